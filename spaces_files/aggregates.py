@@ -0,0 +1,192 @@
+"""
+File counts and sizes of folders.
+
+Every folder keeps the number and total size of the files it contains
+directly (`file_count`, `total_size`) and including all subfolders
+(`tree_file_count`, `tree_total_size`). The counts are updated incrementally
+when files are added, changed, moved or deleted and when folders are moved
+or deleted (see spaces_files.signals and the Folder model), and can be
+recomputed with `recompute_aggregates`.
+
+Along with the folders, the file manager of a space keeps the number and
+total size of all its files (`file_count`, `used_bytes`), which are checked
+against its quota.
+"""
+from contextlib import contextmanager
+import threading
+
+from django.db.models import Count, F, Sum
+
+_state = threading.local()
+
+
+def _suspended():
+    return getattr(_state, 'suspended', 0) > 0
+
+
+@contextmanager
+def suspend_aggregates():
+    """
+    Don't update counts for files deleted or moved within this block, because
+    the caller takes care of it.
+    """
+    _state.suspended = getattr(_state, 'suspended', 0) + 1
+    try:
+        yield
+    finally:
+        _state.suspended -= 1
+
+
+def adjust_usage(file_manager_id, files, size):
+    """
+    Add `files` and `size` (negative values to subtract) to the counts of a
+    file manager.
+    """
+    from .models import SpacesFiles
+    if file_manager_id is None or (not files and not size):
+        return
+    SpacesFiles.objects.filter(pk=file_manager_id).update(
+        file_count=F('file_count') + files,
+        used_bytes=F('used_bytes') + size
+    )
+
+
+def adjust_folder(folder_id, files, size):
+    """
+    Add `files` and `size` (negative values to subtract) to the direct counts
+    of a folder, the recursive counts of the folder and its ancestors and
+    the counts of its file manager.
+    """
+    from .models import Folder
+    if folder_id is None or (not files and not size):
+        return
+    position = Folder.objects.filter(pk=folder_id).values_list(
+        'tree_id', 'lft', 'rght', 'file_manager_id').first()
+    if position is None:
+        return
+    tree_id, lft, rght, file_manager_id = position
+    Folder.objects.filter(pk=folder_id).update(
+        file_count=F('file_count') + files,
+        total_size=F('total_size') + size
+    )
+    Folder.objects.filter(tree_id=tree_id, lft__lte=lft, rght__gte=rght).update(
+        tree_file_count=F('tree_file_count') + files,
+        tree_total_size=F('tree_total_size') + size
+    )
+    adjust_usage(file_manager_id, files, size)
+
+
+def adjust_ancestors(folder_id, sign):
+    """
+    Add (sign=1) or subtract (sign=-1) the recursive counts of a folder to
+    or from all its ancestors, e.g. when the folder is moved or deleted.
+    Returns the folder's recursive file count and size.
+    """
+    from .models import Folder
+    row = Folder.objects.filter(pk=folder_id).values_list(
+        'tree_id', 'lft', 'rght', 'tree_file_count', 'tree_total_size').first()
+    if row is None:
+        return 0, 0
+    tree_id, lft, rght, files, size = row
+    if not files and not size:
+        return 0, 0
+    Folder.objects.filter(tree_id=tree_id, lft__lt=lft, rght__gt=rght).update(
+        tree_file_count=F('tree_file_count') + sign * files,
+        tree_total_size=F('tree_total_size') + sign * size
+    )
+    return files, size
+
+
+@contextmanager
+def moving_folder(folder):
+    """
+    Move the counts of a folder from its old to its new ancestors, around a
+    block that moves the folder.
+    """
+    adjust_ancestors(folder.pk, -1)
+    try:
+        yield
+    finally:
+        # if the move failed, this gives the counts back to the old ancestors
+        adjust_ancestors(folder.pk, 1)
+
+
+def file_saved(file, created):
+    """
+    Update the counts of the folders affected by saving a file.
+    """
+    if _suspended():
+        return
+    size = file.size or 0
+    loaded = getattr(file, '_loaded_values', None)
+    if created or loaded is None:
+        adjust_folder(file.parent_id, 1, size)
+    else:
+        old_parent_id = loaded.get('parent_id')
+        old_size = loaded.get('size') or 0
+        if old_parent_id != file.parent_id:
+            adjust_folder(old_parent_id, -1, -old_size)
+            adjust_folder(file.parent_id, 1, size)
+        elif old_size != size:
+            adjust_folder(file.parent_id, 0, size - old_size)
+    file._loaded_values = {'parent_id': file.parent_id, 'size': file.size, 'file': file.file.name}
+
+
+def file_deleted(file):
+    """
+    Update the counts of the folders affected by deleting a file.
+    """
+    if _suspended():
+        return
+    adjust_folder(file.parent_id, -1, -(file.size or 0))
+
+
+def recompute_aggregates(file_manager_id, folder_model=None, file_model=None):
+    """
+    Recompute the counts of all folders of a file manager, and the file
+    manager's, in a single pass. Returns the number of folders whose counts
+    were wrong.
+
+    Historical models can be passed in for use in migrations, the counts of
+    the file manager are left alone then.
+    """
+    historical = folder_model is not None
+    if folder_model is None or file_model is None:
+        from .models import Folder, File
+        folder_model, file_model = folder_model or Folder, file_model or File
+    folders = list(
+        folder_model.objects.filter(file_manager_id=file_manager_id)
+        .order_by('tree_id', 'lft')
+    )
+    direct = {
+        row['parent']: (row['count'], row['size'] or 0)
+        for row in file_model.objects.filter(parent__file_manager_id=file_manager_id)
+            .values('parent').annotate(count=Count('id'), size=Sum('size'))
+            .order_by()
+    }
+    counts = {}
+    for folder in folders:
+        counts[folder.pk] = list(direct.get(folder.pk, (0, 0))) * 2
+    # children come after their parents in tree order, so summing up in
+    # reverse order adds every subtree to its parent after it's complete
+    for folder in reversed(folders):
+        if folder.parent_id in counts:
+            counts[folder.parent_id][2] += counts[folder.pk][2]
+            counts[folder.parent_id][3] += counts[folder.pk][3]
+    changed = []
+    fields = ('file_count', 'total_size', 'tree_file_count', 'tree_total_size')
+    for folder in folders:
+        values = counts[folder.pk]
+        if [getattr(folder, field) for field in fields] != values:
+            for field, value in zip(fields, values):
+                setattr(folder, field, value)
+            changed.append(folder)
+    folder_model.objects.bulk_update(changed, fields, batch_size=500)
+    if not historical:
+        from .models import SpacesFiles
+        roots = [counts[folder.pk] for folder in folders if folder.parent_id is None]
+        SpacesFiles.objects.filter(pk=file_manager_id).update(
+            file_count=sum(values[2] for values in roots),
+            used_bytes=sum(values[3] for values in roots)
+        )
+    return len(changed)
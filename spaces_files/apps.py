@@ -1,7 +1,11 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_delete, post_migrate
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
 
-from spaces_files.signals import create_notice_types, auto_delete_file_on_delete
+from spaces_files.signals import (create_notice_types, auto_delete_file_on_delete,
+    invalidate_tree_on_folder_change, invalidate_tree_on_folder_delete,
+    invalidate_tree_on_file_change, invalidate_tree_on_file_manager_change,
+    mark_folder_deleting, process_file_on_save,
+    update_aggregates_on_file_delete, update_aggregates_on_file_save)
 
 
 class SpacesFilesConfig(AppConfig):
@@ -11,14 +15,14 @@ class SpacesFilesConfig(AppConfig):
         from . import signals
         # activate activity streams for CalendarEvent
         from actstream import registry
-        from .models import Folder, File
+        from .models import Folder, File, SpacesFiles
         registry.register(Folder)
         registry.register(File)
 
         # register a custom notification
         """
         from spaces_notifications.utils import register_notification
-        from django.utils.translation import ugettext_noop as _
+        from django.utils.translation import gettext_noop as _
         register_notification(
             'spaces_files_file_create',
             _('A new file has been uploaded.'),
@@ -32,3 +36,21 @@ class SpacesFilesConfig(AppConfig):
         """
         post_migrate.connect(create_notice_types, sender=self)
         post_delete.connect(auto_delete_file_on_delete, sender=File)
+
+        # keep cached folder trees up to date
+        from mptt.signals import node_moved
+        post_save.connect(invalidate_tree_on_folder_change, sender=Folder)
+        node_moved.connect(invalidate_tree_on_folder_change, sender=Folder)
+        pre_delete.connect(mark_folder_deleting, sender=Folder)
+        post_delete.connect(invalidate_tree_on_folder_delete, sender=Folder)
+        post_save.connect(invalidate_tree_on_file_change, sender=File)
+        post_delete.connect(invalidate_tree_on_file_change, sender=File)
+        post_save.connect(invalidate_tree_on_file_manager_change, sender=SpacesFiles)
+
+        # keep file counts and sizes of folders up to date
+        post_save.connect(update_aggregates_on_file_save, sender=File)
+        post_delete.connect(update_aggregates_on_file_delete, sender=File)
+
+        # checksums, search index, previews and announcements of new and
+        # changed files
+        post_save.connect(process_file_on_save, sender=File)
@@ -0,0 +1,147 @@
+"""
+Streaming ZIP archives of folders.
+
+The archive is produced while it is sent: zipfile writes to a buffer that is
+emptied after every block of file data, so memory use is bounded by the block
+size and nothing is written to disk.
+"""
+import logging
+import posixpath
+import zipfile
+
+from django.utils import timezone
+
+from .utils import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# content that doesn't get any smaller by compressing it again
+STORED_CONTENT_TYPES = (
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp',
+    'application/zip', 'application/gzip', 'application/x-gzip',
+    'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed',
+    'application/x-rar-compressed', 'application/vnd.rar',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.oasis.opendocument.text',
+    'application/vnd.oasis.opendocument.spreadsheet',
+    'application/vnd.oasis.opendocument.presentation',
+)
+STORED_CONTENT_TYPE_PREFIXES = ('video/', 'audio/')
+
+
+class _StreamBuffer(object):
+    """
+    Write-only file object collecting zipfile's output until it's sent.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def is_compressed(content_type):
+    return (content_type in STORED_CONTENT_TYPES
+            or content_type.startswith(STORED_CONTENT_TYPE_PREFIXES))
+
+
+def _clean_name(name):
+    return name.replace('/', '_').replace('\\', '_').strip() or '_'
+
+
+def _unique(name, taken):
+    """
+    Return `name`, or `name` with a number added if it's in `taken`.
+    """
+    candidate = name
+    root, extension = posixpath.splitext(name)
+    number = 1
+    while candidate.lower() in taken:
+        number += 1
+        candidate = '%s (%d)%s' % (root, number, extension)
+    taken.add(candidate.lower())
+    return candidate
+
+
+def _date_time(value):
+    if value is None:
+        value = timezone.now()
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    # the zip format can't store dates before 1980
+    return max(value.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def folder_entries(folders):
+    """
+    Yield (path, file) tuples for the folders of an in-memory tree (see
+    spaces_files.tree), with `file` None for folders. Paths are relative to
+    the first folder's parent and unique.
+    """
+    paths = {}
+    taken = {}
+    for node in folders:
+        parent_path = paths.get(node.parent_id, '')
+        siblings = taken.setdefault(node.parent_id, set())
+        path = posixpath.join(parent_path, _unique(_clean_name(node.name), siblings))
+        paths[node.pk] = path
+        yield path + '/', None
+        names = taken.setdefault(node.pk, set())
+        for file in node.tree_files:
+            yield posixpath.join(path, _unique(_clean_name(file.get_name()), names)), file
+
+
+def zip_stream(entries, chunk_size=CHUNK_SIZE):
+    """
+    Generate a ZIP archive of (path, file) entries as returned by
+    `folder_entries`, block by block.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as archive:
+        for path, file in entries:
+            info = zipfile.ZipInfo(path, _date_time(getattr(file, 'created_at', None)))
+            if file is None:
+                info.external_attr = 0o40755 << 16 | 0x10
+                archive.writestr(info, b'')
+            else:
+                for data in _write_file(archive, buffer, info, file, chunk_size):
+                    yield data
+            data = buffer.pop()
+            if data:
+                yield data
+    yield buffer.pop()
+
+
+def _write_file(archive, buffer, info, file, chunk_size):
+    info.external_attr = 0o644 << 16
+    info.compress_type = (
+        zipfile.ZIP_STORED if is_compressed(file.content_type)
+        else zipfile.ZIP_DEFLATED
+    )
+    try:
+        source = file.file.storage.open(file.file.name, 'rb')
+    except (IOError, OSError):
+        logger.warning('Skipping missing file %s in archive', file.file.name)
+        return
+    # without a known size, be prepared for large files
+    force_zip64 = file.size is None or file.size > zipfile.ZIP64_LIMIT
+    with source, archive.open(info, 'w', force_zip64=force_zip64) as target:
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+            target.write(data)
+            data = buffer.pop()
+            if data:
+                yield data
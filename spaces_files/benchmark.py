@@ -0,0 +1,251 @@
+"""
+Benchmarks of the folder listing, upload and download paths.
+
+`run_benchmarks` seeds a space with a tree of folders and files and measures
+query count, wall time and peak memory (with tracemalloc) of the views and of
+DefaultServer. It expects an empty database, e.g. a test database as set up
+by the `spaces_files_benchmark` management command, which also writes the
+results as JSON so they can be compared across commits.
+
+Stored files go to a temporary directory. The large download is a sparse
+file, so multi-GB downloads don't need the disk space.
+"""
+from contextlib import contextmanager
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from .aggregates import recompute_aggregates
+from .cache import invalidate_tree
+from .models import File, Folder, SpacesFiles
+from .servers import DefaultServer
+from .tasks import get_backend
+
+BENCHMARK_CACHE = 'spaces_files_benchmark'
+
+
+class DeferredBackend(object):
+    """
+    Task backend collecting tasks until `run_pending` is called, so
+    background work isn't measured as part of a request.
+    """
+    def __init__(self):
+        self.pending = []
+
+    def submit(self, func, *args):
+        self.pending.append((func, args))
+
+    def run_pending(self):
+        while self.pending:
+            func, args = self.pending.pop(0)
+            func(*args)
+
+
+@contextmanager
+def storage_root(root):
+    """
+    Store files in `root` within this block.
+    """
+    storage = File._meta.get_field('file').storage
+    saved = storage.__dict__.copy()
+    storage._location = root
+    for name in ('base_location', 'location'):
+        storage.__dict__.pop(name, None)
+    try:
+        with override_settings(PRIVATE_MEDIA_ROOT=root):
+            yield
+    finally:
+        storage.__dict__.clear()
+        storage.__dict__.update(saved)
+
+
+def seed_space(depth, width, files_per_folder, name='Benchmark'):
+    """
+    Create a space with `width` root folders, each with `width` subfolders
+    down to `depth` levels, and `files_per_folder` files in every folder.
+    File rows point to stored files that don't exist. Returns the space, its
+    file manager and the user owning everything.
+    """
+    from spaces.models import Space
+    from djangoplugins.management.commands.syncplugins import SyncPlugins
+    SyncPlugins(False, 0).all()
+    user = User.objects.create_user(username='benchmark-%s' % name.lower())
+    space = Space.objects.create(name=name, created_by=user, slug=name.lower())
+    user.groups.add(space.get_members())
+    files_plugin = SpacesFiles.objects.create(space=space, active=True)
+    level = [None]
+    with Folder.objects.delay_mptt_updates():
+        for depth_index in range(depth):
+            next_level = []
+            for parent in level:
+                for i in range(width):
+                    next_level.append(Folder.objects.create(
+                        name='Folder %d-%d' % (depth_index, i),
+                        parent=parent,
+                        file_manager=files_plugin,
+                        created_by=user
+                    ))
+            level = next_level
+    files = [
+        File(
+            name='file %d.txt' % i,
+            file='spaces_files/%s/benchmark/%d-%d.txt' % (space.slug, folder.pk, i),
+            parent=folder,
+            created_by=user,
+            size=1024,
+            content_type='text/plain'
+        )
+        for folder in Folder.objects.filter(file_manager=files_plugin)
+        for i in range(files_per_folder)
+    ]
+    File.objects.bulk_create(files, batch_size=500)
+    recompute_aggregates(files_plugin.pk)
+    invalidate_tree(files_plugin.pk)
+    return space, files_plugin, user
+
+
+def _consume(response):
+    """
+    Read the whole response body like a WSGI server would. Returns the
+    number of bytes.
+    """
+    size = 0
+    if response.streaming:
+        for chunk in response:
+            size += len(chunk)
+    else:
+        size = len(response.content)
+    response.close()
+    return size
+
+
+def measure(name, func, repeat, setup=None):
+    """
+    Call `func()` (returning a response) `repeat` times, and once more
+    tracing memory allocations. `setup()` is called before every call.
+    """
+    if repeat < 1:
+        raise ValueError('repeat must be at least 1')
+    times = []
+    queries = []
+    size = 0
+    for i in range(repeat + 1):
+        if setup is not None:
+            setup()
+        # the last run only measures memory, tracing slows everything down
+        trace = i == repeat
+        if trace:
+            tracemalloc.start()
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            response = func()
+            size = _consume(response)
+            elapsed = time.perf_counter() - start
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            times.append(elapsed)
+            queries.append(len(context.captured_queries))
+        backend = get_backend()
+        if isinstance(backend, DeferredBackend):
+            backend.run_pending()
+    return {
+        'name': name,
+        'status': response.status_code,
+        'bytes': size,
+        'queries': max(queries),
+        'time_min': min(times),
+        'time_median': statistics.median(times),
+        'time_max': max(times),
+        'peak_memory': peak,
+    }
+
+
+def run_benchmarks(depth=3, width=4, files_per_folder=10, upload_size=1024 * 1024,
+                   large_size=4 * 1024 ** 3, repeat=5):
+    """
+    Seed a space and run all benchmarks. Returns a dict with metadata and a
+    list of results.
+    """
+    from . import views
+    root = tempfile.mkdtemp(prefix='spaces_files_benchmark')
+    caches = dict(settings.CACHES)
+    caches[BENCHMARK_CACHE] = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    try:
+        with storage_root(root), override_settings(
+                CACHES=caches,
+                SPACES_FILES_TREE_CACHE=BENCHMARK_CACHE,
+                SPACES_FILES_TASK_BACKEND='spaces_files.benchmark.DeferredBackend'):
+            space, files_plugin, user = seed_space(depth, width, files_per_folder)
+            factory = RequestFactory()
+
+            def request(method='get', path='/', data=None, **extra):
+                request = getattr(factory, method)(path, data or {}, **extra)
+                request.user = user
+                request.SPACE = space
+                request._messages = CookieStorage(request)
+                return request
+
+            deepest = Folder.objects.filter(file_manager=files_plugin).order_by('-level', 'pk')[0]
+            file = File.objects.filter(parent=deepest).first()
+            small = os.path.join(root, 'small.bin')
+            with open(small, 'wb') as f:
+                f.write(os.urandom(100 * 1024))
+            large = os.path.join(root, 'large.bin')
+            with open(large, 'wb') as f:
+                f.truncate(large_size)
+            upload_data = os.urandom(upload_size)
+
+            def upload():
+                return views.add_file(request('post', data={
+                    'file': SimpleUploadedFile('upload.bin', upload_data),
+                    'parent': deepest.pk,
+                }))
+
+            results = [
+                measure('index', lambda: views.index(request()), repeat,
+                        setup=lambda: invalidate_tree(files_plugin.pk)),
+                measure('index_cached', lambda: views.index(request()), repeat),
+                measure('show_folder', lambda: views.show_folder(request(), str(deepest.pk)), repeat),
+                measure('show_file', lambda: views.show_file(request(), str(file.pk)), repeat),
+                measure('add_file', upload, repeat),
+                measure('serve_small', lambda: DefaultServer().serve(request(), 'small.bin'), repeat),
+                measure('serve_large', lambda: DefaultServer().serve(request(), 'large.bin'), 1),
+                measure('serve_large_range', lambda: DefaultServer().serve(
+                    request(HTTP_RANGE='bytes=%d-%d' % (large_size // 2, large_size // 2 + 1024 ** 2 - 1)),
+                    'large.bin'), repeat),
+            ]
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'parameters': {
+                'depth': depth,
+                'width': width,
+                'files_per_folder': files_per_folder,
+                'folders': sum(width ** level for level in range(1, depth + 1)),
+                'upload_size': upload_size,
+                'large_size': large_size,
+                'repeat': repeat,
+            },
+        },
+        'results': results,
+    }
@@ -0,0 +1,171 @@
+"""
+Moving and copying many folders and files at once.
+
+Inserting or moving a node renumbers the MPTT tree. Instead of doing that
+for every node, the operations here update and insert rows in bulk and
+rebuild each affected tree once at the end. Folder counts and sizes are
+recomputed in one pass and the cached tree is invalidated once.
+
+No model signals are sent for the moved or created rows, neither
+`post_save` nor MPTT's `node_moved`: receivers that need to know about
+bulk operations have to hook into the views or these functions.
+
+Copied files share the stored file of the original (see
+spaces_files.deletion, which only removes stored files nobody references)
+and its checksum and preview, so they aren't processed again. Only their
+search documents are added, in the background.
+"""
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.translation import gettext as _
+
+from .aggregates import recompute_aggregates
+from .cache import invalidate_tree
+from .models import File, Folder
+from .search import index_files
+from .tasks import run_task
+
+
+class BulkOperationError(Exception):
+    pass
+
+
+def _top_folders(folders):
+    """
+    Drop the folders contained in other given folders, their branch is
+    moved or copied along anyway.
+    """
+    folders = sorted(folders, key=lambda f: (f.tree_id, f.lft))
+    top = []
+    for folder in folders:
+        if not (top and top[-1].tree_id == folder.tree_id
+                and top[-1].lft < folder.lft < top[-1].rght):
+            top.append(folder)
+    return top
+
+
+def _rebuild(files_plugin, tree_ids):
+    for tree_id in sorted(tree_ids):
+        Folder.objects.partial_rebuild(tree_id)
+    recompute_aggregates(files_plugin.pk)
+    invalidate_tree(files_plugin.pk)
+
+
+def move_items(files_plugin, folders, files, target):
+    """
+    Move folders (with their contents) and files into the folder `target`.
+    """
+    folders = _top_folders(folders)
+    for folder in folders:
+        if (folder.tree_id == target.tree_id
+                and folder.lft <= target.lft and target.rght <= folder.rght):
+            raise BulkOperationError(
+                _('Folder "%s" can\'t be moved into itself.') % folder.name)
+    with transaction.atomic():
+        # queryset updates bypass MPTT, the trees are rebuilt below
+        Folder.objects.filter(pk__in=[f.pk for f in folders]).update(parent=target)
+        File.objects.filter(pk__in=[f.pk for f in files]).update(parent=target)
+        _rebuild(files_plugin, set(f.tree_id for f in folders) | {target.tree_id})
+
+
+def copy_items(files_plugin, folders, files, target, user):
+    """
+    Copy folders (with their contents) and files into the folder `target`.
+    The copies are owned by `user` and count towards the space's quota.
+    Returns the number of created folders and files.
+    """
+    folders = _top_folders(folders)
+    # read everything up front, the target may be within a copied folder
+    branches = [list(folder.get_descendants(include_self=True)) for folder in folders]
+    branch_files = {}
+    for file in File.objects.filter(
+            parent__in=[node for branch in branches for node in branch]).order_by('pk'):
+        branch_files.setdefault(file.parent_id, []).append(file)
+    size = sum(file.size or 0 for file in files) + sum(
+        file.size or 0 for branch in branch_files.values() for file in branch)
+    if not files_plugin.has_room_for(size):
+        raise BulkOperationError(
+            _('There is not enough storage left in this space for the copies.'))
+    # copy the branches level by level, children need their parent's id
+    levels = {}
+    for branch in branches:
+        for node in branch:
+            levels.setdefault(node.level - branch[0].level, []).append(node)
+    with transaction.atomic():
+        copies = {}
+        for depth in sorted(levels):
+            nodes = levels[depth]
+            created = _insert_folders([
+                _folder_copy(node, copies[node.parent_id] if depth else target, files_plugin, user)
+                for node in nodes
+            ])
+            copies.update(zip([node.pk for node in nodes], created))
+        file_copies = [
+            _file_copy(file, copies[folder_pk], user)
+            for folder_pk, folder_files in branch_files.items() for file in folder_files
+        ] + [_file_copy(file, target, user) for file in files]
+        last_pk = None
+        if not _returns_bulk_pks():
+            last_pk = File.objects.aggregate(last=Max('pk'))['last'] or 0
+        File.objects.bulk_create(file_copies, batch_size=500)
+        if last_pk is None:
+            file_ids = [file.pk for file in file_copies]
+        else:
+            file_ids = list(File.objects.filter(
+                parent__in=list(copies.values()) + [target], pk__gt=last_pk
+            ).values_list('pk', flat=True))
+        _rebuild(files_plugin, {target.tree_id})
+        if file_ids:
+            transaction.on_commit(lambda: run_task(index_files, file_ids))
+    return len(copies), len(file_copies)
+
+
+def _returns_bulk_pks():
+    features = connection.features
+    # renamed in Django 3.0
+    return getattr(features, 'can_return_rows_from_bulk_insert',
+                   getattr(features, 'can_return_ids_from_bulk_insert', False))
+
+
+def _insert_folders(folders):
+    """
+    Insert new folders, the tree is rebuilt later. Databases that don't
+    return the ids of bulk inserts get an INSERT per folder.
+    """
+    if _returns_bulk_pks():
+        return Folder.objects.bulk_create(folders)
+    with Folder.objects.disable_mptt_updates():
+        for folder in folders:
+            folder.save()
+    return folders
+
+
+def _folder_copy(folder, parent, files_plugin, user):
+    # placeholder tree fields, set by the rebuild
+    return Folder(
+        name=folder.name,
+        description=folder.description,
+        file_manager=files_plugin,
+        parent=parent,
+        created_by=user,
+        tree_id=parent.tree_id,
+        lft=0,
+        rght=0,
+        level=parent.level + 1
+    )
+
+
+def _file_copy(file, parent, user):
+    return File(
+        name=file.name,
+        description=file.description,
+        file=file.file.name,
+        parent=parent,
+        created_by=user,
+        size=file.size,
+        content_type=file.content_type,
+        checksum=file.checksum,
+        has_preview=file.has_preview,
+        processing_status=file.processing_status,
+        processing_error=file.processing_error
+    )
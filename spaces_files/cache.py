@@ -0,0 +1,107 @@
+"""
+Cache of folder trees.
+
+The folders and files of a file manager (a space's SpacesFiles instance) are
+cached together under a version number. Any change to a folder or file
+increments the version (see spaces_files.signals), so stale trees are never
+read and simply expire.
+
+The cache is configured with SPACES_FILES_TREE_CACHE, the alias of a cache in
+CACHES ('default' unless set, None disables caching), and
+SPACES_FILES_TREE_CACHE_TIMEOUT in seconds.
+
+Hits, misses and invalidations are counted per process, and also in the
+Prometheus counters spaces_files_tree_cache_{hits,misses,invalidations}_total
+when spaces_files.instrumentation.PrometheusSink is configured.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import instrumentation
+
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_stats_lock = threading.Lock()
+_help = {
+    'hits': 'Folder trees read from the cache.',
+    'misses': 'Folder trees loaded from the database.',
+    'invalidations': 'Cached folder trees made stale.',
+}
+
+
+def _count(stat):
+    with _stats_lock:
+        _stats[stat] += 1
+    instrumentation.count('spaces_files_tree_cache_%s_total' % stat, _help[stat])
+
+
+def get_tree_cache_stats():
+    """
+    Return the number of cache hits, misses and invalidations of this
+    process.
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_tree_cache_stats():
+    with _stats_lock:
+        for stat in _stats:
+            _stats[stat] = 0
+
+
+def get_tree_cache():
+    alias = getattr(settings, 'SPACES_FILES_TREE_CACHE', 'default')
+    return caches[alias] if alias else None
+
+
+def _version_key(file_manager_id):
+    return 'spaces_files:tree_version:%s' % file_manager_id
+
+
+def _get_version(cache, file_manager_id):
+    key = _version_key(file_manager_id)
+    version = cache.get(key)
+    if version is None:
+        # start from the current time rather than 1, so trees cached before
+        # the version key got evicted aren't valid again
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def get_tree_data(file_manager_id, loader):
+    """
+    Return the cached tree data of a file manager. On a miss, the data is
+    loaded by calling `loader(file_manager_id)` and stored.
+    """
+    cache = get_tree_cache()
+    if cache is None:
+        return loader(file_manager_id)
+    key = 'spaces_files:tree:%s:%s' % (file_manager_id, _get_version(cache, file_manager_id))
+    data = cache.get(key)
+    if data is None:
+        _count('misses')
+        data = loader(file_manager_id)
+        cache.set(
+            key, data, getattr(settings, 'SPACES_FILES_TREE_CACHE_TIMEOUT', 24 * 60 * 60))
+    else:
+        _count('hits')
+    return data
+
+
+def invalidate_tree(file_manager_id):
+    """
+    Make the cached tree of a file manager stale.
+    """
+    cache = get_tree_cache()
+    if cache is None or file_manager_id is None:
+        return
+    _count('invalidations')
+    try:
+        cache.incr(_version_key(file_manager_id))
+    except ValueError:
+        # no version yet, nothing cached
+        pass
@@ -0,0 +1,81 @@
+"""
+Removal of stored files.
+
+Deleting a folder can cascade to thousands of files. Instead of removing the
+stored files one by one within the request, the names deleted by a
+transaction are collected and, once it has been committed, handed to
+background tasks (see spaces_files.tasks) in batches. The names are the
+tasks' arguments, so backends for external job queues can run them in
+another process.
+"""
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from .previews import preview_name
+from .tasks import run_task
+from .utils import lock_stored_file
+
+logger = logging.getLogger(__name__)
+
+# number of stored files checked and removed at once
+DELETE_BATCH_SIZE = getattr(settings, 'SPACES_FILES_DELETE_BATCH_SIZE', 500)
+
+
+class DeletionBatch(object):
+    """
+    The stored files deleted by one transaction. Called on commit.
+    """
+    def __init__(self):
+        self.names = []
+
+    def __call__(self):
+        names, self.names = self.names, []
+        for start in range(0, len(names), DELETE_BATCH_SIZE):
+            run_task(delete_stored_files, names[start:start + DELETE_BATCH_SIZE])
+
+
+def _is_registered(connection, hook):
+    # rolling back a transaction or the savepoint a hook was registered in
+    # drops the hook
+    return any(entry[1] is hook for entry in connection.run_on_commit)
+
+
+def schedule_file_deletion(name):
+    """
+    Remove the stored file `name` after the current transaction has been
+    committed. Nothing is removed if the transaction is rolled back.
+    """
+    connection = transaction.get_connection()
+    batch = getattr(connection, '_spaces_files_deletions', None)
+    if batch is not None and _is_registered(connection, batch):
+        # names of a rolled back savepoint may stay in the batch, their
+        # Files exist again and delete_stored_files keeps them
+        batch.names.append(name)
+        return
+    batch = connection._spaces_files_deletions = DeletionBatch()
+    batch.names.append(name)
+    # outside of a transaction, the batch runs right away
+    transaction.on_commit(batch)
+
+
+def delete_stored_files(names):
+    """
+    Remove the given files and their previews from storage unless a File
+    still references them.
+    """
+    from .models import File
+    storage = File._meta.get_field('file').storage
+    referenced = set(
+        File.objects.filter(file__in=names).values_list('file', flat=True))
+    for name in set(names) - referenced:
+        with transaction.atomic():
+            # waits for uploads reusing the file, see File.reuse_stored_blob
+            if lock_stored_file(name) and File.objects.filter(file=name).exists():
+                continue
+            try:
+                storage.delete(name)
+                storage.delete(preview_name(name))
+            except OSError:
+                logger.exception('Could not remove stored file %s', name)
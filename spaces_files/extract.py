@@ -0,0 +1,105 @@
+"""
+Text extraction for the full-text search.
+
+Plain text, office documents (OOXML and OpenDocument, read with zipfile) and,
+if pdfminer.six is installed, PDF files are supported. Extraction never reads
+more than SPACES_FILES_SEARCH_MAX_TEXT characters of text, nor more than
+SPACES_FILES_SEARCH_MAX_PDF_PAGES pages of a PDF file.
+"""
+import logging
+import re
+import zipfile
+from xml.sax.saxutils import unescape
+
+from django.conf import settings
+
+try:
+    from pdfminer.high_level import extract_text as pdf_extract_text
+except ImportError:
+    pdf_extract_text = None
+
+logger = logging.getLogger(__name__)
+
+MAX_TEXT = getattr(settings, 'SPACES_FILES_SEARCH_MAX_TEXT', 1024 * 1024)
+# parsing PDF pages is slow, large files would keep a worker busy for long
+MAX_PDF_PAGES = getattr(settings, 'SPACES_FILES_SEARCH_MAX_PDF_PAGES', 100)
+
+TEXT_CONTENT_TYPES = (
+    'application/json', 'application/xml', 'application/javascript',
+    'application/x-sh', 'application/x-tex', 'application/rtf',
+)
+
+# members of office documents that contain their text
+OFFICE_MEMBERS = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+        re.compile(r'^word/(document|footnotes|endnotes)\.xml$'),
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
+        re.compile(r'^xl/sharedStrings\.xml$'),
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation':
+        re.compile(r'^ppt/slides/slide\d+\.xml$'),
+    'application/vnd.oasis.opendocument.text': re.compile(r'^content\.xml$'),
+    'application/vnd.oasis.opendocument.spreadsheet': re.compile(r'^content\.xml$'),
+    'application/vnd.oasis.opendocument.presentation': re.compile(r'^content\.xml$'),
+}
+
+_tags = re.compile(r'<[^>]+>')
+_whitespace = re.compile(r'\s+')
+
+
+def _xml_text(data):
+    text = _tags.sub(' ', data.decode('utf-8', 'replace'))
+    return _whitespace.sub(' ', unescape(text, {'&quot;': '"', '&apos;': "'"}))
+
+
+def extract_plain_text(fileobj):
+    return fileobj.read(MAX_TEXT).decode('utf-8', 'replace')
+
+
+def extract_office_text(fileobj, members):
+    parts = []
+    length = 0
+    with zipfile.ZipFile(fileobj) as archive:
+        for name in sorted(archive.namelist()):
+            if members.match(name):
+                parts.append(_xml_text(archive.read(name)))
+                length += len(parts[-1])
+                if length >= MAX_TEXT:
+                    break
+    return ' '.join(parts)[:MAX_TEXT]
+
+
+def extract_pdf_text(fileobj):
+    return pdf_extract_text(fileobj, maxpages=MAX_PDF_PAGES)[:MAX_TEXT]
+
+
+def get_extractor(content_type):
+    """
+    Return a function extracting the text from a file object of the given
+    content type, or None if the content type isn't supported.
+    """
+    if content_type.startswith('text/') or content_type in TEXT_CONTENT_TYPES:
+        return extract_plain_text
+    if content_type in OFFICE_MEMBERS:
+        members = OFFICE_MEMBERS[content_type]
+        return lambda fileobj: extract_office_text(fileobj, members)
+    if content_type == 'application/pdf' and pdf_extract_text is not None:
+        return extract_pdf_text
+    return None
+
+
+def extract_text(file):
+    """
+    Return the text content of a File, or an empty string if the content
+    type isn't supported or the file can't be read.
+    """
+    extractor = get_extractor(file.content_type or '')
+    if extractor is None:
+        return ''
+    try:
+        with file.file.storage.open(file.file.name, 'rb') as fileobj:
+            text = extractor(fileobj)
+    except Exception:
+        logger.warning('Could not extract text from %s', file.file.name, exc_info=True)
+        return ''
+    # NUL characters can't be stored in PostgreSQL text columns
+    return text[:MAX_TEXT].replace('\x00', '')
@@ -1,5 +1,28 @@
 from django import forms
-from .models import File, Folder
+from django.template.defaultfilters import filesizeformat
+from django.utils.translation import gettext_lazy as _
+from .models import File, Folder, UploadSession
+
+
+def check_quota(files_plugin, size):
+    """
+    Raise a ValidationError if `size` more bytes exceed the space's quota.
+    Runs before anything is written to the storage.
+    """
+    if files_plugin is None or files_plugin.has_room_for(size):
+        return
+    quota = files_plugin.get_quota()
+    raise forms.ValidationError(
+        _('There is not enough storage left in this space: %(size)s needed, '
+          '%(free)s of %(quota)s available.'),
+        code='quota',
+        params={
+            'size': filesizeformat(size),
+            'free': filesizeformat(max(quota - files_plugin.used_bytes, 0)),
+            'quota': filesizeformat(quota),
+        }
+    )
+
 
 class FolderForm(forms.ModelForm):
     description = forms.CharField(
@@ -8,10 +31,10 @@ class FolderForm(forms.ModelForm):
     )
 
     def __init__(self, *args, **kwargs):
-        self.space = kwargs.pop('space', None)
+        self.files_plugin = kwargs.pop('files_plugin', None)
         super(FolderForm, self).__init__(*args, **kwargs)
         parent = self.fields['parent']
-        parent.queryset = parent.queryset.filter(file_manager__space=self.space)
+        parent.queryset = parent.queryset.filter(file_manager=self.files_plugin)
         self.fields.update({'parent': parent})
 
     class Meta:
@@ -25,12 +48,131 @@ class FileForm(forms.ModelForm):
     )
 
     def __init__(self, *args, **kwargs):
-        self.space = kwargs.pop('space', None)
+        self.files_plugin = kwargs.pop('files_plugin', None)
         super(FileForm, self).__init__(*args, **kwargs)
         parent = self.fields['parent']
-        parent.queryset = parent.queryset.filter(file_manager__space=self.space)
+        parent.queryset = parent.queryset.filter(file_manager=self.files_plugin)
         self.fields.update({'parent': parent})
+
+    def clean_file(self):
+        file = self.cleaned_data.get('file')
+        # a new upload, not the stored file of the edited instance
+        if file and not getattr(file, '_committed', False):
+            replaced = (self.instance.size or 0) if self.instance.pk else 0
+            check_quota(self.files_plugin, file.size - replaced)
+        return file
     
     class Meta:
         model = File
-        fields = ('name', 'description', 'file', 'parent')
\ No newline at end of file
+        fields = ('name', 'description', 'file', 'parent')
+
+class MultipleFileInput(forms.ClearableFileInput):
+    """
+    File input that lets the user select several files. Recent Django
+    versions refuse `attrs={'multiple': True}` on a plain file input.
+    """
+    allow_multiple_selected = True
+
+    def get_context(self, name, value, attrs):
+        context = super(MultipleFileInput, self).get_context(name, value, attrs)
+        context['widget']['attrs']['multiple'] = True
+        return context
+
+    def value_from_datadict(self, data, files, name):
+        # older Django versions ignore allow_multiple_selected
+        return files.getlist(name)
+
+
+class MultipleFileField(forms.FileField):
+    """
+    FileField cleaning a list of uploaded files, returns a list.
+    """
+    widget = MultipleFileInput
+
+    def clean(self, data, initial=None):
+        if not isinstance(data, (list, tuple)):
+            data = [data] if data else []
+        if not data:
+            # raises if the field is required
+            super(MultipleFileField, self).clean(None, initial)
+            return []
+        return [super(MultipleFileField, self).clean(f, initial) for f in data]
+
+
+class MultiFileForm(forms.Form):
+    """
+    Upload any number of files into a folder at once.
+    """
+    files = MultipleFileField(label=_('Files'))
+    description = forms.CharField(
+        widget = forms.Textarea(attrs={'rows': 2}),
+        required = False
+    )
+    parent = forms.ModelChoiceField(
+        label=_('parent folder'),
+        queryset=Folder.objects.all()
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.files_plugin = kwargs.pop('files_plugin', None)
+        super(MultiFileForm, self).__init__(*args, **kwargs)
+        parent = self.fields['parent']
+        parent.queryset = parent.queryset.filter(file_manager=self.files_plugin)
+        self.fields.update({'parent': parent})
+
+    def clean_files(self):
+        files = self.cleaned_data['files']
+        check_quota(self.files_plugin, sum(f.size for f in files))
+        return files
+
+
+class BulkItemsForm(forms.Form):
+    """
+    Select folders and files of a space to move or copy into a target
+    folder.
+    """
+    folders = forms.ModelMultipleChoiceField(queryset=Folder.objects.all(), required=False)
+    files = forms.ModelMultipleChoiceField(queryset=File.objects.all(), required=False)
+    target = forms.ModelChoiceField(
+        label=_('target folder'),
+        queryset=Folder.objects.all()
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.files_plugin = kwargs.pop('files_plugin', None)
+        super(BulkItemsForm, self).__init__(*args, **kwargs)
+        for name in ('folders', 'target'):
+            field = self.fields[name]
+            field.queryset = field.queryset.filter(file_manager=self.files_plugin)
+        field = self.fields['files']
+        field.queryset = field.queryset.filter(parent__file_manager=self.files_plugin)
+
+    def clean(self):
+        cleaned_data = super(BulkItemsForm, self).clean()
+        if not cleaned_data.get('folders') and not cleaned_data.get('files'):
+            raise forms.ValidationError(_('Select at least one folder or file.'))
+        return cleaned_data
+
+
+class UploadSessionForm(forms.ModelForm):
+    """
+    Start a chunked upload of a file with the given name and size.
+    """
+    def __init__(self, *args, **kwargs):
+        self.files_plugin = kwargs.pop('files_plugin', None)
+        super(UploadSessionForm, self).__init__(*args, **kwargs)
+        parent = self.fields['parent']
+        parent.queryset = parent.queryset.filter(file_manager=self.files_plugin)
+        self.fields.update({'parent': parent})
+
+    def clean_size(self):
+        size = self.cleaned_data['size']
+        if size < 0:
+            raise forms.ValidationError(_('The file size must not be negative.'))
+        # refuse before any chunk is sent
+        check_quota(self.files_plugin, size)
+        return size
+
+    class Meta:
+        model = UploadSession
+        fields = ('filename', 'name', 'description', 'size', 'parent')
@@ -0,0 +1,351 @@
+"""
+Per-request metrics of the views and file servers.
+
+Instrumented views (see `instrument`) record the number and duration of
+database queries, the number and duration of storage calls, the bytes of
+file content sent and the time spent in named phases (`phase`). When the response has been
+sent, the metrics go to the sinks configured in SPACES_FILES_METRICS_SINKS,
+a list of dotted paths:
+
+* `spaces_files.instrumentation.LoggingSink` logs one line per request to
+  the `spaces_files.metrics` logger.
+* `spaces_files.instrumentation.PrometheusSink` adds up counters in
+  `registry`, which `metrics_view` exposes in the Prometheus text format.
+* `spaces_files.instrumentation.ServerTimingSink` adds a `Server-Timing`
+  header to the response (for everything measured before the body is sent).
+
+Without sinks, which is the default, nothing is measured.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('spaces_files.metrics')
+
+_state = threading.local()
+_sinks = None
+_sinks_lock = threading.Lock()
+
+# storage methods whose calls are counted
+STORAGE_METHODS = ('open', 'save', 'delete', 'exists', 'size', 'listdir', 'get_modified_time')
+
+
+class RequestMetrics(object):
+    """
+    What one request cost.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.queries = 0
+        self.query_time = 0.0
+        self.storage_calls = defaultdict(int)
+        self.storage_time = 0.0
+        # counted while the body of a streaming response is sent
+        self.bytes_served = 0
+        self.status = None
+        # phases may overlap, e.g. permission checks while rendering
+        self.phases = defaultdict(float)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def as_dict(self):
+        return {
+            'view': self.name,
+            'status': self.status,
+            'duration': self.duration,
+            'queries': self.queries,
+            'query_time': self.query_time,
+            'storage_calls': dict(self.storage_calls),
+            'storage_time': self.storage_time,
+            'bytes_served': self.bytes_served,
+            'phases': dict(self.phases),
+        }
+
+
+class MetricsSink(object):
+    """
+    Base class of metric sinks.
+    """
+    def process_response(self, metrics, response):
+        """
+        Called when the view returned, before the response is sent.
+        """
+
+    def record(self, metrics):
+        """
+        Called after the response has been sent.
+        """
+
+
+class LoggingSink(MetricsSink):
+    def record(self, metrics):
+        logger.info(
+            '%s status=%s duration=%.1fms queries=%d query_time=%.1fms '
+            'storage_calls=%d storage_time=%.1fms bytes=%d %s',
+            metrics.name, metrics.status, metrics.duration * 1000, metrics.queries,
+            metrics.query_time * 1000, sum(metrics.storage_calls.values()),
+            metrics.storage_time * 1000, metrics.bytes_served,
+            ' '.join('%s=%.1fms' % (name, value * 1000)
+                     for name, value in sorted(metrics.phases.items())),
+            extra={'metrics': metrics.as_dict()}
+        )
+
+
+class CounterRegistry(object):
+    """
+    Thread-safe counters with labels, exposed in the Prometheus text format.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.help = {}
+
+    def inc(self, name, labels, value=1, help=''):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+            self.help.setdefault(name, help)
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+
+    def expose(self):
+        lines = []
+        with self.lock:
+            names = sorted(set(name for name, labels in self.counters))
+            for name in names:
+                lines.append('# HELP %s %s' % (name, self.help.get(name, '')))
+                lines.append('# TYPE %s counter' % name)
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter != name:
+                        continue
+                    label_text = ','.join(
+                        '%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                        for key, label in labels)
+                    lines.append('%s{%s} %r' % (name, label_text, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = CounterRegistry()
+
+
+class PrometheusSink(MetricsSink):
+    def record(self, metrics):
+        view = {'view': metrics.name}
+        registry.inc('spaces_files_requests_total', dict(view, status=metrics.status),
+                     help='Requests handled.')
+        registry.inc('spaces_files_request_seconds_total', view, metrics.duration,
+                     help='Time spent handling requests, including sending the response.')
+        registry.inc('spaces_files_db_queries_total', view, metrics.queries,
+                     help='Database queries.')
+        registry.inc('spaces_files_db_seconds_total', view, metrics.query_time,
+                     help='Time spent in database queries.')
+        for operation, count in metrics.storage_calls.items():
+            registry.inc('spaces_files_storage_calls_total', dict(view, operation=operation),
+                         count, help='Storage calls.')
+        registry.inc('spaces_files_storage_seconds_total', view, metrics.storage_time,
+                     help='Time spent in storage calls.')
+        registry.inc('spaces_files_bytes_served_total', view, metrics.bytes_served,
+                     help='Bytes of file content sent by Django, not by the web server.')
+        for name, value in metrics.phases.items():
+            registry.inc('spaces_files_phase_seconds_total', dict(view, phase=name), value,
+                         help='Time spent in request phases.')
+
+
+class ServerTimingSink(MetricsSink):
+    def process_response(self, metrics, response):
+        entries = [
+            'db;dur=%.1f;desc="%d queries"' % (metrics.query_time * 1000, metrics.queries),
+            'storage;dur=%.1f;desc="%d calls"' % (
+                metrics.storage_time * 1000, sum(metrics.storage_calls.values())),
+        ]
+        entries.extend(
+            '%s;dur=%.1f' % (name, value * 1000) for name, value in sorted(metrics.phases.items()))
+        entries.append('view;dur=%.1f' % (metrics.elapsed() * 1000))
+        response['Server-Timing'] = ', '.join(entries)
+
+
+def get_sinks():
+    global _sinks
+    with _sinks_lock:
+        if _sinks is None:
+            _sinks = [
+                import_string(path)()
+                for path in getattr(settings, 'SPACES_FILES_METRICS_SINKS', [])
+            ]
+        return _sinks
+
+
+def count(name, help=''):
+    """
+    Increment the process-wide counter `name` of `registry`, if
+    PrometheusSink is configured.
+    """
+    if any(isinstance(sink, PrometheusSink) for sink in get_sinks()):
+        registry.inc(name, {}, help=help)
+
+
+@receiver(setting_changed)
+def reset_sinks(setting, **kwargs):
+    global _sinks
+    if setting == 'SPACES_FILES_METRICS_SINKS':
+        _sinks = None
+
+
+def current_metrics():
+    """
+    Return the metrics of the request being handled by this thread, if it's
+    instrumented.
+    """
+    return getattr(_state, 'metrics', None)
+
+
+@contextmanager
+def phase(name):
+    """
+    Add the time spent in this block to the phase `name` of the current
+    request.
+    """
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.phases[name] += time.perf_counter() - start
+
+
+def _count_query(execute, sql, params, many, context):
+    metrics = current_metrics()
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if metrics is not None:
+            metrics.queries += 1
+            metrics.query_time += time.perf_counter() - start
+
+
+def record_storage_call(operation, duration=0.0):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.storage_calls[operation] += 1
+        metrics.storage_time += duration
+
+
+def _counted(operation, method):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if current_metrics() is None:
+            return method(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            record_storage_call(operation, time.perf_counter() - start)
+    return wrapper
+
+
+def instrument_storage(storage):
+    """
+    Count the calls to a storage instance.
+    """
+    if getattr(storage, '_spaces_files_instrumented', False):
+        return
+    for name in STORAGE_METHODS:
+        if hasattr(storage, name):
+            setattr(storage, name, _counted(name, getattr(storage, name)))
+    storage._spaces_files_instrumented = True
+
+
+def _count_bytes(metrics, content):
+    for chunk in content:
+        metrics.bytes_served += len(chunk)
+        yield chunk
+
+
+async def _count_bytes_async(metrics, content):
+    async for chunk in content:
+        metrics.bytes_served += len(chunk)
+        yield chunk
+
+
+class _Finisher(object):
+    """
+    Closed along with the response, i.e. when it has been sent.
+    """
+    def __init__(self, metrics, sinks):
+        self.metrics = metrics
+        self.sinks = sinks
+
+    def close(self):
+        self.metrics.duration = self.metrics.elapsed()
+        for sink in self.sinks:
+            try:
+                sink.record(self.metrics)
+            except Exception:
+                logger.exception('Metrics sink %r failed', sink)
+
+
+def instrument(name):
+    """
+    Decorator measuring a view (or any function returning a response) as
+    `name`. Calls within an instrumented call are measured as part of it.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            sinks = get_sinks()
+            if not sinks or current_metrics() is not None:
+                return func(*args, **kwargs)
+            from .models import File
+            instrument_storage(File._meta.get_field('file').storage)
+            metrics = _state.metrics = RequestMetrics(name)
+            try:
+                with connection.execute_wrapper(_count_query):
+                    response = func(*args, **kwargs)
+            finally:
+                _state.metrics = None
+            metrics.status = response.status_code
+            if response.streaming:
+                # file responses, count what is actually sent: ranges and
+                # aborted downloads send less than the file's size
+                count = _count_bytes_async if getattr(response, 'is_async', False) else _count_bytes
+                response.streaming_content = count(metrics, response.streaming_content)
+            for sink in sinks:
+                sink.process_response(metrics, response)
+            response._closable_objects.append(_Finisher(metrics, sinks))
+            return response
+        return wrapper
+    return decorator
+
+
+def metrics_view(request):
+    """
+    Expose the counters of PrometheusSink. Only for staff users, or include
+    it in a URLconf that's only reachable by the monitoring system.
+    """
+    if not request.user.is_staff:
+        raise PermissionDenied
+    return HttpResponse(registry.expose(), content_type='text/plain; version=0.0.4')
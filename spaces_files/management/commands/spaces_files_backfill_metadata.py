@@ -0,0 +1,70 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from spaces_files.aggregates import recompute_aggregates
+from spaces_files.cache import invalidate_tree
+from spaces_files.models import File, SpacesFiles
+
+
+class Command(BaseCommand):
+    help = (
+        "Store size, content type and checksum for files uploaded before "
+        "these columns existed, then recompute the folder sizes and the "
+        "storage used by the spaces."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help="Number of rows to load and update at once."
+        )
+        parser.add_argument(
+            '--all', action='store_true',
+            help="Recompute metadata for all files, not only incomplete ones."
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        qs = File.objects.select_related('parent').order_by('pk')
+        if not options['all']:
+            qs = qs.filter(Q(size__isnull=True) | Q(checksum='') | Q(content_type=''))
+        updated = missing = 0
+        file_manager_ids = set()
+        last_pk = 0
+        while True:
+            batch = list(qs.filter(pk__gt=last_pk)[:chunk_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            changed = []
+            for obj in batch:
+                try:
+                    obj.update_file_metadata()
+                except (IOError, OSError):
+                    missing += 1
+                    self.stderr.write("Missing file for %s (id %s): %s" % (
+                        obj, obj.pk, obj.file.name))
+                    continue
+                finally:
+                    obj.file.close()
+                changed.append(obj)
+                file_manager_ids.add(obj.parent.file_manager_id)
+            File.objects.bulk_update(changed, ['size', 'content_type', 'checksum'])
+            updated += len(changed)
+            self.stdout.write("Updated %s files..." % updated)
+        if file_manager_ids:
+            # the quotas of the spaces still count the missing sizes as 0
+            call_command(
+                'spaces_files_reconcile_usage',
+                *SpacesFiles.objects.filter(pk__in=file_manager_ids).values_list(
+                    'space__slug', flat=True),
+                fix=True, skip_storage=True, stdout=self.stdout, stderr=self.stderr
+            )
+        # bulk_update sends no signals, the folder sizes still count the
+        # missing sizes as 0
+        for file_manager_id in sorted(file_manager_ids):
+            recompute_aggregates(file_manager_id)
+            invalidate_tree(file_manager_id)
+        self.stdout.write(self.style.SUCCESS(
+            "Done. Updated %s files, %s files missing in storage." % (updated, missing)))
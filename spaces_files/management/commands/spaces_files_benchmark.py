@@ -0,0 +1,59 @@
+import argparse
+import json
+
+from django.core.management.base import BaseCommand
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from spaces_files.benchmark import run_benchmarks
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got %s" % value)
+    return number
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark folder listings, uploads and downloads in a test database "
+        "and write the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depth', type=int, default=3, help="Levels of folders.")
+        parser.add_argument('--width', type=int, default=4, help="Subfolders per folder.")
+        parser.add_argument('--files', type=int, default=10, help="Files per folder.")
+        parser.add_argument(
+            '--upload-size', type=int, default=1024 * 1024,
+            help="Size of the uploaded file in bytes.")
+        parser.add_argument(
+            '--large-size', type=int, default=4 * 1024 ** 3,
+            help="Size of the large downloaded file in bytes.")
+        parser.add_argument('--repeat', type=positive_int, default=5, help="Runs per benchmark.")
+        parser.add_argument('--output', help="File to write the results to instead of stdout.")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            results = run_benchmarks(
+                depth=options['depth'],
+                width=options['width'],
+                files_per_folder=options['files'],
+                upload_size=options['upload_size'],
+                large_size=options['large_size'],
+                repeat=options['repeat'],
+            )
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+        data = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+            self.stdout.write(self.style.SUCCESS("Results written to %s." % options['output']))
+        else:
+            self.stdout.write(data)
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from spaces_files.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = "Delete chunked uploads that haven't been finalized in time."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=int, default=24,
+            help="Delete upload sessions older than this many hours."
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        count = 0
+        for session in UploadSession.objects.filter(created_at__lt=cutoff):
+            session.delete()
+            count += 1
+        self.stdout.write(self.style.SUCCESS("Deleted %s upload sessions." % count))
@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from spaces_files import models
+from spaces_files.cache import invalidate_tree
+from spaces_files.deletion import delete_stored_files
+from spaces_files.models import File, blob_path
+from spaces_files.previews import preview_name
+
+
+class Command(BaseCommand):
+    help = (
+        "Store files with identical content only once. Files sharing a "
+        "checksum are moved to a single content addressed blob. Run "
+        "spaces_files_backfill_metadata first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only report how much space would be saved."
+        )
+        parser.add_argument(
+            '--force', action='store_true',
+            help="Merge duplicates even though SPACES_FILES_DEDUPLICATE is off."
+        )
+
+    def handle(self, *args, **options):
+        if not (models.DEDUPLICATE_UPLOADS or options['dry_run'] or options['force']):
+            raise CommandError(
+                "SPACES_FILES_DEDUPLICATE is off, so merged files would be "
+                "duplicated again by new uploads. Use --force to merge anyway.")
+        storage = File._meta.get_field('file').storage
+        duplicates = (
+            File.objects.exclude(checksum='')
+            .values('checksum')
+            .annotate(count=Count('id'))
+            .filter(count__gt=1)
+            .order_by('checksum')
+        )
+        saved_bytes = 0
+        for group in duplicates.iterator():
+            files = list(
+                File.objects.filter(checksum=group['checksum'])
+                .select_related('parent').order_by('pk'))
+            names = set(f.file.name for f in files)
+            saved_bytes += (len(names) - 1) * (files[0].size or 0)
+            if options['dry_run'] or len(names) == 1:
+                continue
+            name = blob_path(group['checksum'], files[0].file.name)
+            if not storage.exists(name):
+                with storage.open(files[0].file.name) as content:
+                    name = storage.save(name, content)
+            has_preview = self.keep_preview(storage, name, names)
+            File.objects.filter(pk__in=[f.pk for f in files]).update(
+                file=name, has_preview=has_preview)
+            for file_manager_id in set(f.parent.file_manager_id for f in files):
+                invalidate_tree(file_manager_id)
+            # with their previews, unless an upload started to reuse them
+            delete_stored_files(names - {name})
+        self.stdout.write(self.style.SUCCESS(
+            "%s %s bytes." % ("Would save" if options['dry_run'] else "Saved", saved_bytes)))
+
+    def keep_preview(self, storage, name, old_names):
+        """
+        Make sure the blob `name` has the preview of one of the merged
+        files, if any had one. Return whether it has a preview.
+        """
+        if storage.exists(preview_name(name)):
+            return True
+        for old_name in sorted(old_names):
+            if storage.exists(preview_name(old_name)):
+                with storage.open(preview_name(old_name)) as content:
+                    saved = storage.save(preview_name(name), content)
+                if saved != preview_name(name):
+                    # stored by someone else in the meantime
+                    storage.delete(saved)
+                return True
+        return False
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from spaces_files.models import File
+from spaces_files.previews import Image, generate_preview
+
+
+class Command(BaseCommand):
+    help = "Render previews of images and PDF files uploaded before previews existed."
+
+    def handle(self, *args, **options):
+        if Image is None:
+            self.stderr.write("Pillow is not installed, no previews can be rendered.")
+            return
+        files = File.objects.filter(has_preview=False).filter(
+            Q(content_type__startswith='image/') | Q(content_type='application/pdf')
+        ).order_by('pk').values_list('pk', flat=True)
+        count = 0
+        for count, file_id in enumerate(files.iterator(), 1):
+            generate_preview(file_id)
+            if count % 100 == 0:
+                self.stdout.write("Processed %s files..." % count)
+        self.stdout.write(self.style.SUCCESS("Done. Processed %s files." % count))
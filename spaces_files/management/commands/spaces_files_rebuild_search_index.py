@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from spaces_files.models import File
+from spaces_files.search import index_file
+
+
+class Command(BaseCommand):
+    help = (
+        "Extract the text of all files and (re)build the full-text search "
+        "index. Text is only extracted again for files whose content changed."
+    )
+
+    def handle(self, *args, **options):
+        file_ids = File.objects.order_by('pk').values_list('pk', flat=True)
+        count = 0
+        for count, file_id in enumerate(file_ids.iterator(), 1):
+            index_file(file_id)
+            if count % 500 == 0:
+                self.stdout.write("Indexed %s files..." % count)
+        self.stdout.write(self.style.SUCCESS("Done. Indexed %s files." % count))
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from spaces_files.models import File, SpacesFiles
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the file counts and sizes of spaces with their files and "
+        "the stored files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'spaces', nargs='*',
+            help="Slugs of the spaces to check. Defaults to all spaces."
+        )
+        parser.add_argument(
+            '--fix', action='store_true',
+            help="Store the counts of the files in the database."
+        )
+        parser.add_argument(
+            '--skip-storage', action='store_true',
+            help="Don't look at the stored files, only compare with the database."
+        )
+
+    def handle(self, *args, **options):
+        storage = File._meta.get_field('file').storage
+        file_managers = SpacesFiles.objects.select_related('space').order_by('pk')
+        if options['spaces']:
+            file_managers = file_managers.filter(space__slug__in=options['spaces'])
+        wrong = 0
+        for file_manager in file_managers:
+            files = File.objects.filter(parent__file_manager=file_manager)
+            totals = files.aggregate(count=Count('id'), size=Sum('size'))
+            count, size = totals['count'], totals['size'] or 0
+            if (file_manager.file_count, file_manager.used_bytes) != (count, size):
+                wrong += 1
+                self.stdout.write("%s: counted %s files with %s bytes, found %s files with %s bytes." % (
+                    file_manager.space, file_manager.file_count, file_manager.used_bytes,
+                    count, size))
+                if options['fix']:
+                    SpacesFiles.objects.filter(pk=file_manager.pk).update(
+                        file_count=count, used_bytes=size)
+            if not options['skip_storage']:
+                self.check_storage(storage, file_manager, files)
+        self.stdout.write(self.style.SUCCESS(
+            "Done. %s spaces with wrong counts%s." % (wrong, " (fixed)" if options['fix'] and wrong else "")))
+
+    def check_storage(self, storage, file_manager, files):
+        """
+        Report stored files that are missing or differ in size from the
+        database. Shared stored files are looked at once.
+        """
+        stored = missing = mismatched = 0
+        stored_bytes = 0
+        rows = files.order_by('file').values_list('file', 'size').distinct()
+        seen = None
+        for name, size in rows.iterator():
+            if name == seen:
+                continue
+            seen = name
+            try:
+                actual = storage.size(name)
+            except (IOError, OSError):
+                missing += 1
+                self.stderr.write("%s: missing stored file %s" % (file_manager.space, name))
+                continue
+            stored += 1
+            stored_bytes += actual
+            if size != actual:
+                mismatched += 1
+                self.stderr.write("%s: %s has %s bytes, recorded %s" % (
+                    file_manager.space, name, actual, size))
+        self.stdout.write("%s: %s stored files with %s bytes, %s missing, %s with wrong size." % (
+            file_manager.space, stored, stored_bytes, missing, mismatched))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from spaces_files.aggregates import recompute_aggregates
+from spaces_files.cache import invalidate_tree
+from spaces_files.models import SpacesFiles
+
+
+class Command(BaseCommand):
+    help = "Recompute the file counts and sizes of all folders."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'spaces', nargs='*',
+            help="Slugs of the spaces to repair. Defaults to all spaces."
+        )
+
+    def handle(self, *args, **options):
+        file_managers = SpacesFiles.objects.select_related('space').order_by('pk')
+        if options['spaces']:
+            file_managers = file_managers.filter(space__slug__in=options['spaces'])
+        for file_manager in file_managers:
+            changed = recompute_aggregates(file_manager.pk)
+            if changed:
+                invalidate_tree(file_manager.pk)
+                self.stdout.write("%s: repaired %s folders." % (file_manager.space, changed))
+        self.stdout.write(self.style.SUCCESS("Done."))
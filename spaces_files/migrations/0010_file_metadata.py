@@ -0,0 +1,28 @@
+# Generated by Django 2.2.20 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces_files', '0009_auto_20210503_1145'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='checksum',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, verbose_name='checksum'),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='content_type',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='content type'),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='size',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='size'),
+        ),
+    ]
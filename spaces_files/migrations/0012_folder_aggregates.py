@@ -0,0 +1,46 @@
+# Generated by Django 2.2.20 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+def compute_aggregates(apps, schema_editor):
+    """
+    Fill in the file counts and sizes of existing folders.
+    """
+    from spaces_files.aggregates import recompute_aggregates
+    Folder = apps.get_model("spaces_files", "Folder")
+    File = apps.get_model("spaces_files", "File")
+    file_manager_ids = Folder.objects.values_list('file_manager_id', flat=True).distinct()
+    for file_manager_id in file_manager_ids:
+        recompute_aggregates(file_manager_id, Folder, File)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces_files', '0011_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='file_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='total_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='tree_file_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='tree_total_size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(compute_aggregates, migrations.RunPython.noop),
+    ]
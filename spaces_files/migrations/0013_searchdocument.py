@@ -0,0 +1,65 @@
+# Generated by Django 2.2.20 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+FTS_TABLE = 'spaces_files_search_fts'
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Create the database specific full-text index, see spaces_files.search.
+    """
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    table = quote('spaces_files_searchdocument')
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'ALTER TABLE %s ADD COLUMN search_vector tsvector' % table)
+        schema_editor.execute(
+            'CREATE INDEX spaces_files_search_vector_idx ON %s USING gin (search_vector)' % table)
+    elif connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                # searches fall back to icontains lookups
+                return
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE %s USING fts5(name, description, content, "
+            "tokenize='unicode61 remove_diacritics 2')" % quote(FTS_TABLE))
+        # cascading deletes of files don't send signals for search documents
+        schema_editor.execute(
+            'CREATE TRIGGER spaces_files_search_fts_delete AFTER DELETE ON %s '
+            'BEGIN DELETE FROM %s WHERE rowid = old.file_id; END' % (table, quote(FTS_TABLE)))
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TRIGGER IF EXISTS spaces_files_search_fts_delete')
+        schema_editor.execute('DROP TABLE IF EXISTS %s' % connection.ops.quote_name(FTS_TABLE))
+    # on PostgreSQL the column goes with the table
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces_files', '0012_folder_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='spaces_files.File')),
+                ('content', models.TextField(blank=True)),
+                ('checksum', models.CharField(blank=True, max_length=64)),
+                ('indexed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'search document',
+                'verbose_name_plural': 'search documents',
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
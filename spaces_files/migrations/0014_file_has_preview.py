@@ -0,0 +1,18 @@
+# Generated by Django 2.2.20 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces_files', '0013_searchdocument'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='has_preview',
+            field=models.BooleanField(default=False, editable=False, verbose_name='has preview'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.20 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces_files', '0014_file_has_preview'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['file_manager', 'tree_id', 'lft'], name='spaces_fold_fm_tree_lft_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['parent', 'name'], name='spaces_file_parent_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['file'], name='spaces_file_file_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.20 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces_files', '0015_listing_indexes'),
+    ]
+
+    operations = [
+        # an index rather than db_index, altering the field would make
+        # SQLite rebuild the table and drop the search trigger
+        migrations.AddIndex(
+            model_name='searchdocument',
+            index=models.Index(fields=['checksum'], name='spaces_sear_checksum_idx'),
+        ),
+    ]
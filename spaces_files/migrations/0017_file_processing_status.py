@@ -0,0 +1,23 @@
+# Generated by Django 2.2.20 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces_files', '0016_searchdocument_checksum_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='processing_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('done', 'done'), ('failed', 'failed')], default='done', editable=False, max_length=10, verbose_name='processing status'),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='processing_error',
+            field=models.TextField(blank=True, editable=False, verbose_name='processing error'),
+        ),
+    ]
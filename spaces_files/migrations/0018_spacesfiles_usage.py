@@ -0,0 +1,46 @@
+# Generated by Django 2.2.20 on 2026-10-18 17:00
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def compute_usage(apps, schema_editor):
+    """
+    Fill in the file counts and sizes of existing spaces.
+    """
+    SpacesFiles = apps.get_model("spaces_files", "SpacesFiles")
+    File = apps.get_model("spaces_files", "File")
+    rows = (
+        File.objects.values('parent__file_manager')
+        .annotate(count=Count('id'), size=Sum('size'))
+        .order_by()
+    )
+    for row in rows:
+        SpacesFiles.objects.filter(pk=row['parent__file_manager']).update(
+            file_count=row['count'], used_bytes=row['size'] or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spaces_files', '0017_file_processing_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='spacesfiles',
+            name='file_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='file count'),
+        ),
+        migrations.AddField(
+            model_name='spacesfiles',
+            name='used_bytes',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='used bytes'),
+        ),
+        migrations.AddField(
+            model_name='spacesfiles',
+            name='quota_bytes',
+            field=models.BigIntegerField(blank=True, help_text='Leave empty to use the default quota.', null=True, verbose_name='quota in bytes'),
+        ),
+        migrations.RunPython(compute_usage, migrations.RunPython.noop),
+    ]
@@ -1,17 +1,42 @@
-from os.path import basename
+from os.path import basename, splitext
+import logging
 import time
+import uuid
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.urls import reverse
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import gettext_lazy as _
 
 from mptt.models import MPTTModel, TreeForeignKey
 from private_media.storages import PrivateMediaStorage
 
 from spaces.models import Space,SpacePluginRegistry, SpacePlugin, SpaceModel
 
+from . import aggregates
+from .utils import file_checksum, guess_content_type, lock_stored_file
+
+logger = logging.getLogger(__name__)
+
+# store uploads by content hash, so identical files are only kept once
+DEDUPLICATE_UPLOADS = getattr(settings, 'SPACES_FILES_DEDUPLICATE', False)
+# bytes each space may store unless set for the space, None for no limit
+DEFAULT_QUOTA = getattr(settings, 'SPACES_FILES_DEFAULT_QUOTA', None)
+
+
+def blob_path(checksum, filename):
+    """
+    Storage path of a deduplicated file. The extension is kept, so content
+    types can still be guessed from the name.
+    """
+    extension = splitext(filename)[1].lower()
+    return 'spaces_files/blobs/%s/%s/%s%s' % (
+        checksum[:2], checksum[2:4], checksum, extension)
+
+
 def file_upload_path(instance, filename):
+    if DEDUPLICATE_UPLOADS and instance.checksum:
+        return blob_path(instance.checksum, filename)
     space = instance.parent.file_manager.space.slug
     time_string = time.strftime('%Y/%m/%d')
     return 'spaces_files/%s/%s/%s' % (space, time_string, filename)
@@ -26,7 +51,24 @@ class SpacesFiles(SpacePlugin):
     # active field (boolean) inherited from SpacePlugin
     # space field (foreignkey) inherited from SpacePlugin
     reverse_url = 'spaces_files:index'
-    
+
+    # number and size of all files of the space, maintained by
+    # spaces_files.aggregates
+    file_count = models.PositiveIntegerField(_('file count'), default=0, editable=False)
+    used_bytes = models.BigIntegerField(_('used bytes'), default=0, editable=False)
+    quota_bytes = models.BigIntegerField(
+        _('quota in bytes'), null=True, blank=True,
+        help_text=_('Leave empty to use the default quota.'))
+
+    def get_quota(self):
+        """
+        Return the number of bytes the space may store, or None.
+        """
+        return self.quota_bytes if self.quota_bytes is not None else DEFAULT_QUOTA
+
+    def has_room_for(self, size):
+        quota = self.get_quota()
+        return quota is None or self.used_bytes + size <= quota
 
 
 class Folder(MPTTModel):
@@ -46,25 +88,85 @@ class Folder(MPTTModel):
         on_delete=models.CASCADE)
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    # number and size of contained files, directly and including subfolders.
+    # Maintained by spaces_files.aggregates.
+    file_count = models.PositiveIntegerField(default=0, editable=False)
+    total_size = models.BigIntegerField(default=0, editable=False)
+    tree_file_count = models.PositiveIntegerField(default=0, editable=False)
+    tree_total_size = models.BigIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name = _('folder')
         verbose_name_plural = _('folders')
+        indexes = [
+            # all folders of a space in tree order (spaces_files.tree)
+            models.Index(
+                fields=['file_manager', 'tree_id', 'lft'], name='spaces_fold_fm_tree_lft_idx'),
+        ]
 
     class MPTTMeta:
         order_insertion_by = ['name']
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_parent_id = instance.__dict__.get('parent_id')
+        return instance
+
     def __str__(self):
         return self.name
 
     def get_absolute_url(self):
         return reverse('spaces_files:folder', args=[str(self.id)])
 
+    def save(self, *args, **kwargs):
+        moved = (
+            not self._state.adding
+            and not getattr(self, '_moving', False)
+            and hasattr(self, '_loaded_parent_id')
+            and self.parent_id != self._loaded_parent_id
+        )
+        if moved:
+            with aggregates.moving_folder(self):
+                super().save(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+        self._loaded_parent_id = self.parent_id
+
+    def move_to(self, target, position='first-child'):
+        # mptt saves the node after moving it, which mustn't count as a
+        # second move
+        self._moving = True
+        try:
+            with aggregates.moving_folder(self):
+                super().move_to(target, position)
+        finally:
+            self._moving = False
+        self._loaded_parent_id = self.parent_id
+
+    def delete(self, *args, **kwargs):
+        # the whole branch is deleted, so instead of updating the counts for
+        # every file, the branch's counts are subtracted from its ancestors
+        with transaction.atomic():
+            files, size = aggregates.adjust_ancestors(self.pk, -1)
+            aggregates.adjust_usage(self.file_manager_id, -files, -size)
+            with aggregates.suspend_aggregates():
+                return super().delete(*args, **kwargs)
+
 
 class File(SpaceModel):
     """
     A File. Must be contained in a Folder.
     """
+    PROCESSING_PENDING = 'pending'
+    PROCESSING_DONE = 'done'
+    PROCESSING_FAILED = 'failed'
+    PROCESSING_STATUS_CHOICES = (
+        (PROCESSING_PENDING, _('pending')),
+        (PROCESSING_DONE, _('done')),
+        (PROCESSING_FAILED, _('failed')),
+    )
+
     name = models.CharField(max_length=255, null=True, blank=True)
     description = models.TextField(blank=True, null=True)
     file = models.FileField(upload_to=file_upload_path, storage=PrivateMediaStorage())
@@ -75,6 +177,16 @@ class File(SpaceModel):
         on_delete=models.CASCADE)
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    # metadata of the stored file, set whenever a new file gets saved
+    size = models.BigIntegerField(_('size'), null=True, blank=True, editable=False)
+    content_type = models.CharField(_('content type'), max_length=255, blank=True, editable=False)
+    checksum = models.CharField(_('checksum'), max_length=64, blank=True, editable=False, db_index=True)
+    has_preview = models.BooleanField(_('has preview'), default=False, editable=False)
+    # outcome of spaces_files.pipeline
+    processing_status = models.CharField(
+        _('processing status'), max_length=10, choices=PROCESSING_STATUS_CHOICES,
+        default=PROCESSING_DONE, editable=False)
+    processing_error = models.TextField(_('processing error'), blank=True, editable=False)
 
     spaceplugin_field_name = "parent__file_manager"
 
@@ -82,6 +194,22 @@ class File(SpaceModel):
         verbose_name = _('file')
         verbose_name_plural = _('files')
         ordering = ["name"]
+        indexes = [
+            # the files of a folder by name, also paginated by (name, id)
+            models.Index(fields=['parent', 'name'], name='spaces_file_parent_name_idx'),
+            # files sharing a stored file (deduplication, deletion)
+            models.Index(fields=['file'], name='spaces_file_file_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            'parent_id': instance.__dict__.get('parent_id'),
+            'size': instance.__dict__.get('size'),
+            'file': instance.__dict__.get('file'),
+        }
+        return instance
 
     def __str__(self):
         return self.get_name()
@@ -92,12 +220,158 @@ class File(SpaceModel):
     def get_absolute_url(self):
         return reverse('spaces_files:file', args=[str(self.id)])
 
+    def get_preview_url(self):
+        # the version changes with the content, so the preview can be cached
+        return '%s?v=%s' % (
+            reverse('spaces_files:file_preview', args=[str(self.id)]), self.checksum[:16])
+
     def save(self, **kwargs):
         # if the user doesn't provide a name, copy the filename
         if not self.name:
             self.name = basename(self.file.name)
+        # only new content is processed, see signals.process_file_on_save
+        loaded = getattr(self, '_loaded_values', None)
+        self._content_changed = (
+            loaded is None or not self.file._committed or loaded.get('file') != self.file.name)
+        # a new upload that hasn't been written to storage yet
+        if self.file and not self.file._committed:
+            # deduplicated uploads are stored under their checksum, others
+            # are hashed after the upload (see spaces_files.pipeline)
+            self.update_file_metadata(checksum=DEDUPLICATE_UPLOADS)
+            # the preview belongs to the stored file, see spaces_files.previews
+            self.has_preview = False
+            self.processing_status = self.PROCESSING_PENDING
+            self.processing_error = ''
+            if DEDUPLICATE_UPLOADS:
+                content = self.file.file
+                with transaction.atomic():
+                    reused = self.reuse_stored_blob()
+                    super().save(**kwargs)
+                if reused:
+                    transaction.on_commit(lambda: self.restore_stored_blob(content))
+                return
         super().save(**kwargs)
 
+    def reuse_stored_blob(self):
+        """
+        If a file with the same content is stored already, point to it
+        instead of storing another copy. Returns whether it did.
+
+        The stored file is locked until the transaction ends, so it isn't
+        removed along with the last other File using it in the meantime
+        (see spaces_files.deletion).
+        """
+        name = blob_path(self.checksum, self.file.name)
+        lock_stored_file(name)
+        if self.file.storage.exists(name):
+            self.file.name = name
+            self.file._committed = True
+            return True
+        return False
+
+    def restore_stored_blob(self, content):
+        """
+        Store the uploaded `content` again if the stored file this File
+        reused has been removed before the File was committed. Without
+        database locks, removal can't wait for the upload.
+        """
+        storage = self.file.storage
+        if storage.exists(self.file.name):
+            return
+        try:
+            content.seek(0)
+        except ValueError:
+            logger.error('Stored file %s of File %s was removed, the upload is gone',
+                         self.file.name, self.pk)
+            return
+        saved = storage.save(self.file.name, content)
+        if saved != self.file.name:
+            # restored by another upload meanwhile
+            storage.delete(saved)
+
+    def is_shared(self):
+        """
+        Whether other File rows reference the same stored file, e.g. because
+        of deduplication or copies.
+        """
+        return File.objects.filter(file=self.file.name).exclude(pk=self.pk).exists()
+
+    def update_file_metadata(self, checksum=True):
+        """
+        Set size, content type and, unless `checksum` is False, checksum
+        from the file's content. Doesn't save the instance.
+        """
+        self.size = self.file.size
+        self.content_type = guess_content_type(
+            self.file.name,
+            getattr(self.file.file, 'content_type', None) or 'application/octet-stream'
+        )
+        # chunked uploads are hashed while they are assembled
+        self.checksum = getattr(self.file.file, 'checksum', None) or (
+            file_checksum(self.file) if checksum else '')
+
+
+class SearchDocument(models.Model):
+    """
+    Text extracted from a file's content for the full-text search (see
+    spaces_files.search). The database specific index columns and tables are
+    created by migration 0013.
+    """
+    file = models.OneToOneField(
+        File,
+        primary_key=True,
+        related_name='search_document',
+        on_delete=models.CASCADE)
+    content = models.TextField(blank=True)
+    # checksum of the content the text was extracted from
+    checksum = models.CharField(max_length=64, blank=True)
+    indexed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _('search document')
+        verbose_name_plural = _('search documents')
+        indexes = [
+            # text of files with the same content is only extracted once
+            models.Index(fields=['checksum'], name='spaces_sear_checksum_idx'),
+        ]
+
+    def __str__(self):
+        return str(self.file)
+
+
+class UploadSession(models.Model):
+    """
+    A chunked upload in progress. The chunks are kept in a temporary
+    directory (see spaces_files.uploads) until the upload is finalized into
+    a File.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    parent = TreeForeignKey(
+        Folder,
+        verbose_name=_('parent folder'),
+        on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, blank=True)
+    description = models.TextField(blank=True)
+    size = models.BigIntegerField()
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('upload session')
+        verbose_name_plural = _('upload sessions')
+
+    def __str__(self):
+        return self.filename
+
+    def get_absolute_url(self):
+        return reverse('spaces_files:upload_session', args=[str(self.pk)])
+
+    def delete(self, **kwargs):
+        from .uploads import discard
+        discard(self)
+        return super().delete(**kwargs)
+
 
 class FilesPlugin(SpacePluginRegistry):
     """
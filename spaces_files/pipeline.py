@@ -0,0 +1,193 @@
+"""
+Processing of files after upload.
+
+Whenever a File is saved, `process_file` runs in the background (see
+spaces_files.tasks) once the transaction has been committed. It runs the
+registered stages in order:
+
+* `metadata` computes the checksum of uploads that weren't hashed while
+  uploading (only deduplicated and chunked uploads are).
+* `search` extracts the text and updates the search index.
+* `preview` renders the thumbnail of images and PDF files.
+* `activity` announces a new upload in the activity stream and sends the
+  notifications chosen in the upload form, if the upload view asked for it.
+
+More stages are added with `register_stage`. SPACES_FILES_PIPELINE_STAGES
+lists the names of the stages to run, default all registered ones. Uploads
+are announced even if `activity` isn't listed: the upload views used to do
+it themselves.
+
+A stage is a function taking the File and a dict of options. It should
+skip work that is already done, as a file is processed again after every
+change. A failing stage is retried `retries` times, waiting `retry_delay`
+seconds more before every attempt; if it still fails, the remaining stages
+run nonetheless and the file's `processing_status` becomes 'failed', with
+the errors in `processing_error`.
+
+`process_file` takes only the file id and a dict of simple values, so task
+backends for external workers can serialize it.
+"""
+from collections import OrderedDict
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.http import QueryDict
+from django.utils import translation
+from django.utils.translation import gettext as _
+
+from .cache import invalidate_tree
+from .models import File
+from .tasks import run_task
+from .utils import file_checksum
+
+logger = logging.getLogger(__name__)
+
+_stages = OrderedDict()
+
+
+class Stage(object):
+    """
+    A named processing step with its retry policy.
+    """
+    def __init__(self, name, func, retries=0, retry_delay=1.0):
+        self.name = name
+        self.func = func
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def run(self, file, options):
+        """
+        Run the stage, retrying on errors. Raises the last error.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.func(file, options)
+            except Exception:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                logger.warning('Stage %s failed for file %s, retrying (%d/%d)',
+                               self.name, file.pk, attempt, self.retries, exc_info=True)
+                time.sleep(self.retry_delay * attempt)
+
+
+def register_stage(name, retries=0, retry_delay=1.0):
+    """
+    Decorator registering `func(file, options)` as the stage `name`. Stages
+    run in the order they are registered in.
+    """
+    def decorator(func):
+        _stages[name] = Stage(name, func, retries, retry_delay)
+        return func
+    return decorator
+
+
+def get_stages():
+    names = getattr(settings, 'SPACES_FILES_PIPELINE_STAGES', None)
+    if names is None:
+        return list(_stages.values())
+    return [_stages[name] for name in names]
+
+
+def process_file(file_id, options=None):
+    """
+    Run all stages for a file and record the outcome on it.
+    """
+    options = options or {}
+    file = File.objects.select_related('parent__file_manager__space').filter(pk=file_id).first()
+    if file is None:
+        return
+    stages = get_stages()
+    if options.get('announce') and 'activity' not in [stage.name for stage in stages]:
+        stages.append(_stages['activity'])
+    errors = []
+    for stage in stages:
+        try:
+            stage.run(file, options)
+        except Exception as e:
+            logger.exception('Stage %s failed for file %s', stage.name, file_id)
+            errors.append('%s: %s' % (stage.name, e))
+    File.objects.filter(pk=file_id).update(
+        processing_status=File.PROCESSING_FAILED if errors else File.PROCESSING_DONE,
+        processing_error='\n'.join(errors)
+    )
+
+
+def schedule_processing(file_id, options=None):
+    """
+    Process a file in the background once the current transaction has been
+    committed.
+    """
+    transaction.on_commit(lambda: run_task(process_file, file_id, options or {}))
+
+
+def announce_upload(file, request):
+    """
+    Make the processing of `file`, which is about to be saved, announce it
+    like the upload view would: as the request's user, in the request's
+    language, with the notifications chosen in the posted form. Only the
+    fields of the notification formset are passed on to the task.
+    """
+    from spaces_notifications.forms import NotificationFormSet
+    prefix = NotificationFormSet.get_default_prefix() + '-'
+    file._processing_options = {
+        'announce': True,
+        'language': translation.get_language(),
+        'notifications': [
+            (key, values) for key, values in request.POST.lists() if key.startswith(prefix)
+        ],
+    }
+
+
+@register_stage('metadata', retries=2)
+def update_checksum(file, options):
+    if file.checksum:
+        return
+    with file.file.storage.open(file.file.name, 'rb') as stored:
+        file.checksum = file_checksum(stored)
+    File.objects.filter(pk=file.pk).update(checksum=file.checksum)
+    # cached trees build versioned preview URLs from the checksum
+    invalidate_tree(file.parent.file_manager_id)
+
+
+@register_stage('search', retries=2)
+def update_search_index(file, options):
+    from .search import index_file
+    index_file(file.pk)
+
+
+@register_stage('preview', retries=1)
+def update_preview(file, options):
+    from .previews import can_preview, generate_preview
+    if not file.has_preview and can_preview(file.content_type):
+        generate_preview(file.pk, fail_silently=False)
+
+
+@register_stage('activity')
+def announce(file, options):
+    if not options.get('announce'):
+        return
+    from actstream.signals import action as actstream_action
+    from spaces_notifications.forms import NotificationFormSet
+    from spaces_notifications.mixins import process_n12n_formset
+    space = file.parent.file_manager.space
+    data = QueryDict(mutable=True)
+    for key, values in options.get('notifications', ()):
+        data.setlist(key, values)
+    with translation.override(options.get('language')):
+        actstream_action.send(
+            sender=file.created_by,
+            verb=_("was created"),
+            target=space,
+            action_object=file
+        )
+        process_n12n_formset(
+            NotificationFormSet(space, data),
+            'spaces_files_file_create',
+            space,
+            file,
+            file.get_absolute_url()
+        )
@@ -0,0 +1,144 @@
+"""
+Preview images of files.
+
+Thumbnails of images (with Pillow) and of the first page of PDF files (with
+Pillow and poppler's `pdftoppm`) are rendered in the background after upload
+(see spaces_files.pipeline) and stored as JPEG files through the file's storage,
+in a `thumbs` directory next to the original. Requests only ever read the
+stored thumbnail; a missing one is rendered again in the background.
+
+SPACES_FILES_PREVIEW_SIZE sets the maximum (width, height), default
+(256, 256), SPACES_FILES_PREVIEW_MAX_AGE how long browsers may cache previews.
+"""
+import io
+import logging
+import os
+import posixpath
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from .cache import invalidate_tree
+from .tasks import run_task
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_SIZE = tuple(getattr(settings, 'SPACES_FILES_PREVIEW_SIZE', (256, 256)))
+# preview URLs change with the content, so browsers may keep them for long
+PREVIEW_MAX_AGE = getattr(settings, 'SPACES_FILES_PREVIEW_MAX_AGE', 365 * 24 * 60 * 60)
+PDFTOPPM = getattr(settings, 'SPACES_FILES_PDFTOPPM', shutil.which('pdftoppm'))
+# seconds until rendering a PDF page is given up
+PDF_RENDER_TIMEOUT = 60
+
+# formats Pillow can't read or that don't make useful thumbnails
+SKIPPED_IMAGE_TYPES = ('image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+
+
+def can_preview(content_type):
+    if Image is None or not content_type:
+        return False
+    if content_type == 'application/pdf':
+        return bool(PDFTOPPM)
+    return content_type.startswith('image/') and content_type not in SKIPPED_IMAGE_TYPES
+
+
+def preview_name(name):
+    """
+    Storage name of the preview of the stored file `name`.
+    """
+    directory, filename = posixpath.split(name)
+    return posixpath.join(directory, 'thumbs', filename + '.jpg')
+
+
+def _render_pdf_page(source):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'input.pdf')
+        with open(path, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        subprocess.run(
+            [PDFTOPPM, '-png', '-f', '1', '-l', '1', '-singlefile',
+             '-scale-to', str(max(PREVIEW_SIZE)), path, os.path.join(directory, 'page')],
+            check=True, timeout=PDF_RENDER_TIMEOUT,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        image = Image.open(os.path.join(directory, 'page.png'))
+        image.load()
+        return image
+
+
+def render_preview(file):
+    """
+    Return the JPEG encoded preview of a File.
+    """
+    with file.file.storage.open(file.file.name, 'rb') as source:
+        if file.content_type == 'application/pdf':
+            image = _render_pdf_page(source)
+        else:
+            image = Image.open(source)
+            # let the JPEG decoder scale down while decoding
+            image.draft('RGB', PREVIEW_SIZE)
+            image.thumbnail(PREVIEW_SIZE)
+    image.thumbnail(PREVIEW_SIZE)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=85, optimize=True)
+    return output.getvalue()
+
+
+def generate_preview(file_id, fail_silently=True):
+    """
+    Render and store the preview of a file unless it exists, and mark all
+    files sharing the stored file as having a preview. Errors while
+    rendering are logged, or raised if `fail_silently` is False.
+    """
+    from .models import File
+    file = File.objects.filter(pk=file_id).first()
+    if file is None or not can_preview(file.content_type):
+        return
+    storage = file.file.storage
+    name = preview_name(file.file.name)
+    if not storage.exists(name):
+        try:
+            data = render_preview(file)
+        except Exception:
+            if not fail_silently:
+                raise
+            logger.warning('Could not render preview of %s', file.file.name, exc_info=True)
+            return
+        saved = storage.save(name, ContentFile(data))
+        if saved != name:
+            # rendered by someone else in the meantime
+            storage.delete(saved)
+    files = File.objects.filter(file=file.file.name, has_preview=False)
+    file_manager_ids = set(files.values_list('parent__file_manager_id', flat=True))
+    if files.update(has_preview=True):
+        for file_manager_id in file_manager_ids:
+            invalidate_tree(file_manager_id)
+
+
+def open_preview(file):
+    """
+    Return the stored preview of a file opened for reading, or None if it's
+    missing. Missing previews are rendered again in the background.
+    """
+    if not file.has_preview:
+        return None
+    try:
+        return file.file.storage.open(preview_name(file.file.name), 'rb')
+    except (IOError, OSError):
+        run_task(generate_preview, file.pk)
+        return None
@@ -0,0 +1,189 @@
+"""
+Full-text search over file names, descriptions and content.
+
+The text of every file is extracted in the background (see
+spaces_files.extract and spaces_files.pipeline) into a SearchDocument. How it is
+indexed depends on the database:
+
+* PostgreSQL: a weighted `tsvector` column on the search documents with a GIN
+  index, ranked with `ts_rank`. SPACES_FILES_SEARCH_CONFIG selects the text
+  search configuration (default 'simple').
+* SQLite: an FTS5 table, ranked with `bm25`.
+* Other databases, or SQLite without FTS5: `icontains` lookups.
+
+The tables and columns are created by migration 0013.
+"""
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .extract import extract_text
+from .models import File, Folder, SearchDocument
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'spaces_files_search_fts'
+SEARCH_CONFIG = getattr(settings, 'SPACES_FILES_SEARCH_CONFIG', 'simple')
+# maximum number of search results
+SEARCH_RESULTS = getattr(settings, 'SPACES_FILES_SEARCH_RESULTS', 50)
+
+
+def _tables():
+    quote = connection.ops.quote_name
+    return {
+        'document': quote(SearchDocument._meta.db_table),
+        'file': quote(File._meta.db_table),
+        'folder': quote(Folder._meta.db_table),
+        'fts': quote(FTS_TABLE),
+    }
+
+
+def _in_order(ids):
+    files = File.objects.in_bulk(ids)
+    return [files[pk] for pk in ids if pk in files]
+
+
+class FallbackBackend(object):
+    """
+    Search with `icontains` lookups, for databases without full-text search.
+    """
+    def update(self, file, document):
+        pass
+
+    def search(self, file_manager_id, terms, limit):
+        files = File.objects.filter(parent__file_manager_id=file_manager_id)
+        for term in terms:
+            files = files.filter(
+                Q(name__icontains=term)
+                | Q(description__icontains=term)
+                | Q(search_document__content__icontains=term)
+            )
+        return list(files.order_by('name')[:limit])
+
+
+class PostgresBackend(object):
+    """
+    Search a weighted tsvector column with a GIN index.
+    """
+    def update(self, file, document):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {document} SET search_vector = "
+                "setweight(to_tsvector(%s::regconfig, %s), 'A') || "
+                "setweight(to_tsvector(%s::regconfig, %s), 'B') || "
+                "setweight(to_tsvector(%s::regconfig, content), 'C') "
+                "WHERE file_id = %s".format(**_tables()),
+                [SEARCH_CONFIG, file.name or '', SEARCH_CONFIG, file.description or '',
+                 SEARCH_CONFIG, file.pk]
+            )
+
+    def search(self, file_manager_id, terms, limit):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT d.file_id FROM {document} d "
+                "JOIN {file} f ON f.id = d.file_id "
+                "JOIN {folder} p ON p.id = f.parent_id, "
+                "plainto_tsquery(%s::regconfig, %s) query "
+                "WHERE p.file_manager_id = %s AND d.search_vector @@ query "
+                "ORDER BY ts_rank(d.search_vector, query) DESC, f.name "
+                "LIMIT %s".format(**_tables()),
+                [SEARCH_CONFIG, ' '.join(terms), file_manager_id, limit]
+            )
+            return _in_order([row[0] for row in cursor.fetchall()])
+
+
+class SQLiteBackend(object):
+    """
+    Search an FTS5 table whose rowids are file ids.
+    """
+    def update(self, file, document):
+        tables = _tables()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM {fts} WHERE rowid = %s".format(**tables), [file.pk])
+            cursor.execute(
+                "INSERT INTO {fts} (rowid, name, description, content) "
+                "VALUES (%s, %s, %s, %s)".format(**tables),
+                [file.pk, file.name or '', file.description or '', document.content]
+            )
+
+    def search(self, file_manager_id, terms, limit):
+        # match every term as a quoted prefix, so the query can't contain
+        # FTS5 syntax
+        query = ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT {fts}.rowid FROM {fts} "
+                "JOIN {file} f ON f.id = {fts}.rowid "
+                "JOIN {folder} p ON p.id = f.parent_id "
+                "WHERE {fts} MATCH %s AND p.file_manager_id = %s "
+                "ORDER BY bm25({fts}, 10.0, 5.0, 1.0), f.name "
+                "LIMIT %s".format(**_tables()),
+                [query, file_manager_id, limit]
+            )
+            return _in_order([row[0] for row in cursor.fetchall()])
+
+
+_backends = {}
+
+
+def get_search_backend():
+    """
+    Return the search backend for the default database.
+    """
+    vendor = connection.vendor
+    if vendor not in _backends:
+        if vendor == 'postgresql':
+            _backends[vendor] = PostgresBackend()
+        elif vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names():
+            _backends[vendor] = SQLiteBackend()
+        else:
+            _backends[vendor] = FallbackBackend()
+    return _backends[vendor]
+
+
+def index_file(file_id):
+    """
+    Extract the text of a file, unless its content didn't change since it
+    was last indexed or another file with the same content was indexed, and
+    update the search index.
+    """
+    file = File.objects.filter(pk=file_id).first()
+    if file is None:
+        return
+    try:
+        document = file.search_document
+    except SearchDocument.DoesNotExist:
+        document = SearchDocument(file=file)
+    if document._state.adding or not file.checksum or document.checksum != file.checksum:
+        # copies and deduplicated uploads share their content with other files
+        same_content = None
+        if file.checksum:
+            same_content = SearchDocument.objects.filter(
+                checksum=file.checksum).exclude(file=file).values_list('content', flat=True).first()
+        document.content = same_content if same_content is not None else extract_text(file)
+        document.checksum = file.checksum
+    with transaction.atomic():
+        document.save()
+        get_search_backend().update(file, document)
+
+
+def index_files(file_ids):
+    """
+    Index several files, e.g. copies of files already indexed.
+    """
+    for file_id in file_ids:
+        index_file(file_id)
+
+
+def search_files(files_plugin, query, limit=SEARCH_RESULTS):
+    """
+    Return the files of a space's file manager matching all words of
+    `query`, best matches first.
+    """
+    terms = query.split()
+    if files_plugin is None or not terms:
+        return []
+    return get_search_backend().search(files_plugin.pk, terms, limit)
@@ -1,13 +1,120 @@
 #-*- coding: utf-8 -*-
 import mimetypes
 import os
+import re
 import stat
+import time
+from urllib.parse import quote
+
+import django
 from django.conf import settings
-from django.http import (Http404, HttpResponse, HttpResponseBadRequest, 
-    HttpResponseNotModified)
-from django.utils.http import http_date
+from django.core.exceptions import ImproperlyConfigured, SuspiciousFileOperation
+from django.http import (FileResponse, Http404, HttpResponse,
+    HttpResponseBadRequest, HttpResponseNotModified, StreamingHttpResponse)
+from django.utils._os import safe_join
+from django.utils.module_loading import import_string
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
 from django.views.static import was_modified_since
 
+from .instrumentation import instrument, record_storage_call
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+# size of the blocks read from disk and sent to the client
+SERVE_CHUNK_SIZE = getattr(settings, 'SPACES_FILES_SERVE_CHUNK_SIZE', 64 * 1024)
+
+# Cache-Control max-age in seconds by content type, e.g.
+# {'image/*': 3600, 'application/pdf': 600, '*': 0}. Responses are always
+# private, with max-age=0 browsers revalidate with If-None-Match.
+CACHE_MAX_AGE = getattr(settings, 'SPACES_FILES_CACHE_MAX_AGE', {'*': 0})
+
+RANGE_RE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', re.I)
+
+
+def parse_range_header(header, size):
+    """
+    Parse a single-range `Range` header for a file of the given size.
+
+    Returns an inclusive (start, end) tuple, None if the header should be
+    ignored (missing, malformed or asking for multiple ranges) and raises
+    ValueError if the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header or '')
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # suffix range: the last n bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        if size == 0:
+            raise ValueError('Suffix range of an empty file')
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = int(end) if end else size - 1
+    if end < start:
+        return None
+    if start >= size:
+        raise ValueError('Range starts beyond end of file')
+    return start, min(end, size - 1)
+
+
+def get_max_age(content_type):
+    """
+    Return the max-age configured for a content type, looking up the exact
+    type, then `major/*`, then `*`.
+    """
+    major = content_type.split('/')[0]
+    for key in (content_type, major + '/*', '*'):
+        if key in CACHE_MAX_AGE:
+            return CACHE_MAX_AGE[key]
+    return 0
+
+
+def etag_matches(etag, header):
+    """
+    Whether an `If-None-Match` header matches `etag` (weak comparison, as
+    RFC 7232 requires for If-None-Match).
+    """
+    if header.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    return any(
+        (tag[2:] if tag.startswith('W/') else tag) == opaque
+        for tag in parse_etags(header)
+    )
+
+
+class RangeFileWrapper(object):
+    """
+    Iterate over `length` bytes of a file starting at `start`, in blocks of
+    `chunk_size` bytes. Closes the file when the response is closed.
+    """
+    def __init__(self, filelike, start, length, chunk_size=SERVE_CHUNK_SIZE):
+        self.filelike = filelike
+        self.start = start
+        self.remaining = length
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        self.filelike.seek(self.start)
+        while self.remaining > 0:
+            data = self.filelike.read(min(self.chunk_size, self.remaining))
+            if not data:
+                break
+            self.remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.filelike.close()
+
+
 class DefaultServer(object):
     """
     Serve static files from the local filesystem through django.
@@ -16,24 +123,240 @@ class DefaultServer(object):
     This will only work for files that can be accessed in the local filesystem.
 
     Mostly identical to the server from django_private_media, but this one ensures
-    the file in question is indeed a file, not a directory.
+    the file in question is indeed a file, not a directory. Files are streamed
+    in chunks and single byte ranges are supported, so memory usage doesn't
+    depend on the file size and media players can seek. Responses carry a
+    strong ETag and a private Cache-Control header, so clients revalidate
+    with If-None-Match and get a 304 for unchanged files.
     """
-    def serve(self, request, path):
+    chunk_size = SERVE_CHUNK_SIZE
+
+    def get_checksum(self, path):
+        """
+        Return the content checksum stored for the file `path`, if any.
+        """
+        from .models import File
+        return File.objects.filter(file=path).exclude(checksum='').values_list(
+            'checksum', flat=True).first()
+
+    def get_etag(self, path, statobj, checksum=None):
+        """
+        Return a strong ETag: the stored content checksum or, for files
+        without one, inode, size and modification time in nanoseconds.
+        """
+        if checksum is None:
+            checksum = self.get_checksum(path)
+        if checksum:
+            return '"%s"' % checksum
+        return '"%x-%x-%x"' % (statobj.st_ino, statobj.st_size, statobj.st_mtime_ns)
+
+    def set_cache_headers(self, response, statobj, etag, content_type):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(statobj[stat.ST_MTIME])
+        response['Cache-Control'] = 'private, max-age=%d' % get_max_age(content_type)
+
+    def not_modified(self, request, statobj, etag):
+        """
+        Whether the client's copy is current. If-None-Match takes precedence
+        over If-Modified-Since.
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            return request.method in ('GET', 'HEAD') and etag_matches(etag, if_none_match)
+        return not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                      statobj[stat.ST_MTIME], statobj[stat.ST_SIZE])
+
+    @instrument('serve')
+    def serve(self, request, path, checksum=None):
+        """
+        Serve the file `path`. `checksum` is the known content checksum, if
+        given ('' for none) it isn't looked up.
+        """
         # the following code is largely borrowed from `django.views.static.serve`
         # and django-filetransfers: filetransfers.backends.default
-        fullpath = os.path.join(settings.PRIVATE_MEDIA_ROOT, path)
-        if not os.path.exists(fullpath):
+        try:
+            fullpath = safe_join(settings.PRIVATE_MEDIA_ROOT, path)
+        except SuspiciousFileOperation:
+            raise Http404('"{0}" is outside of the private media root'.format(path))
+        start = time.perf_counter()
+        try:
+            statobj = os.stat(fullpath)
+        except (IOError, OSError):
             raise Http404('"{0}" does not exist'.format(fullpath))
-        # Respect the If-Modified-Since header.
-        statobj = os.stat(fullpath)
-        content_type = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
-        if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
-                                  statobj[stat.ST_MTIME], statobj[stat.ST_SIZE]):
-            return HttpResponseNotModified(content_type=content_type)
-        if not os.path.isfile(fullpath):
+        finally:
+            record_storage_call('stat', time.perf_counter() - start)
+        if not stat.S_ISREG(statobj.st_mode):
             return HttpResponseBadRequest()
-        response = HttpResponse(open(fullpath, 'rb').read(), content_type=content_type)
-        response["Last-Modified"] = http_date(statobj[stat.ST_MTIME])
+        content_type = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+        etag = self.get_etag(path, statobj, checksum)
+        # Respect the If-None-Match and If-Modified-Since headers.
+        if self.not_modified(request, statobj, etag):
+            response = HttpResponseNotModified()
+        else:
+            response = self.send_file(request, path, fullpath, statobj, content_type, etag)
+        if response.status_code in (200, 206, 304):
+            self.set_cache_headers(response, statobj, etag, content_type)
         # filename = os.path.basename(path)
         # response['Content-Disposition'] = smart_str(u'attachment; filename={0}'.format(filename))
-        return response
\ No newline at end of file
+        return response
+
+    def send_file(self, request, path, fullpath, statobj, content_type, etag):
+        """
+        Return the response for an existing file that passed all checks.
+        """
+        size = statobj[stat.ST_SIZE]
+        try:
+            byte_range = self.get_range(request, statobj, etag)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        if byte_range is None:
+            response = self.full_response(fullpath, size, content_type)
+            response['Content-Length'] = size
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                self.file_content(fullpath, start, end - start + 1),
+                status=206,
+                content_type=content_type
+            )
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            response['Content-Length'] = end - start + 1
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    def full_response(self, fullpath, size, content_type):
+        response = FileResponse(open(fullpath, 'rb'), content_type=content_type)
+        response.block_size = self.chunk_size
+        return response
+
+    def file_content(self, fullpath, start, length):
+        """
+        Return the response content for `length` bytes starting at `start`.
+        """
+        return RangeFileWrapper(open(fullpath, 'rb'), start, length, self.chunk_size)
+
+    def get_range(self, request, statobj, etag):
+        """
+        Return the requested (start, end) byte range or None if the whole
+        file should be sent. Raises ValueError for unsatisfiable ranges.
+        """
+        header = request.META.get('HTTP_RANGE')
+        if not header:
+            return None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range:
+            # only send a part if the client's copy is still current
+            if if_range.strip().startswith(('"', 'W/')):
+                if etag not in parse_etags(if_range):
+                    return None
+            elif parse_http_date_safe(if_range) != int(statobj[stat.ST_MTIME]):
+                return None
+        return parse_range_header(header, statobj[stat.ST_SIZE])
+
+
+class AsyncFileIterator(object):
+    """
+    Like RangeFileWrapper, but an asynchronous iterator: every block is read
+    in a thread, so disk reads don't block the event loop. Closes the file
+    once the content has been sent.
+    """
+    def __init__(self, filelike, start, length, chunk_size=SERVE_CHUNK_SIZE):
+        self.filelike = filelike
+        self.start = start
+        self.remaining = length
+        self.chunk_size = chunk_size
+
+    def __aiter__(self):
+        return self.chunks()
+
+    async def chunks(self):
+        # file access doesn't need to run in the thread of the ORM
+        read = sync_to_async(self.filelike.read, thread_sensitive=False)
+        try:
+            await sync_to_async(self.filelike.seek, thread_sensitive=False)(self.start)
+            while self.remaining > 0:
+                data = await read(min(self.chunk_size, self.remaining))
+                if not data:
+                    break
+                self.remaining -= len(data)
+                yield data
+        finally:
+            self.filelike.close()
+
+    def close(self):
+        self.filelike.close()
+
+
+class AsyncDefaultServer(DefaultServer):
+    """
+    DefaultServer for asynchronous views: `serve` is a coroutine, the checks
+    run in a thread since they may query the database. Full and partial
+    responses are sent by an AsyncFileIterator, so neither a thread nor the
+    event loop is held while a slow client downloads.
+
+    Needs Django 4.2 or later, which sends asynchronous iterators without
+    buffering them. Use it with `spaces_files.views.serve_private_file_async`;
+    it can't be the PRIVATE_MEDIA_SERVER of synchronous views.
+    """
+    async def serve(self, request, path, checksum=None):
+        if django.VERSION < (4, 2):
+            raise ImproperlyConfigured('AsyncDefaultServer needs Django 4.2 or later.')
+        return await sync_to_async(super().serve)(request, path, checksum)
+
+    def full_response(self, fullpath, size, content_type):
+        return StreamingHttpResponse(
+            self.file_content(fullpath, 0, size), content_type=content_type)
+
+    def file_content(self, fullpath, start, length):
+        return AsyncFileIterator(open(fullpath, 'rb'), start, length, self.chunk_size)
+
+
+def get_media_server():
+    """
+    Return an instance of the server class set in PRIVATE_MEDIA_SERVER.
+    """
+    server_class = import_string(getattr(
+        settings, 'PRIVATE_MEDIA_SERVER', 'spaces_files.servers.DefaultServer'))
+    return server_class(**getattr(settings, 'PRIVATE_MEDIA_SERVER_OPTIONS', {}))
+
+
+class XSendfileServer(DefaultServer):
+    """
+    Let the web server send the file: Apache (mod_xsendfile) and lighttpd
+    read the file given in the `X-Sendfile` header.
+
+    Django only runs the permission and file checks and returns an empty
+    response, so no worker is kept busy during the transfer. Ranges and
+    caching are up to the web server.
+    """
+    header = 'X-Sendfile'
+
+    def get_location(self, path, fullpath):
+        return fullpath
+
+    def send_file(self, request, path, fullpath, statobj, content_type, etag):
+        response = HttpResponse(content_type=content_type)
+        response[self.header] = self.get_location(path, fullpath)
+        return response
+
+
+class NginxXAccelRedirectServer(XSendfileServer):
+    """
+    Let nginx send the file. nginx expects an URI in an internal location
+    that maps to PRIVATE_MEDIA_ROOT, e.g.
+
+        location /private-media-internal/ {
+            internal;
+            alias /path/to/private_media/;
+        }
+
+    The location is configured by SPACES_FILES_SENDFILE_PREFIX.
+    """
+    header = 'X-Accel-Redirect'
+
+    def get_location(self, path, fullpath):
+        prefix = getattr(settings, 'SPACES_FILES_SENDFILE_PREFIX', '/private-media-internal/')
+        relative = os.path.relpath(fullpath, os.path.abspath(settings.PRIVATE_MEDIA_ROOT))
+        return prefix.rstrip('/') + '/' + quote(relative.replace(os.sep, '/'), safe='/')
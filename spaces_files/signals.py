@@ -1,9 +1,13 @@
-import os
+import threading
+
 from django.conf import settings
 from django.db import models
 #from django.dispatch import receiver
-from django.utils.translation import ugettext_noop as _
+from django.utils.translation import gettext_noop as _
 #from .models import File
+from . import aggregates
+from .cache import invalidate_tree
+from .deletion import schedule_file_deletion
 
 # These two auto-delete files from filesystem when they are unneeded:
 #@receiver(models.signals.post_delete, sender=File)
@@ -11,12 +15,81 @@ def auto_delete_file_on_delete(sender, instance, **kwargs):
     """
     Deletes file from filesystem
     when corresponding `File` object is deleted.
+
+    Stored files can be shared by several `File` objects, so the file is only
+    removed with the last object referencing it. Removal happens in the
+    background after the transaction has been committed.
     """
     if instance.file:
-        if os.path.isfile(instance.file.path):
-            os.remove(instance.file.path)
+        schedule_file_deletion(instance.file.name)
+
+
+
+# folders being deleted by the current thread, see invalidate_tree_on_file_change
+_deleting = threading.local()
+
+
+def invalidate_tree_on_folder_change(sender, instance, **kwargs):
+    """
+    Invalidate the cached tree when a folder is saved, moved or deleted.
+    """
+    invalidate_tree(instance.file_manager_id)
+
+
+def mark_folder_deleting(sender, instance, **kwargs):
+    if not hasattr(_deleting, 'folders'):
+        _deleting.folders = set()
+    _deleting.folders.add(instance.pk)
+
+
+def invalidate_tree_on_folder_delete(sender, instance, **kwargs):
+    getattr(_deleting, 'folders', set()).discard(instance.pk)
+    invalidate_tree(instance.file_manager_id)
 
 
+def invalidate_tree_on_file_change(sender, instance, **kwargs):
+    """
+    Invalidate the cached tree when a file is saved or deleted.
+    """
+    # files deleted along with their folder are taken care of by the folder,
+    # this saves looking up the file manager for every file
+    if instance.parent_id in getattr(_deleting, 'folders', ()):
+        return
+    parent_field = sender._meta.get_field('parent')
+    if parent_field.is_cached(instance):
+        file_manager_id = instance.parent.file_manager_id
+    else:
+        file_manager_id = parent_field.related_model.objects.filter(
+            pk=instance.parent_id).values_list('file_manager_id', flat=True).first()
+    invalidate_tree(file_manager_id)
+
+
+def invalidate_tree_on_file_manager_change(sender, instance, **kwargs):
+    invalidate_tree(instance.pk)
+
+
+def update_aggregates_on_file_save(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        aggregates.file_saved(instance, created)
+
+
+def update_aggregates_on_file_delete(sender, instance, **kwargs):
+    aggregates.file_deleted(instance)
+
+
+def process_file_on_save(sender, instance, raw=False, **kwargs):
+    """
+    Run the processing stages (search index, preview, ...) in the
+    background, see spaces_files.pipeline. Only new files and files whose
+    stored file changed are processed, not renames or moves.
+    """
+    if raw:
+        return
+    options = instance.__dict__.pop('_processing_options', None)
+    if instance.__dict__.pop('_content_changed', True) or options:
+        from .pipeline import schedule_processing
+        schedule_processing(instance.pk, options)
+
 
 def create_notice_types(sender, **kwargs):
     if "pinax.notifications" in settings.INSTALLED_APPS:
@@ -0,0 +1,20 @@
+"""
+URLs of signed downloads, see spaces_files.signing. They don't belong to a
+space, include them in the root URLconf:
+
+    re_path(r'^signed-media/', include('spaces_files.signed_urls')),
+"""
+from django.urls import re_path
+
+from . import views
+
+app_name = 'spaces_files_signed'
+urlpatterns = (
+
+    re_path(
+        r'^(\d+)/(.+)$',
+        views.signed_download,
+        name='download'
+    ),
+
+)
@@ -0,0 +1,95 @@
+"""
+Signed, time-limited download URLs.
+
+A signed URL carries the file id, the stored file name, the user it was
+issued to, its expiry and the content checksum, together with an HMAC over
+all of them (keyed with SECRET_KEY). `spaces_files.views.signed_download`
+checks the signature and the logged in user and serves the file without
+looking it up, so range requests and repeated downloads don't repeat the
+permission checks.
+
+A signed URL only works for the user it was issued to, leaked URLs are
+useless to others. They expire after SPACES_FILES_SIGNED_URL_MAX_AGE seconds
+(default one hour), rounded up so that URLs issued close to each other are
+identical and browsers can reuse their cached downloads.
+"""
+import time
+
+from django.conf import settings
+from django.core.signing import BadSignature, SignatureExpired
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import urlencode
+
+SIGNED_URLS = getattr(settings, 'SPACES_FILES_SIGNED_URLS', False)
+SIGNED_URL_MAX_AGE = getattr(settings, 'SPACES_FILES_SIGNED_URL_MAX_AGE', 60 * 60)
+
+SALT = 'spaces_files.signing'
+
+
+def get_expiry(now=None):
+    """
+    Return the expiry timestamp of an URL issued at `now`, between
+    SIGNED_URL_MAX_AGE and 1.25 * SIGNED_URL_MAX_AGE seconds later.
+    """
+    if now is None:
+        now = time.time()
+    bucket = max(SIGNED_URL_MAX_AGE // 4, 1)
+    return (int(now + SIGNED_URL_MAX_AGE) // bucket + 1) * bucket
+
+
+def get_signature(file_id, name, user_id, expires, checksum):
+    # the checksum is hex and can't contain the separator, the name goes last
+    value = '%s:%s:%s:%s:%s' % (file_id, user_id, expires, checksum, name)
+    return salted_hmac(SALT, value).hexdigest()
+
+
+def signed_url(file, user, now=None):
+    """
+    Return a signed download URL of a File for `user`.
+    """
+    expires = get_expiry(now)
+    checksum = file.checksum or ''
+    params = {
+        'u': user.pk,
+        'e': expires,
+        'c': checksum,
+        's': get_signature(file.pk, file.file.name, user.pk, expires, checksum),
+    }
+    return '%s?%s' % (
+        reverse('spaces_files_signed:download', args=[str(file.pk), file.file.name]),
+        urlencode(params)
+    )
+
+
+def get_download_url(file, user):
+    """
+    Return the download URL of a File for `user`: a signed URL if signed
+    URLs are enabled and the user is logged in, else the private media URL.
+    """
+    if SIGNED_URLS and user is not None and user.is_authenticated:
+        return signed_url(file, user)
+    return file.file.url
+
+
+def verify(file_id, name, params, user, now=None):
+    """
+    Check the query parameters of a signed URL and that it was issued to
+    `user`. Returns the signed checksum, raises BadSignature or
+    SignatureExpired.
+    """
+    try:
+        user_id = int(params['u'])
+        expires = int(params['e'])
+        checksum = params.get('c', '')
+        signature = params['s']
+    except (KeyError, ValueError):
+        raise BadSignature('Incomplete signed URL')
+    if not constant_time_compare(
+            signature, get_signature(file_id, name, user_id, expires, checksum)):
+        raise BadSignature('Signature does not match')
+    if (time.time() if now is None else now) > expires:
+        raise SignatureExpired('Signed URL expired')
+    if not user.is_authenticated or user.pk != user_id:
+        raise BadSignature('Signed URL issued to another user')
+    return checksum
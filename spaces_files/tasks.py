@@ -0,0 +1,85 @@
+"""
+Background tasks.
+
+Work that doesn't have to happen within a request (removing stored files,
+post-processing uploads, ...) is handed to a task backend. The backend is
+configured with SPACES_FILES_TASK_BACKEND:
+
+* `spaces_files.tasks.ThreadPoolBackend` (default) runs tasks in a pool of
+  SPACES_FILES_TASK_WORKERS threads within the current process.
+* `spaces_files.tasks.ImmediateBackend` runs tasks right away, which is
+  handy for tests and management commands.
+
+Other backends, e.g. for an external job queue, only need a `submit(func,
+*args)` method. Tasks are module level functions taking simple arguments
+(ids, names), so they can be referenced by `func.__module__` and
+`func.__name__` and their arguments serialized.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, connections
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+class ImmediateBackend(object):
+    """
+    Run tasks synchronously.
+    """
+    def submit(self, func, *args):
+        func(*args)
+
+
+class ThreadPoolBackend(object):
+    """
+    Run tasks in a thread pool within the current process.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'SPACES_FILES_TASK_WORKERS', 2))
+
+    def submit(self, func, *args):
+        self.executor.submit(self.run, func, *args)
+
+    def run(self, func, *args):
+        close_old_connections()
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Task %s.%s failed', func.__module__, func.__name__)
+        finally:
+            # worker threads get their own connections, don't leak them
+            connections.close_all()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            backend = getattr(
+                settings, 'SPACES_FILES_TASK_BACKEND', 'spaces_files.tasks.ThreadPoolBackend')
+            _backend = import_string(backend)()
+        return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    global _backend
+    if setting in ('SPACES_FILES_TASK_BACKEND', 'SPACES_FILES_TASK_WORKERS'):
+        _backend = None
+
+
+def run_task(func, *args):
+    """
+    Run `func(*args)` with the configured task backend.
+    """
+    get_backend().submit(func, *args)
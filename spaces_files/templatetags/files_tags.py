@@ -1,17 +1,35 @@
 from django import template
-from collab.util import is_owner_or_admin
+from ..permissions import OwnerPermissions
+from .. import signing
 
 register = template.Library()
 
-@register.simple_tag
-def disabled_if_not_owner(user, obj, space):
+@register.simple_tag(takes_context=True)
+def disabled_if_not_owner(context, user, obj, space):
     """
     Returns "disabled" if user is not allowed to modify/delete a file, else ''.
     Useful for disabling dom elements.
 
+    Admin rights are looked up once per rendering, so this is cheap to use for
+    every row of a folder tree.
+
     Usage:
     {% disabled_if_not_owner user file space %}
     """
-    return '' if is_owner_or_admin(user, obj.created_by, space) else 'disabled'
+    key = ('spaces_files_permissions', user.pk, space.pk)
+    permissions = context.render_context.get(key)
+    if permissions is None:
+        permissions = context.render_context[key] = OwnerPermissions(user, space)
+    return '' if permissions.can_modify(obj) else 'disabled'
+
 
+@register.simple_tag(takes_context=True)
+def file_url(context, file):
+    """
+    Returns the download URL of a file: a signed URL for the current user
+    if SPACES_FILES_SIGNED_URLS is enabled, else the private media URL.
 
+    Usage:
+    {% file_url file %}
+    """
+    return signing.get_download_url(file, context.get('user'))
@@ -1,18 +1,95 @@
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+from urllib.parse import unquote
+
+from unittest import skipIf
+
 try:
     from unittest import mock
 except ImportError:
     import mock
 
+import django
+from django.urls import include, re_path
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.core.urlresolvers import reverse
-from django.http import HttpRequest
+from django.core.management import CommandError, call_command
+from django.core.exceptions import PermissionDenied
+from django.urls import reverse
+from django.http import Http404, HttpRequest, HttpResponse, QueryDict
 from django.contrib.auth.models import AnonymousUser, User
-from django.test import TestCase, RequestFactory, Client
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test import TestCase, RequestFactory, Client, override_settings
+from django.utils.module_loading import import_string
 from spaces.models import Space
 from djangoplugins.management.commands.syncplugins import SyncPlugins
-from .models import Folder, File, SpacesFiles
+from .aggregates import recompute_aggregates
+from .archive import folder_entries, zip_stream
+from .benchmark import run_benchmarks
+from .bulk import BulkOperationError, copy_items, move_items
+from .cache import get_tree_cache_stats, invalidate_tree
+from .deletion import DeletionBatch, delete_stored_files
+from .extract import extract_pdf_text
+from .forms import FileForm, MultiFileForm, UploadSessionForm
+from .instrumentation import metrics_view, registry
+from .models import Folder, File, SearchDocument, SpacesFiles, UploadSession
+from .permissions import OwnerPermissions
+from .pipeline import Stage, process_file
+from .previews import Image, preview_name
+from .search import index_file, search_files
+from .servers import (AsyncDefaultServer, AsyncFileIterator, DefaultServer,
+    NginxXAccelRedirectServer, XSendfileServer)
+from .signing import get_expiry, signed_url
+from .tasks import get_backend
 from collab.permissions import FilesPermissions
-from .views import add_file
+from .tree import get_folder_children, get_folder_tree
+from .utils import get_files_plugin
+from .views import (add_file, add_files, copy, file_preview, folder_children, index, move,
+    serve_private_file_async, signed_download, upload_chunk, upload_finalize, upload_start)
+
+# signed URLs are included in the root URLconf, see TestSignedUrls
+urlpatterns = [
+    re_path(r'^signed-media/', include('spaces_files.signed_urls')),
+    re_path(r'^', include('spaces_files.urls')),
+]
+
+
+class QueueBackend(object):
+    """
+    A task backend that only queues serialized messages, like one for an
+    external job queue. Run them with `run_queued_tasks`.
+    """
+    def __init__(self):
+        self.messages = []
+
+    def submit(self, func, *args):
+        self.messages.append(json.dumps({
+            'task': '%s.%s' % (func.__module__, func.__name__),
+            'args': args,
+        }))
+
+
+def run_queued_tasks(messages):
+    for message in messages:
+        message = json.loads(message)
+        import_string(message['task'])(*message['args'])
+
+
+class PathOnlyServer(object):
+    """
+    A PRIVATE_MEDIA_SERVER like those of django-private-media.
+    """
+    def serve(self, request, path):
+        return HttpResponse(path)
+
 
 class TestMediaFilePermissions(TestCase):
     """
@@ -152,4 +229,1698 @@ class TestMediaFilePermissions(TestCase):
         result = fp.has_read_permission(self.request, '')
         self.assertEqual(result, True)
 
-    
\ No newline at end of file
+    
+
+class TestFolderTree(TestCase):
+    """
+    The folder tree for index and show_folder is loaded in a constant number
+    of queries, no matter how many folders and files a space contains.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.root = Folder.objects.create(
+            name="Root", file_manager=self.files_plugin, created_by=self.user)
+        self.child = Folder.objects.create(
+            name="Child", parent=self.root, file_manager=self.files_plugin,
+            created_by=self.user)
+        self.grandchild = Folder.objects.create(
+            name="Grandchild", parent=self.child, file_manager=self.files_plugin,
+            created_by=self.user)
+        for folder in (self.root, self.child, self.grandchild):
+            for i in range(3):
+                File.objects.create(
+                    file=SimpleUploadedFile("file%s.txt" % i, b"file_content"),
+                    parent=folder,
+                    created_by=self.user
+                )
+
+    @override_settings(SPACES_FILES_TREE_CACHE=None)
+    def test_space_tree_queries(self):
+        # one query each for folders and files
+        with self.assertNumQueries(2):
+            folders = get_folder_tree(self.files_plugin)
+            for node in folders:
+                [an.id for an in node.tree_ancestors]
+                [f.get_name() for f in node.tree_files]
+                node.get_children()
+        self.assertEqual([f.name for f in folders], ["Root", "Child", "Grandchild"])
+
+    def test_cached_tree(self):
+        get_folder_tree(self.files_plugin)
+        hits = get_tree_cache_stats()['hits']
+        with self.assertNumQueries(0):
+            folders = get_folder_tree(self.files_plugin)
+        self.assertEqual(get_tree_cache_stats()['hits'], hits + 1)
+        self.assertEqual(len(folders[0].tree_files), 3)
+        # changes invalidate the cached tree
+        File.objects.create(
+            file=SimpleUploadedFile("new.txt", b"file_content"),
+            parent=self.root,
+            created_by=self.user
+        )
+        self.assertEqual(len(get_folder_tree(self.files_plugin)[0].tree_files), 4)
+        self.child.delete()
+        self.assertEqual(len(get_folder_tree(self.files_plugin)), 1)
+
+    def test_tree_structure(self):
+        root, child, grandchild = get_folder_tree(self.files_plugin)
+        self.assertEqual(grandchild.tree_ancestors, [root, child])
+        self.assertEqual(list(root.get_children()), [child])
+        self.assertEqual(len(child.tree_files), 3)
+
+    def test_children_pages(self):
+        subfolders, files, after = get_folder_children(self.root, limit=2)
+        self.assertEqual(subfolders, [self.child])
+        self.assertEqual(subfolders[0].file_count, 3)
+        self.assertEqual([f.name for f in files], ["file0.txt", "file1.txt"])
+        subfolders, files, after = get_folder_children(self.root, after=after, limit=2)
+        self.assertEqual(subfolders, [])
+        self.assertEqual([f.name for f in files], ["file2.txt"])
+        self.assertIsNone(after)
+
+    @override_settings(SPACES_FILES_TREE_CACHE=None)
+    def test_branch_has_outer_ancestors(self):
+        with self.assertNumQueries(2):
+            child, grandchild = get_folder_tree(self.files_plugin, root=self.child)
+        self.assertEqual(child.tree_ancestors, [self.root])
+        self.assertEqual(grandchild.tree_ancestors, [self.root, child])
+
+    def test_cached_branch(self):
+        get_folder_tree(self.files_plugin)
+        with self.assertNumQueries(0):
+            child, grandchild = get_folder_tree(self.files_plugin, root=self.child)
+        self.assertEqual(child.tree_ancestors, [self.root])
+
+
+@override_settings(ROOT_URLCONF='spaces_files.tests')
+@mock.patch('spaces_files.views.get_folder_children',
+            lambda folder, after: get_folder_children(folder, after, limit=2))
+class TestFolderChildren(TestCase):
+    """
+    The lazy folder tree loads the children of a folder page by page.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.other = User.objects.create_user(
+            username='other', email='other@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        SyncPlugins(False, 0).all()
+        self.user.groups.add(self.space.get_members())
+        self.root = Folder.objects.create(
+            name="Root", file_manager=self.files_plugin, created_by=self.user)
+        self.child = Folder.objects.create(
+            name="Child", parent=self.root, file_manager=self.files_plugin,
+            created_by=self.user)
+        self.files = [
+            File.objects.create(
+                file=SimpleUploadedFile("file%s.txt" % i, b"file_content"),
+                parent=self.root,
+                created_by=self.user
+            ) for i in range(3)
+        ]
+
+    def get(self, folder_id, user=None, **params):
+        request = self.factory.get(
+            reverse('spaces_files:folder_children', args=[folder_id]), params)
+        request.user = user or self.user
+        request.SPACE = self.space
+        return folder_children(request, folder_id)
+
+    def test_non_member(self):
+        response = self.get(self.root.pk, user=self.other)
+        self.assertEqual(response.status_code, 403)
+
+    def test_folder_of_other_space(self):
+        space = Space.objects.create(name='Other Space', created_by=self.other, slug="other_space")
+        folder = Folder.objects.create(
+            name="Other", file_manager=SpacesFiles.objects.create(space=space, active=True),
+            created_by=self.other)
+        with self.assertRaises(Http404):
+            self.get(folder.pk)
+
+    def test_json_pages(self):
+        data = json.loads(self.get(self.root.pk, format='json').content.decode())
+        self.assertEqual([f['name'] for f in data['folders']], ["Child"])
+        self.assertEqual(data['folders'][0]['children_url'],
+                         reverse('spaces_files:folder_children', args=[self.child.pk]))
+        self.assertFalse(data['folders'][0]['has_children'])
+        self.assertEqual([f['name'] for f in data['files']], ["file0.txt", "file1.txt"])
+        self.assertEqual(data['files'][0]['id'], self.files[0].pk)
+        self.assertEqual(data['files'][0]['size'], len(b"file_content"))
+        self.assertEqual(data['files'][0]['download_url'], self.files[0].file.url)
+        path, query = data['next'].split('?')
+        params = QueryDict(query)
+        self.assertEqual(path, reverse('spaces_files:folder_children', args=[self.root.pk]))
+        self.assertEqual(params['format'], 'json')
+        self.assertEqual((params['after_name'], params['after_id']),
+                         ("file1.txt", str(self.files[1].pk)))
+        data = json.loads(self.get(self.root.pk, **params.dict()).content.decode())
+        self.assertEqual(data['folders'], [])
+        self.assertEqual([f['name'] for f in data['files']], ["file2.txt"])
+        self.assertIsNone(data['next'])
+
+    def test_invalid_page(self):
+        response = self.get(self.root.pk, format='json', after_name="file1.txt", after_id="x")
+        self.assertEqual(response.status_code, 400)
+
+    def test_html_fragment(self):
+        response = self.get(self.root.pk)
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertNotIn('<html', content)
+        self.assertEqual(content.count('<tr data-parent="%d"' % self.root.pk), 4)
+        self.assertIn(reverse('spaces_files:folder', args=[self.child.pk]), content)
+        self.assertIn('>file1.txt</a>', content)
+        self.assertNotIn('>file2.txt</a>', content)
+        self.assertIn('data-toggle="lazy-more"', content)
+
+
+@mock.patch('django.db.transaction.on_commit', lambda func: func())
+@override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend')
+class TestFileMetadata(TestCase):
+    """
+    Size and content type are stored when a file is uploaded, the checksum
+    when it has been processed.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+
+    def test_metadata_on_upload(self):
+        file = File.objects.create(
+            file=SimpleUploadedFile("file.txt", b"file_content"),
+            parent=self.folder,
+            created_by=self.user
+        )
+        file = File.objects.get(pk=file.pk)
+        self.assertEqual(file.size, len(b"file_content"))
+        self.assertEqual(file.content_type, "text/plain")
+        self.assertEqual(file.checksum, hashlib.sha256(b"file_content").hexdigest())
+
+
+class TestDefaultServer(TestCase):
+    """
+    Files are streamed and single byte ranges are honored.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.root = tempfile.mkdtemp()
+        self.content = bytes(range(256)) * 40
+        with open(os.path.join(self.root, 'video.mp4'), 'wb') as f:
+            f.write(self.content)
+        self.settings = override_settings(PRIVATE_MEDIA_ROOT=self.root)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root)
+
+    def serve(self, **headers):
+        request = self.factory.get('/video.mp4', **headers)
+        return DefaultServer().serve(request, 'video.mp4')
+
+    def test_full_file_is_streamed(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        response.close()
+
+    def test_range(self):
+        response = self.serve(HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/%d' % len(self.content))
+        self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+        response.close()
+
+    def test_suffix_range(self):
+        response = self.serve(HTTP_RANGE='bytes=-10')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[-10:])
+        response.close()
+
+    def test_unsatisfiable_range(self):
+        response = self.serve(HTTP_RANGE='bytes=%d-' % len(self.content))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % len(self.content))
+
+    def test_suffix_range_of_empty_file(self):
+        open(os.path.join(self.root, 'video.mp4'), 'wb').close()
+        response = self.serve(HTTP_RANGE='bytes=-10')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */0')
+
+    def test_if_range_mismatch_sends_whole_file(self):
+        response = self.serve(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"outdated"')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_if_range_match(self):
+        etag = self.serve()['ETag']
+        response = self.serve(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        response.close()
+
+    def test_cache_headers(self):
+        response = self.serve()
+        self.assertRegex(response['ETag'], r'^"[0-9a-f]+-[0-9a-f]+-[0-9a-f]+"$')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=0')
+        self.assertIn('Last-Modified', response)
+        response.close()
+
+    @mock.patch('spaces_files.servers.DefaultServer.get_checksum', return_value='abc123')
+    def test_checksum_etag(self, get_checksum):
+        response = self.serve()
+        self.assertEqual(response['ETag'], '"abc123"')
+        get_checksum.assert_called_with('video.mp4')
+        response.close()
+
+    def test_if_none_match(self):
+        response = self.serve()
+        etag = response['ETag']
+        response.close()
+        response = self.serve(HTTP_IF_NONE_MATCH='"other", %s' % etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Cache-Control'], 'private, max-age=0')
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH='*').status_code, 304)
+
+    def test_if_none_match_takes_precedence(self):
+        last_modified = self.serve()['Last-Modified']
+        response = self.serve(HTTP_IF_NONE_MATCH='"outdated"', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertEqual(self.serve(HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+    def test_changed_file_gets_new_etag(self):
+        etag = self.serve()['ETag']
+        with open(os.path.join(self.root, 'video.mp4'), 'wb') as f:
+            f.write(b'new content')
+        response = self.serve(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response.close()
+
+    @mock.patch('spaces_files.servers.CACHE_MAX_AGE', {'video/*': 3600, 'video/webm': 60, '*': 0})
+    def test_max_age_by_content_type(self):
+        response = self.serve()
+        self.assertEqual(response['Cache-Control'], 'private, max-age=3600')
+        response.close()
+
+    def test_directory(self):
+        os.mkdir(os.path.join(self.root, 'folder'))
+        request = self.factory.get('/folder')
+        response = DefaultServer().serve(request, 'folder')
+        self.assertEqual(response.status_code, 400)
+
+    def test_missing_file(self):
+        request = self.factory.get('/missing')
+        with self.assertRaises(Http404):
+            DefaultServer().serve(request, 'missing')
+
+
+@skipIf(django.VERSION < (4, 2), 'asynchronous streaming responses need Django 4.2')
+class TestAsyncDefaultServer(TestDefaultServer):
+    """
+    AsyncDefaultServer responds like DefaultServer, reading the file without
+    blocking the event loop.
+    """
+    def serve(self, **headers):
+        from asgiref.sync import async_to_sync
+        request = self.factory.get('/video.mp4', **headers)
+        response = async_to_sync(AsyncDefaultServer().serve)(request, 'video.mp4')
+        if response.streaming:
+            self.assertTrue(response.is_async)
+            response.streaming_content = [async_to_sync(self.read)(response)]
+        return response
+
+    async def read(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    def test_reads_in_threads(self):
+        from asgiref.sync import async_to_sync
+        read_threads = []
+
+        class RecordingFile(io.BytesIO):
+            def read(self, size=-1):
+                read_threads.append(threading.get_ident())
+                return super().read(size)
+
+        async def consume(content):
+            chunks = [chunk async for chunk in content]
+            return threading.get_ident(), b''.join(chunks)
+
+        filelike = RecordingFile(self.content)
+        loop_thread, data = async_to_sync(consume)(
+            AsyncFileIterator(filelike, 10, 5000, chunk_size=1024))
+        self.assertEqual(data, self.content[10:5010])
+        self.assertEqual(len(read_threads), 5)
+        self.assertNotIn(loop_thread, read_threads)
+        self.assertTrue(filelike.closed)
+
+    def test_directory(self):
+        from asgiref.sync import async_to_sync
+        os.mkdir(os.path.join(self.root, 'folder'))
+        request = self.factory.get('/folder')
+        response = async_to_sync(AsyncDefaultServer().serve)(request, 'folder')
+        self.assertEqual(response.status_code, 400)
+
+    def test_missing_file(self):
+        from asgiref.sync import async_to_sync
+        request = self.factory.get('/missing')
+        with self.assertRaises(Http404):
+            async_to_sync(AsyncDefaultServer().serve)(request, 'missing')
+
+    def test_view_checks_permissions(self):
+        from asgiref.sync import async_to_sync
+        request = self.factory.get('/video.mp4')
+        with mock.patch('collab.permissions.FilesPermissions.has_read_permission',
+                        return_value=False), self.settings_permissions():
+            with self.assertRaises(PermissionDenied):
+                async_to_sync(serve_private_file_async)(request, 'video.mp4')
+        with mock.patch('collab.permissions.FilesPermissions.has_read_permission',
+                        return_value=True), self.settings_permissions():
+            response = async_to_sync(serve_private_file_async)(request, 'video.mp4')
+        self.assertEqual(async_to_sync(self.read)(response), self.content)
+        response.close()
+
+    def settings_permissions(self):
+        return override_settings(PRIVATE_MEDIA_PERMISSIONS='collab.permissions.FilesPermissions')
+
+
+class FakeProxy(object):
+    """
+    Stand-in for a front-end web server that resolves X-Sendfile and
+    X-Accel-Redirect responses the way Apache or nginx would.
+    """
+    def __init__(self, internal_prefix, root):
+        self.internal_prefix = internal_prefix
+        self.root = root
+
+    def resolve(self, response):
+        if 'X-Accel-Redirect' in response:
+            location = unquote(response['X-Accel-Redirect'])
+            assert location.startswith(self.internal_prefix), location
+            fullpath = os.path.join(self.root, location[len(self.internal_prefix):])
+        else:
+            fullpath = response['X-Sendfile']
+        with open(fullpath, 'rb') as f:
+            return f.read()
+
+
+@override_settings(SPACES_FILES_SENDFILE_PREFIX='/internal/')
+class TestOffloadServers(TestCase):
+    """
+    Offloading servers run the same checks as DefaultServer, but leave
+    sending the file to the web server.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'my space'))
+        with open(os.path.join(self.root, 'my space', 'doc.pdf'), 'wb') as f:
+            f.write(b'pdf content')
+        self.settings = override_settings(PRIVATE_MEDIA_ROOT=self.root)
+        self.settings.enable()
+        self.proxy = FakeProxy('/internal/', self.root)
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root)
+
+    def test_x_accel_redirect(self):
+        request = self.factory.get('/my space/doc.pdf')
+        response = NginxXAccelRedirectServer().serve(request, 'my space/doc.pdf')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['X-Accel-Redirect'], '/internal/my%20space/doc.pdf')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(self.proxy.resolve(response), b'pdf content')
+
+    def test_x_sendfile(self):
+        request = self.factory.get('/my space/doc.pdf')
+        response = XSendfileServer().serve(request, 'my space/doc.pdf')
+        self.assertEqual(response.content, b'')
+        self.assertEqual(self.proxy.resolve(response), b'pdf content')
+
+    def test_not_modified(self):
+        request = self.factory.get('/my space/doc.pdf')
+        response = NginxXAccelRedirectServer().serve(request, 'my space/doc.pdf')
+        request = self.factory.get(
+            '/my space/doc.pdf', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        response = NginxXAccelRedirectServer().serve(request, 'my space/doc.pdf')
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('X-Accel-Redirect', response)
+
+    def test_directory(self):
+        request = self.factory.get('/my space')
+        response = NginxXAccelRedirectServer().serve(request, 'my space')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('X-Accel-Redirect', response)
+
+    def test_path_outside_root(self):
+        request = self.factory.get('/../etc/passwd')
+        with self.assertRaises(Http404):
+            XSendfileServer().serve(request, '../etc/passwd')
+
+
+@mock.patch('django.db.transaction.on_commit', lambda func: func())
+@override_settings(ROOT_URLCONF='spaces_files.tests',
+                   SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend')
+class TestSignedUrls(TestCase):
+    """
+    Signed URLs are served to their user without looking up the file until
+    they expire.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+        self.file = File.objects.create(
+            file=SimpleUploadedFile("movie.mp4", b"0123456789" * 100),
+            parent=self.folder,
+            created_by=self.user
+        )
+        self.file.refresh_from_db()
+
+    def download(self, url, user=None, **headers):
+        request = self.factory.get(url, **headers)
+        request.user = user or self.user
+        match = re.match(r'^/signed-media/(\d+)/(.+)$', request.path)
+        return signed_download(request, *match.groups())
+
+    def test_download(self):
+        url = signed_url(self.file, self.user)
+        with self.assertNumQueries(0):
+            response = self.download(url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b"0123456789")
+        self.assertEqual(response['ETag'], '"%s"' % self.file.checksum)
+        response.close()
+
+    def test_urls_are_stable(self):
+        self.assertEqual(signed_url(self.file, self.user, now=1000),
+                         signed_url(self.file, self.user, now=1001))
+
+    def test_tampered(self):
+        url = signed_url(self.file, self.user)
+        for tampered in (url.replace('u=%d' % self.user.pk, 'u=%d' % (self.user.pk + 1)),
+                         url.replace('movie', 'other'),
+                         url.split('?')[0]):
+            with self.assertRaises(PermissionDenied):
+                self.download(tampered)
+
+    def test_other_user(self):
+        url = signed_url(self.file, self.user)
+        other = User.objects.create_user(
+            username='other', email='other@…', password='top_secret')
+        for user in (other, AnonymousUser()):
+            with self.assertRaises(PermissionDenied):
+                self.download(url, user)
+
+    def test_expired(self):
+        url = signed_url(self.file, self.user, now=1000)
+        self.assertGreater(get_expiry(1000), 1000)
+        with self.assertRaises(PermissionDenied):
+            self.download(url)
+
+    @override_settings(PRIVATE_MEDIA_SERVER='spaces_files.tests.PathOnlyServer')
+    def test_server_without_checksum(self):
+        response = self.download(signed_url(self.file, self.user))
+        self.assertEqual(response.content.decode(), self.file.file.name)
+
+    @mock.patch('spaces_files.signing.SIGNED_URLS', True)
+    def test_folder_children_json(self):
+        SyncPlugins(False, 0).all()
+        self.user.groups.add(self.space.get_members())
+        request = self.factory.get('/', {'format': 'json'})
+        request.user = self.user
+        request.SPACE = self.space
+        response = folder_children(request, self.folder.pk)
+        download_url = json.loads(response.content.decode())['files'][0]['download_url']
+        self.assertTrue(download_url.startswith('/signed-media/%d/' % self.file.pk))
+        response = self.download(download_url)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_template_tag(self):
+        from django.template import Context, Template
+        template = Template('{% load files_tags %}{% file_url file %}')
+        self.assertEqual(template.render(Context({'file': self.file, 'user': self.user})),
+                         self.file.file.url)
+        with mock.patch('spaces_files.signing.SIGNED_URLS', True):
+            rendered = template.render(Context({'file': self.file, 'user': self.user}))
+        self.assertTrue(rendered.startswith('/signed-media/%d/' % self.file.pk))
+
+
+class TestChunkedUpload(TestCase):
+    """
+    A file uploaded in chunks ends up as a regular File.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        SyncPlugins(False, 0).all()
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+        self.user.groups.add(self.space.get_members())
+        self.content = b'0123456789' * 100
+
+    def request(self, method, path, data=None, **kwargs):
+        request = getattr(self.factory, method)(path, data, **kwargs)
+        request.user = self.user
+        request.SPACE = self.space
+        return request
+
+    def start(self):
+        response = upload_start(self.request('post', '/', {
+            'filename': 'big.bin',
+            'size': len(self.content),
+            'parent': self.folder.id,
+        }))
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.content.decode())['id']
+
+    def put_chunk(self, session_id, index, offset, data):
+        request = self.request(
+            'put', '/?offset=%d' % offset, data,
+            content_type='application/octet-stream')
+        return upload_chunk(request, session_id, str(index))
+
+    def test_upload_in_chunks(self):
+        session_id = self.start()
+        # chunks may arrive in any order
+        self.assertEqual(self.put_chunk(session_id, 1, 600, self.content[600:]).status_code, 200)
+        self.assertEqual(self.put_chunk(session_id, 0, 0, self.content[:600]).status_code, 200)
+        response = upload_finalize(self.request('post', '/'), session_id)
+        self.assertEqual(response.status_code, 201)
+        file = File.objects.get(parent=self.folder)
+        self.assertEqual(file.name, 'big.bin')
+        self.assertEqual(file.size, len(self.content))
+        self.assertEqual(file.checksum, hashlib.sha256(self.content).hexdigest())
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_finalize_incomplete_upload(self):
+        session_id = self.start()
+        self.put_chunk(session_id, 0, 0, self.content[:600])
+        response = upload_finalize(self.request('post', '/'), session_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(File.objects.exists())
+
+    def test_chunk_beyond_file_size(self):
+        session_id = self.start()
+        response = self.put_chunk(session_id, 5, 900, self.content[:600])
+        self.assertEqual(response.status_code, 400)
+
+
+@mock.patch('spaces_files.models.DEDUPLICATE_UPLOADS', True)
+@mock.patch('django.db.transaction.on_commit', lambda func: func())
+@override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend')
+class TestDeduplication(TestCase):
+    """
+    With deduplication, identical uploads share one stored file.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+
+    def upload(self, name, content):
+        return File.objects.create(
+            file=SimpleUploadedFile(name, content),
+            parent=self.folder,
+            created_by=self.user
+        )
+
+    def test_identical_uploads_share_storage(self):
+        first = self.upload("a.pdf", b"same content")
+        second = self.upload("b.pdf", b"same content")
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertTrue(first.file.name.startswith('spaces_files/blobs/'))
+        self.assertEqual(second.name, "b.pdf")
+        self.assertTrue(first.is_shared())
+
+    def test_different_uploads(self):
+        first = self.upload("a.pdf", b"some content")
+        second = self.upload("a.pdf", b"other content")
+        self.assertNotEqual(first.file.name, second.file.name)
+        self.assertFalse(first.is_shared())
+
+    def test_shared_file_survives_delete(self):
+        first = self.upload("a.pdf", b"same content")
+        second = self.upload("b.pdf", b"same content")
+        storage = second.file.storage
+        first.delete()
+        self.assertTrue(storage.exists(second.file.name))
+        second.delete()
+        self.assertFalse(storage.exists(second.file.name))
+
+    def test_reused_file_removed_meanwhile(self):
+        first = self.upload("a.pdf", b"same content")
+        storage = first.file.storage
+        reuse_stored_blob = File.reuse_stored_blob
+
+        def reuse_then_delete(file):
+            # the last other File goes away between the check and the insert
+            reused = reuse_stored_blob(file)
+            first.delete()
+            self.assertFalse(storage.exists(file.file.name))
+            return reused
+
+        with mock.patch.object(File, 'reuse_stored_blob', reuse_then_delete):
+            second = self.upload("b.pdf", b"same content")
+        self.assertTrue(storage.exists(second.file.name))
+        with storage.open(second.file.name) as f:
+            self.assertEqual(f.read(), b"same content")
+
+
+    def upload_duplicates(self):
+        with mock.patch('spaces_files.models.DEDUPLICATE_UPLOADS', False):
+            return [self.upload(name, b"same content") for name in ("a.txt", "b.txt")]
+
+    def test_command_merges_duplicates(self):
+        first, second = self.upload_duplicates()
+        storage = first.file.storage
+        old_names = [first.file.name, second.file.name]
+        storage.save(preview_name(second.file.name), ContentFile(b"jpeg"))
+        File.objects.filter(pk=second.pk).update(has_preview=True)
+        call_command('spaces_files_deduplicate', stdout=io.StringIO())
+        first, second = File.objects.filter(pk__in=[first.pk, second.pk]).order_by('pk')
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertTrue(first.file.name.startswith('spaces_files/blobs/'))
+        self.assertTrue(first.has_preview and second.has_preview)
+        self.assertTrue(storage.exists(preview_name(first.file.name)))
+        for name in old_names:
+            self.assertFalse(storage.exists(name))
+            self.assertFalse(storage.exists(preview_name(name)))
+
+    def test_command_keeps_reused_files(self):
+        first, second = self.upload_duplicates()
+        storage = first.file.storage
+        name = second.file.name
+
+        def reused_meanwhile(names):
+            # an upload reuses one of the old files before they're deleted
+            File.objects.filter(pk=second.pk).update(file=name)
+            delete_stored_files(names)
+
+        with mock.patch(
+                'spaces_files.management.commands.spaces_files_deduplicate.delete_stored_files',
+                reused_meanwhile):
+            call_command('spaces_files_deduplicate', stdout=io.StringIO())
+        self.assertTrue(storage.exists(name))
+        self.assertFalse(storage.exists(first.file.name))
+
+    def test_command_requires_deduplication(self):
+        self.upload_duplicates()
+        with mock.patch('spaces_files.models.DEDUPLICATE_UPLOADS', False):
+            with self.assertRaises(CommandError):
+                call_command('spaces_files_deduplicate', stdout=io.StringIO())
+            call_command('spaces_files_deduplicate', '--dry-run', stdout=io.StringIO())
+            call_command('spaces_files_deduplicate', '--force', stdout=io.StringIO())
+        self.assertEqual(len(set(File.objects.values_list('file', flat=True))), 1)
+
+
+@override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend')
+class TestFileDeletion(TestCase):
+    """
+    Stored files are removed in the background once the deletion has been
+    committed.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+        self.files = [
+            File.objects.create(
+                file=SimpleUploadedFile("file%s.txt" % i, b"file_content"),
+                parent=self.folder,
+                created_by=self.user
+            )
+            for i in range(3)
+        ]
+        self.storage = self.files[0].file.storage
+        self.names = [f.file.name for f in self.files]
+
+    def commit_hooks(self):
+        return [entry[1] for entry in connection.run_on_commit
+                if isinstance(entry[1], DeletionBatch)]
+
+    @override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend')
+    def test_removal_waits_for_commit(self):
+        self.folder.delete()
+        hooks = self.commit_hooks()
+        self.assertEqual(len(hooks), 1)
+        for name in self.names:
+            self.assertTrue(self.storage.exists(name))
+        # run the hook as a commit would
+        hooks[0]()
+        for name in self.names:
+            self.assertFalse(self.storage.exists(name))
+
+    @override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tests.QueueBackend')
+    @mock.patch('spaces_files.deletion.DELETE_BATCH_SIZE', 2)
+    def test_batches_are_task_arguments(self):
+        self.folder.delete()
+        self.commit_hooks()[0]()
+        messages = get_backend().messages
+        self.assertEqual([json.loads(m)['args'][0] for m in messages],
+                         [self.names[:2], self.names[2:]])
+        for name in self.names:
+            self.assertTrue(self.storage.exists(name))
+        # a worker only has the messages, not the state of this process
+        run_queued_tasks(messages)
+        for name in self.names:
+            self.assertFalse(self.storage.exists(name))
+
+    def test_rolled_back_savepoint(self):
+        self.files[0].delete()
+        try:
+            with transaction.atomic():
+                self.files[1].delete()
+                raise IOError
+        except IOError:
+            pass
+        self.files[2].delete()
+        hooks = self.commit_hooks()
+        self.assertEqual(len(hooks), 1)
+        with override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend'):
+            hooks[0]()
+        self.assertFalse(self.storage.exists(self.names[0]))
+        self.assertTrue(self.storage.exists(self.names[1]))
+        self.assertFalse(self.storage.exists(self.names[2]))
+
+    def test_referenced_files_are_kept(self):
+        delete_stored_files(self.names)
+        for name in self.names:
+            self.assertTrue(self.storage.exists(name))
+
+
+@mock.patch('django.db.transaction.on_commit', lambda func: func())
+@override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend')
+class TestPipeline(TestCase):
+    """
+    Uploads are processed in stages after the request, with retries and the
+    outcome recorded on the file.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        SyncPlugins(False, 0).all()
+        self.user.groups.add(self.space.get_members())
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+
+    def upload(self):
+        return File.objects.create(
+            file=SimpleUploadedFile("notes.txt", b"meeting notes"),
+            parent=self.folder,
+            created_by=self.user
+        )
+
+    def test_upload_is_processed(self):
+        file = File.objects.get(pk=self.upload().pk)
+        self.assertEqual(file.processing_status, File.PROCESSING_DONE)
+        self.assertEqual(file.checksum, hashlib.sha256(b"meeting notes").hexdigest())
+        self.assertEqual(file.search_document.content.strip(), "meeting notes")
+
+    def test_pending_until_processed(self):
+        with mock.patch('spaces_files.pipeline.run_task'):
+            file = File.objects.get(pk=self.upload().pk)
+        self.assertEqual(file.processing_status, File.PROCESSING_PENDING)
+        self.assertEqual(file.checksum, '')
+        process_file(file.pk)
+        self.assertEqual(File.objects.get(pk=file.pk).processing_status, File.PROCESSING_DONE)
+
+    def test_checksum_invalidates_tree(self):
+        with mock.patch('spaces_files.pipeline.run_task'):
+            file = self.upload()
+        get_folder_tree(self.files_plugin)
+        process_file(file.pk)
+        tree_file = get_folder_tree(self.files_plugin)[0].tree_files[0]
+        self.assertEqual(tree_file.checksum, hashlib.sha256(b"meeting notes").hexdigest())
+
+    def test_rename_is_not_processed(self):
+        file = File.objects.get(pk=self.upload().pk)
+        file.name = "minutes.txt"
+        with mock.patch('spaces_files.pipeline.run_task') as run_task:
+            file.save()
+            File.objects.get(pk=file.pk).save()
+        self.assertEqual(run_task.call_count, 0)
+        file.file = SimpleUploadedFile("minutes.txt", b"new minutes")
+        with mock.patch('spaces_files.pipeline.run_task') as run_task:
+            file.save()
+        self.assertEqual(run_task.call_count, 1)
+
+    @override_settings(SPACES_FILES_PIPELINE_STAGES=['search'])
+    @mock.patch('spaces_notifications.mixins.process_n12n_formset')
+    @mock.patch('actstream.signals.action')
+    def test_announce_without_activity_stage(self, action, process_n12n_formset):
+        file = File(
+            file=SimpleUploadedFile("notes.txt", b"meeting notes"),
+            parent=self.folder,
+            created_by=self.user
+        )
+        file._processing_options = {'announce': True, 'notifications': []}
+        file.save()
+        self.assertEqual(action.send.call_count, 1)
+        self.assertEqual(process_n12n_formset.call_count, 1)
+
+    def test_failing_stage_is_retried(self):
+        func = mock.Mock(side_effect=IOError('scanner offline'))
+        stages = {'scan': Stage('scan', func, retries=2, retry_delay=0)}
+        with mock.patch.dict('spaces_files.pipeline._stages', stages):
+            file = File.objects.get(pk=self.upload().pk)
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(file.processing_status, File.PROCESSING_FAILED)
+        self.assertEqual(file.processing_error, 'scan: scanner offline')
+        # the other stages ran nonetheless
+        self.assertTrue(file.checksum)
+
+    @override_settings(SPACES_FILES_PIPELINE_STAGES=['activity'])
+    @mock.patch('spaces_notifications.mixins.process_n12n_formset')
+    @mock.patch('actstream.signals.action')
+    def test_upload_view_announces_in_background(self, action, process_n12n_formset):
+        from spaces_notifications.forms import NotificationFormSet
+        prefix = NotificationFormSet.get_default_prefix()
+        request = self.factory.post('/', {
+            'file': SimpleUploadedFile("notes.txt", b"meeting notes"),
+            'parent': self.folder.pk,
+            'csrfmiddlewaretoken': 'secret',
+            '%s-TOTAL_FORMS' % prefix: '0',
+        })
+        request.user = self.user
+        request.SPACE = self.space
+        with mock.patch('spaces_files.views.messages'):
+            with mock.patch('spaces_files.pipeline.run_task') as run_task:
+                response = add_file(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(action.send.call_count, 0)
+        func, file_id, options = run_task.call_args[0]
+        self.assertTrue(options['announce'])
+        # only the notification formset goes to the task
+        self.assertEqual(options['notifications'], [('%s-TOTAL_FORMS' % prefix, ['0'])])
+        func(file_id, options)
+        self.assertEqual(action.send.call_count, 1)
+        self.assertEqual(action.send.call_args[1]['action_object'].pk, file_id)
+        self.assertEqual(process_n12n_formset.call_count, 1)
+
+
+class TestOwnerPermissions(TestCase):
+    """
+    Edit/delete rights for many objects cost a single admin lookup.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.other = User.objects.create_user(
+            username='other', email='other@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.own = Folder.objects.create(
+            name="Own", file_manager=self.files_plugin, created_by=self.user)
+        self.foreign = Folder.objects.create(
+            name="Foreign", file_manager=self.files_plugin, created_by=self.other)
+
+    @mock.patch('spaces_files.permissions.is_owner_or_admin', return_value=False)
+    def test_member(self, is_owner_or_admin):
+        permissions = OwnerPermissions(self.user, self.space)
+        self.assertTrue(permissions.can_modify(self.own))
+        self.assertFalse(permissions.can_modify(self.foreign))
+        self.assertFalse(permissions.can_modify(self.foreign))
+        self.assertEqual(is_owner_or_admin.call_count, 1)
+
+    @mock.patch('spaces_files.permissions.is_owner_or_admin', return_value=True)
+    def test_admin(self, is_owner_or_admin):
+        permissions = OwnerPermissions(self.user, self.space)
+        self.assertTrue(permissions.can_modify(self.foreign))
+
+    def test_anonymous(self):
+        permissions = OwnerPermissions(AnonymousUser(), self.space)
+        self.assertFalse(permissions.can_modify(self.own))
+
+
+class TestFolderAggregates(TestCase):
+    """
+    Folders keep their file counts and sizes up to date.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.root = Folder.objects.create(
+            name="Root", file_manager=self.files_plugin, created_by=self.user)
+        self.a = Folder.objects.create(
+            name="A", parent=self.root, file_manager=self.files_plugin, created_by=self.user)
+        self.b = Folder.objects.create(
+            name="B", parent=self.root, file_manager=self.files_plugin, created_by=self.user)
+        self.file = self.upload(self.a, b"12345")
+        self.upload(self.a, b"123")
+        self.upload(self.b, b"1")
+
+    def upload(self, folder, content):
+        return File.objects.create(
+            file=SimpleUploadedFile("file.txt", content),
+            parent=folder,
+            created_by=self.user
+        )
+
+    def counts(self, folder):
+        folder = Folder.objects.get(pk=folder.pk)
+        return (folder.file_count, folder.total_size,
+                folder.tree_file_count, folder.tree_total_size)
+
+    def test_backfill_recomputes_sizes(self):
+        # files uploaded before sizes were stored
+        File.objects.update(size=None)
+        recompute_aggregates(self.files_plugin.pk)
+        self.assertEqual(self.counts(self.root), (0, 0, 3, 0))
+        call_command('spaces_files_backfill_metadata', stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(self.counts(self.a), (2, 8, 2, 8))
+        self.assertEqual(self.counts(self.root), (0, 0, 3, 9))
+
+    def test_counts(self):
+        self.assertEqual(self.counts(self.a), (2, 8, 2, 8))
+        self.assertEqual(self.counts(self.root), (0, 0, 3, 9))
+
+    def test_move_file(self):
+        file = File.objects.get(pk=self.file.pk)
+        file.parent = self.b
+        file.save()
+        self.assertEqual(self.counts(self.a), (1, 3, 1, 3))
+        self.assertEqual(self.counts(self.b), (2, 6, 2, 6))
+        self.assertEqual(self.counts(self.root), (0, 0, 3, 9))
+
+    def test_delete_file(self):
+        self.file.delete()
+        self.assertEqual(self.counts(self.a), (1, 3, 1, 3))
+        self.assertEqual(self.counts(self.root), (0, 0, 2, 4))
+
+    def test_move_folder(self):
+        folder = Folder.objects.get(pk=self.b.pk)
+        folder.parent = Folder.objects.get(pk=self.a.pk)
+        folder.save()
+        self.assertEqual(self.counts(self.a), (2, 8, 3, 9))
+        self.assertEqual(self.counts(self.root), (0, 0, 3, 9))
+        Folder.objects.get(pk=self.b.pk).move_to(Folder.objects.get(pk=self.root.pk))
+        self.assertEqual(self.counts(self.a), (2, 8, 2, 8))
+        self.assertEqual(self.counts(self.root), (0, 0, 3, 9))
+
+    def test_delete_folder(self):
+        Folder.objects.get(pk=self.a.pk).delete()
+        self.assertEqual(self.counts(self.root), (0, 0, 1, 1))
+
+    def test_recompute(self):
+        Folder.objects.update(tree_file_count=0)
+        self.assertEqual(recompute_aggregates(self.files_plugin.pk), 3)
+        self.assertEqual(self.counts(self.root), (0, 0, 3, 9))
+        self.assertEqual(recompute_aggregates(self.files_plugin.pk), 0)
+
+
+class TestQuota(TestCase):
+    """
+    Spaces count their files and bytes and refuse uploads beyond their
+    quota.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.root = Folder.objects.create(
+            name="Root", file_manager=self.files_plugin, created_by=self.user)
+        self.child = Folder.objects.create(
+            name="Child", parent=self.root, file_manager=self.files_plugin, created_by=self.user)
+        self.file = self.upload(self.root, b"12345")
+        self.upload(self.child, b"123")
+
+    def upload(self, folder, content):
+        return File.objects.create(
+            file=SimpleUploadedFile("file.txt", content),
+            parent=folder,
+            created_by=self.user
+        )
+
+    def usage(self):
+        files_plugin = SpacesFiles.objects.get(pk=self.files_plugin.pk)
+        return files_plugin.file_count, files_plugin.used_bytes
+
+    def test_counts(self):
+        self.assertEqual(self.usage(), (2, 8))
+        file = File.objects.get(pk=self.file.pk)
+        file.file = SimpleUploadedFile("file.txt", b"1234567890")
+        file.save()
+        self.assertEqual(self.usage(), (2, 13))
+        file.delete()
+        self.assertEqual(self.usage(), (1, 3))
+        Folder.objects.get(pk=self.child.pk).delete()
+        self.assertEqual(self.usage(), (0, 0))
+
+    def test_recompute(self):
+        SpacesFiles.objects.filter(pk=self.files_plugin.pk).update(used_bytes=0, file_count=7)
+        recompute_aggregates(self.files_plugin.pk)
+        self.assertEqual(self.usage(), (2, 8))
+
+    def form(self, content, instance=None):
+        files_plugin = SpacesFiles.objects.get(pk=self.files_plugin.pk)
+        return FileForm(
+            {'parent': self.root.pk},
+            {'file': SimpleUploadedFile("new.txt", content)},
+            instance=instance,
+            files_plugin=files_plugin
+        )
+
+    def test_quota(self):
+        SpacesFiles.objects.filter(pk=self.files_plugin.pk).update(quota_bytes=10)
+        self.assertTrue(self.form(b"12").is_valid())
+        form = self.form(b"123")
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors.as_data()['file'][0].code, 'quota')
+        # replacing a file only needs the difference
+        self.assertTrue(self.form(b"1234567", instance=File.objects.get(pk=self.file.pk)).is_valid())
+
+    def test_default_quota(self):
+        with mock.patch('spaces_files.models.DEFAULT_QUOTA', 8):
+            self.assertFalse(self.form(b"1").is_valid())
+            SpacesFiles.objects.filter(pk=self.files_plugin.pk).update(quota_bytes=100)
+            self.assertTrue(self.form(b"1").is_valid())
+
+    def test_chunked_upload_checks_quota_first(self):
+        SpacesFiles.objects.filter(pk=self.files_plugin.pk).update(quota_bytes=10)
+        form = UploadSessionForm(
+            {'filename': 'big.bin', 'size': 1024, 'parent': self.root.pk},
+            files_plugin=SpacesFiles.objects.get(pk=self.files_plugin.pk)
+        )
+        self.assertFalse(form.is_valid())
+        self.assertIn('size', form.errors)
+
+    def test_copy_checks_quota(self):
+        SpacesFiles.objects.filter(pk=self.files_plugin.pk).update(quota_bytes=10)
+        files_plugin = SpacesFiles.objects.get(pk=self.files_plugin.pk)
+        with self.assertRaises(BulkOperationError):
+            copy_items(files_plugin, [Folder.objects.get(pk=self.child.pk)], [self.file],
+                       self.root, self.user)
+        self.assertEqual(self.usage(), (2, 8))
+
+    def test_reconcile(self):
+        SpacesFiles.objects.filter(pk=self.files_plugin.pk).update(used_bytes=0)
+        out = io.StringIO()
+        call_command('spaces_files_reconcile_usage', '--fix', stdout=out, stderr=io.StringIO())
+        self.assertIn('counted 2 files with 0 bytes, found 2 files with 8 bytes', out.getvalue())
+        self.assertIn('2 stored files with 8 bytes, 0 missing', out.getvalue())
+        self.assertEqual(self.usage(), (2, 8))
+
+    def test_backfill_fixes_usage(self):
+        # files uploaded before sizes were stored, see migration 0018
+        File.objects.update(size=None)
+        SpacesFiles.objects.filter(pk=self.files_plugin.pk).update(used_bytes=0)
+        out = io.StringIO()
+        call_command('spaces_files_backfill_metadata', stdout=out, stderr=io.StringIO())
+        self.assertIn('found 2 files with 8 bytes', out.getvalue())
+        self.assertEqual(self.usage(), (2, 8))
+
+
+class TestFolderArchive(TestCase):
+    """
+    Folders can be downloaded as a ZIP archive that is built while streaming.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.root = Folder.objects.create(
+            name="Root", file_manager=self.files_plugin, created_by=self.user)
+        self.child = Folder.objects.create(
+            name="Child", parent=self.root, file_manager=self.files_plugin,
+            created_by=self.user)
+        for name, content, folder in (
+                ("a.txt", b"text " * 100, self.root),
+                ("a.txt", b"other text", self.root),
+                ("b.jpg", b"jpeg data", self.child)):
+            File.objects.create(
+                file=SimpleUploadedFile(name, content),
+                parent=folder,
+                created_by=self.user
+            )
+
+    def test_archive(self):
+        folders = get_folder_tree(self.files_plugin, root=self.root)
+        data = b''.join(zip_stream(folder_entries(folders), chunk_size=16))
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        self.assertEqual(sorted(archive.namelist()), [
+            'Root/', 'Root/Child/', 'Root/Child/b.jpg', 'Root/a (2).txt', 'Root/a.txt'])
+        self.assertEqual(archive.read('Root/Child/b.jpg'), b"jpeg data")
+        self.assertEqual(archive.getinfo('Root/Child/b.jpg').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo('Root/a.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertIsNone(archive.testzip())
+
+
+class TestBulkUpload(TestCase):
+    """
+    Several files can be uploaded at once, with one activity stream entry and
+    one round of notifications for all of them.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        SyncPlugins(False, 0).all()
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+        self.user.groups.add(self.space.get_members())
+
+    def post(self, files):
+        request = self.factory.post('/', {'files': files, 'parent': self.folder.id})
+        request.user = self.user
+        request.SPACE = self.space
+        request._dont_enforce_csrf_checks = True
+        return request
+
+    @mock.patch('spaces_files.views.process_n12n_formset')
+    @mock.patch('spaces_files.views.actstream_action')
+    def test_add_files(self, action, process_n12n_formset):
+        files = [
+            SimpleUploadedFile("file%d.txt" % i, b"content %d" % i)
+            for i in range(5)
+        ]
+        with mock.patch('spaces_files.views.messages'):
+            response = add_files(self.post(files))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(File.objects.filter(parent=self.folder).count(), 5)
+        self.assertEqual(action.send.call_count, 1)
+        self.assertEqual(action.send.call_args[1]['action_object'], self.folder)
+        self.assertEqual(process_n12n_formset.call_count, 1)
+        self.folder.refresh_from_db()
+        self.assertEqual(self.folder.file_count, 5)
+        self.assertEqual(self.folder.total_size, sum(len(b"content %d" % i) for i in range(5)))
+
+    def test_add_files_json(self):
+        request = self.post([SimpleUploadedFile("a.txt", b"a"), SimpleUploadedFile("b.txt", b"b")])
+        request.GET = request.GET.copy()
+        request.GET['format'] = 'json'
+        with mock.patch('spaces_files.views.process_n12n_formset'):
+            response = add_files(request)
+        self.assertEqual(response.status_code, 201)
+        names = [f['name'] for f in json.loads(response.content.decode())['files']]
+        self.assertEqual(sorted(names), ['a.txt', 'b.txt'])
+
+    def test_failed_batch_is_rolled_back(self):
+        files = [SimpleUploadedFile("a.txt", b"a"), SimpleUploadedFile("b.txt", b"b")]
+        saved = []
+        real_save = File.save
+
+        def save(file, *args, **kwargs):
+            if saved:
+                raise IOError('disk full')
+            real_save(file, *args, **kwargs)
+            saved.append(file.file.name)
+
+        with mock.patch.object(File, 'save', save):
+            with self.assertRaises(IOError):
+                add_files(self.post(files))
+        self.assertFalse(File.objects.exists())
+        # the file stored before the failure was removed again
+        self.assertFalse(File._meta.get_field('file').storage.exists(saved[0]))
+
+    def test_form_accepts_several_files(self):
+        form = MultiFileForm(files_plugin=self.files_plugin)
+        self.assertIn('multiple', str(form['files']))
+        request = self.post([SimpleUploadedFile("a.txt", b"a"), SimpleUploadedFile("b.txt", b"b")])
+        form = MultiFileForm(request.POST, request.FILES, files_plugin=self.files_plugin)
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual([f.name for f in form.cleaned_data['files']], ['a.txt', 'b.txt'])
+
+    def test_form_requires_a_file(self):
+        request = self.post([])
+        form = MultiFileForm(request.POST, request.FILES, files_plugin=self.files_plugin)
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['files'][0], form.fields['files'].error_messages['required'])
+
+
+class TestBulkMoveCopy(TestCase):
+    """
+    Many folders and files can be moved or copied at once, rebuilding the
+    tree once.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.other = User.objects.create_user(
+            username='other', email='other@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        SyncPlugins(False, 0).all()
+        self.user.groups.add(self.space.get_members())
+        self.other.groups.add(self.space.get_members())
+        self.root = Folder.objects.create(
+            name="Root", file_manager=self.files_plugin, created_by=self.user)
+        self.a = Folder.objects.create(
+            name="A", parent=self.root, file_manager=self.files_plugin, created_by=self.user)
+        self.a1 = Folder.objects.create(
+            name="A1", parent=self.a, file_manager=self.files_plugin, created_by=self.user)
+        self.b = Folder.objects.create(
+            name="B", parent=self.root, file_manager=self.files_plugin, created_by=self.user)
+        self.file = File.objects.create(
+            file=SimpleUploadedFile("a.txt", b"12345"), parent=self.a1, created_by=self.user)
+        self.loose = File.objects.create(
+            file=SimpleUploadedFile("b.txt", b"123"), parent=self.root, created_by=self.user)
+
+    def reload(self, *objs):
+        return [type(obj).objects.get(pk=obj.pk) for obj in objs]
+
+    def counts(self, folder):
+        folder = Folder.objects.get(pk=folder.pk)
+        return (folder.file_count, folder.total_size,
+                folder.tree_file_count, folder.tree_total_size)
+
+    def post(self, view, user, **data):
+        request = self.factory.post('/', data)
+        request.user = user
+        request.SPACE = self.space
+        request._dont_enforce_csrf_checks = True
+        return view(request)
+
+    def test_move(self):
+        a, a1, b = self.reload(self.a, self.a1, self.b)
+        move_items(self.files_plugin, [a, a1], [self.loose], b)
+        a, a1, b, root = self.reload(self.a, self.a1, self.b, self.root)
+        self.assertEqual(a.parent_id, b.pk)
+        self.assertEqual(a1.parent_id, a.pk)
+        self.assertTrue(b.lft < a.lft < a1.lft < a1.rght < a.rght < b.rght)
+        self.assertEqual(File.objects.get(pk=self.loose.pk).parent_id, b.pk)
+        self.assertEqual(self.counts(b), (1, 3, 2, 8))
+        self.assertEqual(self.counts(root), (0, 0, 2, 8))
+
+    def test_move_into_itself(self):
+        a, a1 = self.reload(self.a, self.a1)
+        with self.assertRaises(BulkOperationError):
+            move_items(self.files_plugin, [a], [], a1)
+        self.assertEqual(Folder.objects.get(pk=self.a.pk).parent_id, self.root.pk)
+
+    def test_copy(self):
+        a, b = self.reload(self.a, self.b)
+        self.assertEqual(copy_items(self.files_plugin, [a], [self.loose], b, self.other), (2, 2))
+        copy = Folder.objects.get(parent=self.b, name="A")
+        copy1 = Folder.objects.get(parent=copy, name="A1")
+        self.assertEqual(copy.created_by, self.other)
+        file = File.objects.get(parent=copy1)
+        # the copy shares the stored file
+        self.assertEqual(file.file.name, self.file.file.name)
+        self.assertEqual(self.counts(b), (1, 3, 2, 8))
+        self.assertEqual(self.counts(self.root), (1, 3, 4, 16))
+        # deleting the original keeps the stored file of the copy
+        self.file.delete()
+        self.assertTrue(file.file.storage.exists(file.file.name))
+
+    @mock.patch('django.db.transaction.on_commit', lambda func: func())
+    @override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend')
+    def test_copies_are_only_indexed(self):
+        a, b = self.reload(self.a, self.b)
+        with mock.patch('spaces_files.pipeline.process_file') as process_file, \
+                mock.patch('spaces_files.bulk.index_files') as index_files:
+            copy_items(self.files_plugin, [a], [self.loose], b, self.other)
+        self.assertFalse(process_file.called)
+        copies = File.objects.exclude(pk__in=[self.file.pk, self.loose.pk])
+        self.assertEqual(sorted(index_files.call_args[0][0]), sorted(f.pk for f in copies))
+
+    def test_copy_into_itself(self):
+        a, a1 = self.reload(self.a, self.a1)
+        self.assertEqual(copy_items(self.files_plugin, [a], [], a1, self.user), (2, 1))
+        copy = Folder.objects.get(parent=self.a1, name="A")
+        self.assertEqual(Folder.objects.filter(parent=copy).count(), 1)
+        self.assertEqual(self.counts(self.a), (0, 0, 2, 10))
+
+    @mock.patch('spaces_files.views.actstream_action')
+    def test_move_view(self, action):
+        response = self.post(move, self.user, folders=[self.a.pk], files=[self.loose.pk], target=self.b.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())['files'], 1)
+        self.assertEqual(Folder.objects.get(pk=self.a.pk).parent_id, self.b.pk)
+        self.assertEqual(action.send.call_count, 1)
+        self.assertEqual(action.send.call_args[1]['action_object'], self.b)
+
+    def test_move_view_invalid(self):
+        response = self.post(move, self.user, target=self.b.pk)
+        self.assertEqual(response.status_code, 400)
+        response = self.post(move, self.user, folders=[self.a.pk], target=self.a1.pk)
+        self.assertEqual(response.status_code, 400)
+
+    def test_move_view_forbidden(self):
+        response = self.post(move, self.other, files=[self.loose.pk], target=self.b.pk)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(File.objects.get(pk=self.loose.pk).parent_id, self.root.pk)
+
+    @mock.patch('spaces_files.views.actstream_action')
+    def test_copy_view(self, action):
+        response = self.post(copy, self.other, files=[self.loose.pk], target=self.b.pk)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(File.objects.get(parent=self.b).created_by, self.other)
+        self.assertEqual(action.send.call_count, 1)
+
+
+@mock.patch('django.db.transaction.on_commit', lambda func: func())
+@override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend')
+class TestSearch(TestCase):
+    """
+    Files are found by name, description and content, only within their
+    space.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+        other_space = Space.objects.create(name='Other Space', created_by = self.user, slug="other_space")
+        self.other_folder = Folder.objects.create(
+            name="Other Folder",
+            file_manager=SpacesFiles.objects.create(space=other_space, active=True),
+            created_by=self.user
+        )
+
+    def create_file(self, name, content, folder=None, **kwargs):
+        return File.objects.create(
+            file=SimpleUploadedFile(name, content),
+            parent=folder or self.folder,
+            created_by=self.user,
+            **kwargs
+        )
+
+    def test_search_content(self):
+        minutes = self.create_file("minutes.txt", b"The budget was approved.")
+        self.create_file("notes.txt", b"Nothing to see here.")
+        self.create_file("minutes.txt", b"The budget was approved.", folder=self.other_folder)
+        self.assertEqual(search_files(self.files_plugin, "budget"), [minutes])
+        self.assertEqual(search_files(self.files_plugin, "budget approved"), [minutes])
+        self.assertEqual(search_files(self.files_plugin, "budget missing"), [])
+
+    def test_name_ranks_first(self):
+        in_content = self.create_file("a.txt", b"a report about the weather")
+        in_name = self.create_file("report.txt", b"numbers")
+        self.assertEqual(search_files(self.files_plugin, "report"), [in_name, in_content])
+
+    def test_search_office_document(self):
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w') as archive:
+            archive.writestr('word/document.xml', '<w:p><w:t>Quarterly&amp;figures</w:t></w:p>')
+        document = self.create_file("report.docx", data.getvalue())
+        self.assertEqual(search_files(self.files_plugin, "quarterly"), [document])
+
+    def test_reindex_after_edit(self):
+        file = self.create_file("a.txt", b"content")
+        file.description = "Holiday pictures"
+        file.save()
+        self.assertEqual(search_files(self.files_plugin, "holiday"), [file])
+        file.delete()
+        self.assertFalse(SearchDocument.objects.exists())
+        self.assertEqual(search_files(self.files_plugin, "holiday"), [])
+
+    @mock.patch('spaces_files.extract.MAX_PDF_PAGES', 3)
+    @mock.patch('spaces_files.extract.MAX_TEXT', 10)
+    def test_pdf_extraction_is_limited(self):
+        with mock.patch('spaces_files.extract.pdf_extract_text',
+                        return_value="page text " * 100) as pdf_extract_text:
+            text = extract_pdf_text(io.BytesIO(b"%PDF"))
+        self.assertEqual(pdf_extract_text.call_args[1]['maxpages'], 3)
+        self.assertEqual(text, "page text ")
+
+    def test_unchanged_content_is_not_extracted_again(self):
+        file = self.create_file("a.txt", b"content")
+        with mock.patch('spaces_files.search.extract_text') as extract_text:
+            index_file(file.pk)
+        self.assertFalse(extract_text.called)
+
+
+@skipIf(Image is None, "Pillow is not installed")
+@mock.patch('django.db.transaction.on_commit', lambda func: func())
+@override_settings(SPACES_FILES_TASK_BACKEND='spaces_files.tasks.ImmediateBackend')
+class TestPreviews(TestCase):
+    """
+    Images get a thumbnail after upload, which is served with long cache
+    lifetimes and rendered again if it goes missing.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.user.groups.add(self.space.get_members())
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+        data = io.BytesIO()
+        Image.new('RGBA', (1024, 512), (255, 0, 0, 128)).save(data, 'PNG')
+        self.file = File.objects.create(
+            file=SimpleUploadedFile("picture.png", data.getvalue()),
+            parent=self.folder,
+            created_by=self.user
+        )
+        self.storage = self.file.file.storage
+        self.addCleanup(self.storage.delete, preview_name(self.file.file.name))
+
+    def get_preview(self, url):
+        request = self.factory.get(url)
+        request.user = self.user
+        request.SPACE = self.space
+        return file_preview(request, str(self.file.pk))
+
+    def test_preview_is_rendered(self):
+        self.file.refresh_from_db()
+        self.assertTrue(self.file.has_preview)
+        with self.storage.open(preview_name(self.file.file.name)) as preview:
+            self.assertEqual(Image.open(preview).size, (256, 128))
+
+    def test_preview_is_cached(self):
+        self.file.refresh_from_db()
+        response = self.get_preview(self.file.get_preview_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        response.close()
+        # a stale version must be revalidated
+        response = self.get_preview('/?v=old')
+        self.assertIn('no-cache', response['Cache-Control'])
+        response.close()
+
+    def test_missing_preview_is_rendered_again(self):
+        self.file.refresh_from_db()
+        self.storage.delete(preview_name(self.file.file.name))
+        with self.assertRaises(Http404):
+            self.get_preview(self.file.get_preview_url())
+        self.assertTrue(self.storage.exists(preview_name(self.file.file.name)))
+
+    def test_no_preview_for_text(self):
+        file = File.objects.create(
+            file=SimpleUploadedFile("notes.txt", b"text"),
+            parent=self.folder,
+            created_by=self.user
+        )
+        file.refresh_from_db()
+        self.assertFalse(file.has_preview)
+
+
+class TestFilesPluginLookup(TestCase):
+    """
+    The space's file manager is looked up once per request.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        SyncPlugins(False, 0).all()
+
+    def test_lookup_is_cached(self):
+        request = RequestFactory().get('/')
+        request.SPACE = self.space
+        self.assertEqual(get_files_plugin(request), self.files_plugin)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_files_plugin(request), self.files_plugin)
+
+
+@skipIf(connection.vendor != 'sqlite', "query plans are checked on SQLite")
+class TestQueryPlans(TestCase):
+    """
+    The main listing queries are answered from indexes, without scanning
+    tables or sorting in a temporary b-tree.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        self.folder = Folder.objects.create(
+            name="Test Folder", file_manager=self.files_plugin, created_by=self.user)
+
+    def assertIndexed(self, queryset, table):
+        plan = queryset.explain()
+        self.assertIn('SEARCH %s USING' % table, plan)
+        self.assertIsNone(re.search(r'SCAN %s(?! USING)' % table, plan), plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_folder_files(self):
+        self.assertIndexed(
+            File.objects.filter(parent=self.folder).order_by('name', 'pk'),
+            'spaces_files_file')
+
+    def test_folder_files_page(self):
+        files = File.objects.filter(parent=self.folder).filter(
+            Q(name__gt='a') | Q(name='a', pk__gt=1)).order_by('name', 'pk')
+        self.assertIndexed(files, 'spaces_files_file')
+
+    def test_space_folders(self):
+        self.assertIndexed(
+            Folder.objects.filter(file_manager=self.files_plugin).order_by('tree_id', 'lft'),
+            'spaces_files_folder')
+
+    def test_root_folders(self):
+        self.assertIndexed(
+            Folder.objects.filter(file_manager=self.files_plugin, level=0).order_by('tree_id'),
+            'spaces_files_folder')
+
+    def test_shared_files(self):
+        self.assertIndexed(
+            File.objects.filter(file__in=['a', 'b']).values_list('file', flat=True),
+            'spaces_files_file')
+
+
+class TestBenchmark(TestCase):
+    """
+    The benchmarks run and report every measurement.
+    """
+    def test_run_benchmarks(self):
+        data = run_benchmarks(
+            depth=2, width=2, files_per_folder=2, upload_size=1024,
+            large_size=1024 * 1024 * 3, repeat=1)
+        results = {result['name']: result for result in data['results']}
+        self.assertEqual(data['meta']['parameters']['folders'], 6)
+        self.assertEqual(results['serve_large']['bytes'], 1024 * 1024 * 3)
+        self.assertEqual(results['serve_large_range']['status'], 206)
+        self.assertEqual(results['add_file']['status'], 302)
+        for name in ('index', 'index_cached', 'show_folder', 'show_file'):
+            self.assertEqual(results[name]['status'], 200)
+            self.assertGreater(results[name]['peak_memory'], 0)
+        self.assertLessEqual(results['index_cached']['queries'], results['index']['queries'])
+
+    def test_repeat_must_be_positive(self):
+        with self.assertRaises(CommandError):
+            call_command('spaces_files_benchmark', '--repeat', '0')
+
+
+@override_settings(SPACES_FILES_METRICS_SINKS=[
+    'spaces_files.instrumentation.PrometheusSink',
+    'spaces_files.instrumentation.ServerTimingSink',
+])
+class TestInstrumentation(TestCase):
+    """
+    Instrumented views and servers report queries, phases, storage calls and
+    bytes served.
+    """
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            username='jacob', email='jacob@…', password='top_secret')
+        self.space = Space.objects.create(name='My Test Space', created_by = self.user, slug="my_test_space")
+        self.files_plugin = SpacesFiles.objects.create(space=self.space, active=True)
+        SyncPlugins(False, 0).all()
+        self.user.groups.add(self.space.get_members())
+        Folder.objects.create(name="Root", file_manager=self.files_plugin, created_by=self.user)
+        registry.clear()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        with open(os.path.join(self.root, 'video.mp4'), 'wb') as f:
+            f.write(b'x' * 1000)
+
+    def test_view_metrics(self):
+        request = self.factory.get('/')
+        request.user = self.user
+        request.SPACE = self.space
+        response = index(request)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('tree;dur=', response['Server-Timing'])
+        self.assertIn('render;dur=', response['Server-Timing'])
+        response.close()
+        self.assertEqual(registry.get('spaces_files_requests_total', view='index', status=200), 1)
+        self.assertGreater(registry.get('spaces_files_db_queries_total', view='index'), 0)
+        self.assertIn('spaces_files_phase_seconds_total{phase="tree",view="index"}', registry.expose())
+
+    def test_server_metrics(self):
+        with override_settings(PRIVATE_MEDIA_ROOT=self.root):
+            response = DefaultServer().serve(self.factory.get('/'), 'video.mp4')
+        b''.join(response.streaming_content)
+        response.close()
+        self.assertEqual(registry.get('spaces_files_bytes_served_total', view='serve'), 1000)
+        self.assertEqual(
+            registry.get('spaces_files_storage_calls_total', view='serve', operation='stat'), 1)
+
+    def test_bytes_actually_sent(self):
+        with override_settings(PRIVATE_MEDIA_ROOT=self.root):
+            response = DefaultServer().serve(
+                self.factory.get('/', HTTP_RANGE='bytes=0-99'), 'video.mp4')
+            b''.join(response.streaming_content)
+            response.close()
+            # an aborted download
+            response = DefaultServer().serve(self.factory.get('/'), 'video.mp4')
+            response.close()
+            response = XSendfileServer().serve(self.factory.get('/'), 'video.mp4')
+            response.close()
+        self.assertEqual(registry.get('spaces_files_bytes_served_total', view='serve'), 100)
+        self.assertEqual(registry.get('spaces_files_requests_total', view='serve', status=200), 2)
+
+    def test_tree_cache_metrics(self):
+        get_folder_tree(self.files_plugin)
+        get_folder_tree(self.files_plugin)
+        invalidate_tree(self.files_plugin.pk)
+        self.assertEqual(registry.get('spaces_files_tree_cache_misses_total'), 1)
+        self.assertEqual(registry.get('spaces_files_tree_cache_hits_total'), 1)
+        self.assertEqual(registry.get('spaces_files_tree_cache_invalidations_total'), 1)
+        request = self.factory.get('/metrics')
+        request.user = self.user
+        request.user.is_staff = True
+        self.assertIn(b'spaces_files_tree_cache_hits_total{} 1.0', metrics_view(request).content)
+
+    @override_settings(SPACES_FILES_METRICS_SINKS=[])
+    def test_disabled(self):
+        request = self.factory.get('/')
+        request.user = self.user
+        request.SPACE = self.space
+        response = index(request)
+        self.assertNotIn('Server-Timing', response)
+        response.close()
+        self.assertEqual(registry.expose(), '\n')
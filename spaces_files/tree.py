@@ -0,0 +1,134 @@
+"""
+In-memory folder trees for the templates.
+
+Rendering a space's folders used to cost several queries per folder (ancestors,
+parent, file count, file list). The functions here load all folders and files
+of a (sub)tree up front and attach everything the templates need to each
+folder instance:
+
+    node.tree_ancestors  list of ancestor folders, root first
+    node.tree_files      list of files directly contained in the folder
+
+Children and parents are cached the same way mptt's `cache_tree_children`
+does it, so `{% recursetree %}`, `node.get_children` and `node.parent` don't
+hit the database either.
+
+For spaces too large to render at once, `get_root_folders` and
+`get_folder_children` load the tree one level at a time.
+"""
+from django.conf import settings
+from django.db.models import Q
+
+from .cache import get_tree_data, invalidate_tree
+from .models import Folder, File
+
+# number of files per page when expanding folders lazily
+CHILDREN_PAGE_SIZE = getattr(settings, 'SPACES_FILES_CHILDREN_PAGE_SIZE', 100)
+
+
+def build_tree(folders, files, ancestors=()):
+    """
+    Link the given folders (in tree order) and files into an in-memory tree.
+
+    `ancestors` are the ancestors of the first folder in `folders` if the
+    tree is a branch, not a whole space. Returns the list of folders.
+    """
+    nodes = {}
+    path = list(ancestors)
+    for node in folders:
+        # drop everything from the path that isn't an ancestor of this node
+        while path and not (path[-1].tree_id == node.tree_id
+                            and path[-1].lft < node.lft < path[-1].rght):
+            path.pop()
+        node.tree_ancestors = list(path)
+        node.tree_files = []
+        node._cached_children = []
+        if path and path[-1].pk in nodes:
+            node.parent = path[-1]
+            path[-1]._cached_children.append(node)
+        nodes[node.pk] = node
+        path.append(node)
+    for file in files:
+        parent = nodes.get(file.parent_id)
+        if parent is not None:
+            file.parent = parent
+            parent.tree_files.append(file)
+    return list(folders)
+
+
+def load_tree_data(file_manager_id):
+    """
+    Return lists of all folders (in tree order) and files (ordered by name)
+    of a file manager.
+    """
+    folders = Folder.objects.filter(file_manager_id=file_manager_id)
+    files = File.objects.filter(parent__file_manager_id=file_manager_id)
+    return list(folders.order_by('tree_id', 'lft')), list(files.order_by('name'))
+
+
+def get_folder_tree(files_plugin, root=None):
+    """
+    Return all folders of a space's file manager (or the branch below `root`,
+    including `root` itself) in tree order, with ancestors, children and files
+    attached.
+
+    The folders and files are cached per file manager (see
+    spaces_files.cache), loading them takes two queries.
+    """
+    if files_plugin is None:
+        return []
+    file_manager_id = files_plugin.pk
+    folders, files = get_tree_data(file_manager_id, load_tree_data)
+    if root is None:
+        return build_tree(folders, files)
+    # tree ids of all spaces shift when root folders are added, so compare
+    # positions to the cached copy of root rather than to root itself
+    cached_root = next((f for f in folders if f.pk == root.pk), None)
+    if cached_root is None:
+        invalidate_tree(file_manager_id)
+        folders, files = get_tree_data(file_manager_id, load_tree_data)
+        cached_root = next((f for f in folders if f.pk == root.pk), root)
+    ancestors = [
+        f for f in folders
+        if f.tree_id == cached_root.tree_id and f.lft < cached_root.lft < f.rght
+    ]
+    folders = [
+        f for f in folders
+        if f.tree_id == cached_root.tree_id and cached_root.lft <= f.lft < cached_root.rght
+    ]
+    folder_ids = set(f.pk for f in folders)
+    files = [f for f in files if f.parent_id in folder_ids]
+    return build_tree(folders, files, ancestors)
+
+
+def get_root_folders(files_plugin):
+    """
+    Return the top level folders of a space's file manager.
+    """
+    folders = Folder.objects.filter(file_manager=files_plugin, level=0)
+    return list(folders.order_by('tree_id'))
+
+
+def get_folder_children(folder, after=None, limit=CHILDREN_PAGE_SIZE):
+    """
+    Return the direct subfolders of a folder and a page of its files, ordered
+    by name.
+
+    Files are paginated by keyset: `after` is the (name, id) tuple of the
+    last file of the previous page. Subfolders are only returned with the
+    first page. Returns a (subfolders, files, next) tuple, where `next` is the
+    `after` value for the next page or None if there are no more files.
+    """
+    subfolders = []
+    files = File.objects.filter(parent=folder).order_by('name', 'pk')
+    if after is None:
+        subfolders = list(folder.get_children())
+    else:
+        name, pk = after
+        files = files.filter(Q(name__gt=name) | Q(name=name, pk__gt=pk))
+    files = list(files[:limit + 1])
+    next_page = None
+    if len(files) > limit:
+        files = files[:limit]
+        next_page = (files[-1].name, files[-1].pk)
+    return subfolders, files, next_page
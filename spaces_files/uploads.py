@@ -0,0 +1,143 @@
+"""
+Storage of chunked uploads.
+
+Chunks of an UploadSession are written to their own files in a temporary
+directory, named after their index and byte offset. Finalizing an upload
+concatenates them in a single streaming pass, computing the checksum on the
+way, and hands the result to the regular File save path.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.files import File as DjangoFile
+
+from .utils import CHUNK_SIZE
+
+# directory for chunks of unfinished uploads. Must be shared by all workers.
+UPLOAD_TEMP_DIR = getattr(
+    settings,
+    'SPACES_FILES_UPLOAD_TEMP_DIR',
+    os.path.join(
+        getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None) or tempfile.gettempdir(),
+        'spaces_files_uploads'
+    )
+)
+# largest chunk accepted in a single request
+UPLOAD_MAX_CHUNK_SIZE = getattr(settings, 'SPACES_FILES_UPLOAD_MAX_CHUNK_SIZE', 16 * 1024 * 1024)
+
+
+class UploadError(Exception):
+    pass
+
+
+class AssembledFile(DjangoFile):
+    """
+    The complete content of a chunked upload. Carries the checksum computed
+    while assembling, so it doesn't have to be read again.
+    """
+    def __init__(self, file, name, checksum):
+        super(AssembledFile, self).__init__(file, name)
+        self.checksum = checksum
+
+
+def get_chunk_dir(session):
+    return os.path.join(UPLOAD_TEMP_DIR, str(session.pk))
+
+
+def write_chunk(session, index, offset, stream, length):
+    """
+    Copy `length` bytes from `stream` into the chunk file for `index`.
+    Uploading a chunk again replaces the previous one.
+    """
+    if offset < 0 or length < 0 or offset + length > session.size:
+        raise UploadError('Chunk exceeds the announced file size.')
+    if length > UPLOAD_MAX_CHUNK_SIZE:
+        raise UploadError('Chunk is larger than %d bytes.' % UPLOAD_MAX_CHUNK_SIZE)
+    chunk_dir = get_chunk_dir(session)
+    os.makedirs(chunk_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=chunk_dir, prefix='.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            remaining = length
+            while remaining > 0:
+                data = stream.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise UploadError('Chunk is shorter than announced.')
+                f.write(data)
+                remaining -= len(data)
+        for previous in _chunk_files(session):
+            if previous[0] == index:
+                os.remove(os.path.join(chunk_dir, previous[3]))
+        os.rename(tmp_path, os.path.join(chunk_dir, '%08d-%d' % (index, offset)))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _chunk_files(session):
+    """
+    Return (index, offset, size, filename) tuples of all received chunks,
+    ordered by offset.
+    """
+    chunk_dir = get_chunk_dir(session)
+    if not os.path.isdir(chunk_dir):
+        return []
+    chunks = []
+    for filename in os.listdir(chunk_dir):
+        if filename.startswith('.'):
+            continue
+        index, offset = filename.split('-')
+        size = os.path.getsize(os.path.join(chunk_dir, filename))
+        chunks.append((int(index), int(offset), size, filename))
+    return sorted(chunks, key=lambda chunk: chunk[1])
+
+
+def received_chunks(session):
+    """
+    Return a list of dicts describing the received chunks, to let clients
+    resume an interrupted upload.
+    """
+    return [
+        {'index': index, 'offset': offset, 'size': size}
+        for index, offset, size, filename in _chunk_files(session)
+    ]
+
+
+def assemble(session):
+    """
+    Concatenate all chunks into a temporary file and return it as an
+    AssembledFile. Raises UploadError if chunks are missing or overlap.
+    """
+    chunk_dir = get_chunk_dir(session)
+    expected = 0
+    chunks = _chunk_files(session)
+    for index, offset, size, filename in chunks:
+        if offset != expected:
+            raise UploadError('Chunks are missing or overlapping at byte %d.' % expected)
+        expected += size
+    if expected != session.size:
+        raise UploadError('Received %d of %d bytes.' % (expected, session.size))
+    digest = hashlib.sha256()
+    target = tempfile.NamedTemporaryFile(dir=chunk_dir, prefix='.')
+    for index, offset, size, filename in chunks:
+        with open(os.path.join(chunk_dir, filename), 'rb') as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                target.write(data)
+    target.flush()
+    target.seek(0)
+    return AssembledFile(target, session.filename, digest.hexdigest())
+
+
+def discard(session):
+    """
+    Remove all chunks of an upload session.
+    """
+    shutil.rmtree(get_chunk_dir(session), ignore_errors=True)
@@ -1,4 +1,4 @@
-from django.conf.urls import url
+from django.urls import re_path
 from spaces.urls import space_patterns
 
 from . import views
@@ -6,68 +6,140 @@ from . import views
 app_name = 'spaces_files'
 urlpatterns = (
 
-    url(r'^files/$', views.index, name='index'),
+    re_path(r'^files/$', views.index, name='index'),
 
-    url(
+    re_path(
         r'^files/folder/(\d+)/$', 
         views.show_folder, 
         name='folder'
     ),
 
-    url(
+    re_path(
+        r'^files/folder/(\d+)/children/$',
+        views.folder_children,
+        name='folder_children'
+    ),
+
+    re_path(
+        r'^files/folder/(\d+)/zip/$',
+        views.download_folder,
+        name='download_folder'
+    ),
+
+    re_path(
         r'^files/file/(\d+)/$', 
         views.show_file, 
         name='file'
     ),
 
-    url(
+    re_path(
         r'^files/add_file/$',
         views.add_file,
         name='add_file'
     ),
 
-    url(
+    re_path(
         r'^files/add_file/(\d+)$',
         views.add_file,
         name='add_file'
     ),
 
-    url(
+    re_path(
+        r'^files/file/(\d+)/preview/$',
+        views.file_preview,
+        name='file_preview'
+    ),
+
+    re_path(
+        r'^files/move/$',
+        views.move,
+        name='move'
+    ),
+
+    re_path(
+        r'^files/copy/$',
+        views.copy,
+        name='copy'
+    ),
+
+    re_path(
+        r'^files/search/$',
+        views.search,
+        name='search'
+    ),
+
+    re_path(
+        r'^files/add_files/$',
+        views.add_files,
+        name='add_files'
+    ),
+
+    re_path(
+        r'^files/add_files/(\d+)$',
+        views.add_files,
+        name='add_files'
+    ),
+
+    re_path(
         r'^files/add_folder/$',
         views.add_folder,
         name='add_folder'
     ),
 
-    url(
+    re_path(
         r'^files/add_folder/(\d+)$',
         views.add_folder,
         name='add_folder'
     ),
 
-    url(
+    re_path(
         r'^files/file/edit/(\d+)/$', 
         views.edit_file, 
         name='edit_file'
     ),
 
 
-    url(
+    re_path(
         r'^files/folder/edit/(\d+)/$', 
         views.edit_folder, 
         name='edit_folder'
     ),
 
-    url(
+    re_path(
         r'^files/folder/delete/(?P<pk>\d+)/$', 
         views.DeleteFolder.as_view(), 
         name='delete_folder'
     ),
 
 
-    url(
+    re_path(
         r'^files/file/delete/(?P<pk>\d+)/$', 
         views.DeleteFile.as_view(), 
         name='delete_file'
     ),
 
+    re_path(
+        r'^files/upload/$',
+        views.upload_start,
+        name='upload_start'
+    ),
+
+    re_path(
+        r'^files/upload/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})/$',
+        views.upload_session,
+        name='upload_session'
+    ),
+
+    re_path(
+        r'^files/upload/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})/(\d+)/$',
+        views.upload_chunk,
+        name='upload_chunk'
+    ),
+
+    re_path(
+        r'^files/upload/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})/finalize/$',
+        views.upload_finalize,
+        name='upload_finalize'
+    ),
+
 )
\ No newline at end of file
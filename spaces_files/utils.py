@@ -0,0 +1,54 @@
+import hashlib
+import mimetypes
+
+from django.db import connection
+
+# chunk size used when reading stored files, e.g. for hashing
+CHUNK_SIZE = 64 * 1024
+
+
+def file_checksum(fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Return the hex encoded SHA-256 digest of a django File object, reading it
+    in chunks.
+    """
+    digest = hashlib.sha256()
+    for chunk in fileobj.chunks(chunk_size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def lock_stored_file(name):
+    """
+    Keep other transactions from reusing or removing the stored file `name`
+    until the current transaction ends. Uses advisory locks on PostgreSQL,
+    does nothing on other databases. Returns whether a lock was taken.
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    # the lock key is a signed 64 bit integer
+    key = int.from_bytes(hashlib.sha256(name.encode('utf-8')).digest()[:8], 'big', signed=True)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [key])
+    return True
+
+
+def guess_content_type(name, default='application/octet-stream'):
+    """
+    Guess a file's content type from its name.
+    """
+    return mimetypes.guess_type(name)[0] or default
+
+
+def get_files_plugin(request):
+    """
+    Return the SpacesFiles instance of the request's space. It's looked up
+    once per request and kept on the request.
+    """
+    if not hasattr(request, '_spaces_files_plugin'):
+        from spaces.models import SpacePluginRegistry
+        request._spaces_files_plugin = SpacePluginRegistry().get_instance(
+            plugin_name='spaces_files',
+            space=request.SPACE
+        )
+    return request._spaces_files_plugin
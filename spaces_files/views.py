@@ -1,19 +1,49 @@
+from urllib.parse import quote
+
+from django.conf import settings
 from django.contrib import messages
+from django.db import transaction
+from django.http import FileResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.contrib.messages.views import SuccessMessageMixin
+from django.core.exceptions import PermissionDenied
+from django.core.signing import BadSignature
 from django.shortcuts import render, redirect, get_object_or_404
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
-from django.utils.encoding import force_text
-from django.utils.translation import ugettext as _
+from django.utils.encoding import force_str
+from django.utils.http import urlencode
+from django.utils.inspect import func_supports_parameter
+from django.utils.module_loading import import_string
+from django.utils.translation import gettext as _, ngettext
+from django.views.decorators.http import require_http_methods, require_POST, require_safe
 from django.views.generic.edit import DeleteView
 from actstream.signals import action as actstream_action
-from spaces.models import SpacePluginRegistry
 from spaces_notifications.forms import NotificationFormSet
 from spaces_notifications.mixins import process_n12n_formset
 from collab.decorators import permission_required_or_403
 from .decorators import file_owner_or_admin_required
-from .forms import FolderForm, FileForm
-from .models import Folder, File, FilesPlugin
+from .aggregates import adjust_folder, suspend_aggregates
+from .archive import folder_entries, zip_stream
+from .bulk import BulkOperationError, copy_items, move_items
+from .deletion import delete_stored_files
+from .forms import (BulkItemsForm, FolderForm, FileForm, MultiFileForm,
+    UploadSessionForm)
+from .instrumentation import instrument, phase
+from .models import Folder, File, FilesPlugin, UploadSession
+from .permissions import OwnerPermissions
+from .pipeline import announce_upload
+from .previews import PREVIEW_MAX_AGE, open_preview
+from .search import search_files
+from .servers import AsyncDefaultServer, get_media_server, sync_to_async
+from .signing import get_download_url, verify
+from .tree import get_folder_children, get_folder_tree, get_root_folders
+from .utils import get_files_plugin
+from . import uploads
+
+# render only top level folders on the index page and load the rest on demand
+LAZY_TREE = getattr(settings, 'SPACES_FILES_LAZY_TREE', False)
+
 
 def base_extra_context(request):
     extra_context = {}
@@ -21,23 +51,132 @@ def base_extra_context(request):
     return extra_context
 
 
+@instrument('index')
 @permission_required_or_403('access_space')
 def index(request):
     extra_context = base_extra_context(request)
-    extra_context["folders"] = Folder.objects.all().filter(file_manager__space=request.SPACE)
-    return render(request, 'spaces_files/index.html', extra_context)
+    with phase('tree'):
+        if LAZY_TREE:
+            extra_context["lazy_tree"] = True
+            extra_context["subfolders"] = get_root_folders(get_files_plugin(request))
+        else:
+            extra_context["folders"] = get_folder_tree(get_files_plugin(request))
+    with phase('render'):
+        return render(request, 'spaces_files/index.html', extra_context)
 
 
+@instrument('show_folder')
 @permission_required_or_403('access_space')
 def show_folder(request, folder_id=None):
     """
     Show a folder branch starting from the given folder id.
     """
-    folder = get_object_or_404(Folder, id=folder_id, file_manager__space=request.SPACE)
+    folder = get_object_or_404(Folder, id=folder_id, file_manager=get_files_plugin(request))
+    with phase('tree'):
+        folders = get_folder_tree(get_files_plugin(request), root=folder)
+    extra_context = base_extra_context(request)
+    # the tree's copy of the folder has its ancestors attached
+    extra_context["folder"] = folders[0]
+    extra_context["folders"] = folders
+    with phase('render'):
+        return render(request, 'spaces_files/subfolder.html', extra_context)
+
+
+@instrument('folder_children')
+@permission_required_or_403('access_space')
+def folder_children(request, folder_id=None):
+    """
+    Return the direct subfolders and a page of files of a folder, as table
+    rows for the folder tree or as JSON if `format=json` is requested.
+
+    Pages after the first are requested with the `after_name` and `after_id`
+    of the last file of the previous page.
+    """
+    folder = get_object_or_404(Folder, id=folder_id, file_manager=get_files_plugin(request))
+    after = None
+    if 'after_id' in request.GET:
+        try:
+            after = (request.GET.get('after_name', ''), int(request.GET['after_id']))
+        except ValueError:
+            return JsonResponse({'error': _("Invalid page.")}, status=400)
+    with phase('tree'):
+        subfolders, files, next_page = get_folder_children(folder, after)
+    next_url = None
+    if next_page:
+        params = {'after_name': next_page[0], 'after_id': next_page[1]}
+        if request.GET.get('format') == 'json':
+            params['format'] = 'json'
+        next_url = '%s?%s' % (request.path, urlencode(params))
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'folders': [{
+                'id': f.pk,
+                'name': f.name,
+                'url': f.get_absolute_url(),
+                'children_url': reverse('spaces_files:folder_children', args=[f.pk]),
+                'has_children': not f.is_leaf_node() or f.file_count > 0,
+                'file_count': f.tree_file_count,
+                'size': f.tree_total_size,
+            } for f in subfolders],
+            'files': [{
+                'id': f.pk,
+                'name': f.get_name(),
+                'size': f.size,
+                'url': f.get_absolute_url(),
+                'download_url': get_download_url(f, request.user),
+            } for f in files],
+            'next': next_url,
+        })
     extra_context = base_extra_context(request)
     extra_context["folder"] = folder
-    extra_context["folders"] = folder.get_descendants(include_self=True)
-    return render(request, 'spaces_files/subfolder.html', extra_context)
+    extra_context["ancestor_ids"] = ' '.join(
+        str(pk) for pk in folder.get_ancestors(include_self=True).values_list('pk', flat=True))
+    extra_context["subfolders"] = subfolders
+    extra_context["files"] = files
+    extra_context["next_url"] = next_url
+    with phase('render'):
+        return render(request, 'spaces_files/children.html', extra_context)
+
+
+@instrument('download_folder')
+@permission_required_or_403('access_space')
+def download_folder(request, folder_id=None):
+    """
+    Send a folder and everything below it as a ZIP archive, which is built
+    while it's sent.
+    """
+    folder = get_object_or_404(Folder, id=folder_id, file_manager=get_files_plugin(request))
+    with phase('tree'):
+        folders = get_folder_tree(get_files_plugin(request), root=folder)
+    response = StreamingHttpResponse(
+        zip_stream(folder_entries(folders)),
+        content_type='application/zip'
+    )
+    filename = '%s.zip' % folder.name
+    response['Content-Disposition'] = "attachment; filename*=UTF-8''%s" % quote(filename)
+    return response
+
+
+@instrument('search')
+@permission_required_or_403('access_space')
+def search(request):
+    """
+    Full-text search over the files of the space. Answers with JSON if
+    `format=json` is requested.
+    """
+    query = request.GET.get('q', '').strip()
+    with phase('search'):
+        files = search_files(get_files_plugin(request), query) if query else []
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'files': [
+            {'id': f.pk, 'name': f.get_name(), 'url': f.get_absolute_url()}
+            for f in files
+        ]})
+    extra_context = base_extra_context(request)
+    extra_context["query"] = query
+    extra_context["files"] = files
+    with phase('render'):
+        return render(request, 'spaces_files/search.html', extra_context)
 
 
 def save_files_form(request, form):
@@ -46,23 +185,20 @@ def save_files_form(request, form):
     """
     obj = form.save(commit=False)
     obj.created_by = request.user
-    files_plugin = SpacePluginRegistry().get_instance(
-        plugin_name='spaces_files',
-        space=request.SPACE
-    )
-    obj.file_manager = files_plugin
+    obj.file_manager = get_files_plugin(request)
     obj.save()
     return obj
 
-    
+
+
 @permission_required_or_403('access_space')#TODO:finetune permissions according to spec
 def edit_folder(request, folder_id=None):
     """
     Display and process a form for editing a given folder.
     """
-    folder = get_object_or_404(Folder, id=folder_id, file_manager__space=request.SPACE)
+    folder = get_object_or_404(Folder, id=folder_id, file_manager=get_files_plugin(request))
     if request.method == 'POST':
-        form = FolderForm(request.POST, instance=folder, space=request.SPACE)
+        form = FolderForm(request.POST, instance=folder, files_plugin=get_files_plugin(request))
         if form.is_valid():
             folder = save_files_form(request, form)
             actstream_action.send(
@@ -74,7 +210,7 @@ def edit_folder(request, folder_id=None):
 
             return redirect('spaces_files:index')
     else:
-        form = FolderForm(instance=folder, space=request.SPACE)
+        form = FolderForm(instance=folder, files_plugin=get_files_plugin(request))
     extra_context = base_extra_context(request)
     extra_context["form"] = form
     return render(request, 'spaces_files/add_folder.html', extra_context)
@@ -103,24 +239,45 @@ class DeleteFolder(SuccessMessageMixin, DeleteView):
     # ensure only folders of own space can get deleted
     def get_queryset(self):
         qs = super(DeleteFolder, self).get_queryset()
-        qs = qs.filter(file_manager__space=self.request.SPACE)
+        qs = qs.filter(file_manager=get_files_plugin(self.request))
         return qs
 
+@instrument('show_file')
 @permission_required_or_403('access_space')
 def show_file(request, file_id=None):
     """
     Show a folder branch starting from the given folder id.
     """
-    file = get_object_or_404(File, id=file_id, parent__file_manager__space=request.SPACE)
+    file = get_object_or_404(File, id=file_id, parent__file_manager=get_files_plugin(request))
     extra_context = base_extra_context(request)
     extra_context["file"] = file
-    return render(request, 'spaces_files/file.html', extra_context)
+    with phase('render'):
+        return render(request, 'spaces_files/file.html', extra_context)
+
+
+@instrument('file_preview')
+@permission_required_or_403('access_space')
+def file_preview(request, file_id=None):
+    """
+    Send the preview image of a file. Previews requested with the current
+    version (see File.get_preview_url) may be cached by the browser.
+    """
+    file = get_object_or_404(File, id=file_id, parent__file_manager=get_files_plugin(request))
+    preview = open_preview(file)
+    if preview is None:
+        raise Http404(_("No preview available."))
+    response = FileResponse(preview, content_type='image/jpeg')
+    if file.checksum and request.GET.get('v') == file.checksum[:16]:
+        patch_cache_control(response, private=True, max_age=PREVIEW_MAX_AGE)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @permission_required_or_403('access_space')
 def add_folder(request, folder_id=None):
     if request.method == 'POST':
-        form = FolderForm(request.POST, space=request.SPACE)
+        form = FolderForm(request.POST, files_plugin=get_files_plugin(request))
         if form.is_valid():
             folder = save_files_form(request, form)
             messages.success(request, _("Folder successfully created."))
@@ -132,7 +289,7 @@ def add_folder(request, folder_id=None):
             )
             return redirect(folder.get_absolute_url())
     else:
-        form = FolderForm(initial={'parent':folder_id}, space=request.SPACE)
+        form = FolderForm(initial={'parent':folder_id}, files_plugin=get_files_plugin(request))
     extra_context = base_extra_context(request)
     extra_context["form"] = form
     return render(request, 'spaces_files/add_folder.html', extra_context)
@@ -143,9 +300,9 @@ def edit_file(request, file_id=None):
     """
     Display and process a form for editing a given file.
     """
-    file = get_object_or_404(File, id=file_id, parent__file_manager__space=request.SPACE)
+    file = get_object_or_404(File, id=file_id, parent__file_manager=get_files_plugin(request))
     if request.method == 'POST':
-        form = FileForm(request.POST, instance=file, space=request.SPACE)
+        form = FileForm(request.POST, instance=file, files_plugin=get_files_plugin(request))
         n12n_formset = NotificationFormSet(request.SPACE, request.POST)
         if form.is_valid():
             file = save_files_form(request, form)
@@ -165,7 +322,7 @@ def edit_file(request, file_id=None):
             )
             return redirect('spaces_files:index')
     else:
-        form = FileForm(instance=file, space=request.SPACE)
+        form = FileForm(instance=file, files_plugin=get_files_plugin(request))
         n12n_formset = NotificationFormSet(request.SPACE)
     extra_context = base_extra_context(request)
     extra_context["form"] = form
@@ -173,37 +330,236 @@ def edit_file(request, file_id=None):
     return render(request, 'spaces_files/add_file.html', extra_context)
 
 
+@instrument('add_file')
 @permission_required_or_403('access_space')
 def add_file(request, parent_id=None):
     if request.method == 'POST':
-        form = FileForm(request.POST, request.FILES, space=request.SPACE)
+        form = FileForm(request.POST, request.FILES, files_plugin=get_files_plugin(request))
         n12n_formset = NotificationFormSet(request.SPACE, request.POST)
         if form.is_valid():
-            file = save_files_form(request, form)
-            actstream_action.send(
-                sender=request.user,
-                verb=_("was created"),
-                target=request.SPACE,
-                action_object=file
-            )
+            # the activity entry and notifications are sent in the background
+            announce_upload(form.instance, request)
+            with phase('save'):
+                file = save_files_form(request, form)
             messages.success(request, _("File successfully created."))
-            process_n12n_formset(
-                n12n_formset,
-                'spaces_files_file_create',
-                request.SPACE,
-                file,
-                file.get_absolute_url()
-            )
             redirect_target = file.parent.get_absolute_url() if file.parent else 'spaces_files:index'
             return redirect(redirect_target)
     else:
-        form = FileForm(initial={'parent':parent_id}, space=request.SPACE)
+        form = FileForm(initial={'parent':parent_id}, files_plugin=get_files_plugin(request))
         n12n_formset = NotificationFormSet(request.SPACE)
     extra_context = base_extra_context(request)
     extra_context["form"] = form
     extra_context["notification_formset"] = n12n_formset
     return render(request, 'spaces_files/add_file.html', extra_context)
 
+
+
+def save_multiple_files(request, form):
+    """
+    Save all files of a MultiFileForm in one transaction. Returns the list of
+    created files.
+    """
+    parent = form.cleaned_data['parent']
+    description = form.cleaned_data['description']
+    files = []
+    try:
+        with transaction.atomic(), suspend_aggregates():
+            for upload in form.cleaned_data['files']:
+                file = File(
+                    parent=parent,
+                    file=upload,
+                    description=description,
+                    created_by=request.user
+                )
+                file.save()
+                files.append(file)
+            # one update of the folder counts for the whole batch
+            adjust_folder(parent.pk, len(files), sum(f.size or 0 for f in files))
+    except Exception:
+        # the rows are gone, remove what was already written to the storage
+        delete_stored_files([f.file.name for f in files])
+        raise
+    return files
+
+
+def files_created(request, parent, files, n12n_formset):
+    """
+    Announce a batch of new files in a folder with a single activity stream
+    entry and a single round of notifications.
+    """
+    actstream_action.send(
+        sender=request.user,
+        verb=ngettext(
+            "received %(count)d new file",
+            "received %(count)d new files",
+            len(files)
+        ) % {'count': len(files)},
+        target=request.SPACE,
+        action_object=parent
+    )
+    process_n12n_formset(
+        n12n_formset,
+        'spaces_files_file_create',
+        request.SPACE,
+        parent,
+        parent.get_absolute_url()
+    )
+
+
+@instrument('add_files')
+@permission_required_or_403('access_space')
+def add_files(request, parent_id=None):
+    """
+    Upload several files into a folder at once. Answers with JSON if
+    `format=json` is requested.
+    """
+    as_json = request.GET.get('format') == 'json'
+    if request.method == 'POST':
+        form = MultiFileForm(request.POST, request.FILES, files_plugin=get_files_plugin(request))
+        n12n_formset = NotificationFormSet(request.SPACE, request.POST)
+        if form.is_valid():
+            parent = form.cleaned_data['parent']
+            with phase('save'):
+                files = save_multiple_files(request, form)
+            with phase('notify'):
+                files_created(request, parent, files, n12n_formset)
+            if as_json:
+                return JsonResponse({'files': [
+                    {'id': f.pk, 'name': f.name, 'url': f.get_absolute_url()}
+                    for f in files
+                ]}, status=201)
+            messages.success(request, ngettext(
+                "%(count)d file successfully created.",
+                "%(count)d files successfully created.",
+                len(files)
+            ) % {'count': len(files)})
+            return redirect(parent.get_absolute_url())
+        if as_json:
+            return JsonResponse({'errors': form.errors}, status=400)
+    else:
+        form = MultiFileForm(initial={'parent': parent_id}, files_plugin=get_files_plugin(request))
+        n12n_formset = NotificationFormSet(request.SPACE)
+    extra_context = base_extra_context(request)
+    extra_context["form"] = form
+    extra_context["notification_formset"] = n12n_formset
+    return render(request, 'spaces_files/add_files.html', extra_context)
+
+@require_POST
+@instrument('move')
+@permission_required_or_403('access_space')
+def move(request):
+    """
+    Move the posted `folders` and `files` into the `target` folder. Answers
+    with JSON.
+    """
+    form = BulkItemsForm(request.POST, files_plugin=get_files_plugin(request))
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    folders = list(form.cleaned_data['folders'])
+    files = list(form.cleaned_data['files'])
+    target = form.cleaned_data['target']
+    permissions = OwnerPermissions(request.user, request.SPACE)
+    if not all(permissions.can_modify(obj) for obj in folders + files):
+        return JsonResponse(
+            {'error': _("You may only move your own folders and files.")}, status=403)
+    try:
+        move_items(get_files_plugin(request), folders, files, target)
+    except BulkOperationError as e:
+        return JsonResponse({'error': force_str(e)}, status=400)
+    count = len(folders) + len(files)
+    actstream_action.send(
+        sender=request.user,
+        verb=ngettext(
+            "received %(count)d moved item",
+            "received %(count)d moved items",
+            count
+        ) % {'count': count},
+        target=request.SPACE,
+        action_object=target
+    )
+    return JsonResponse({
+        'folders': len(folders),
+        'files': len(files),
+        'url': target.get_absolute_url(),
+    })
+
+
+@require_POST
+@instrument('copy')
+@permission_required_or_403('access_space')
+def copy(request):
+    """
+    Copy the posted `folders` (with their contents) and `files` into the
+    `target` folder. Copies share the stored files. Answers with JSON.
+    """
+    form = BulkItemsForm(request.POST, files_plugin=get_files_plugin(request))
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    target = form.cleaned_data['target']
+    try:
+        folder_count, file_count = copy_items(
+            get_files_plugin(request),
+            list(form.cleaned_data['folders']),
+            list(form.cleaned_data['files']),
+            target,
+            request.user
+        )
+    except BulkOperationError as e:
+        return JsonResponse({'error': force_str(e)}, status=400)
+    count = folder_count + file_count
+    actstream_action.send(
+        sender=request.user,
+        verb=ngettext(
+            "received %(count)d copied item",
+            "received %(count)d copied items",
+            count
+        ) % {'count': count},
+        target=request.SPACE,
+        action_object=target
+    )
+    return JsonResponse({
+        'folders': folder_count,
+        'files': file_count,
+        'url': target.get_absolute_url(),
+    }, status=201)
+
+@require_safe
+@instrument('signed_download')
+def signed_download(request, file_id, name):
+    """
+    Serve a file for a signed URL (see spaces_files.signing) to the user it
+    was issued to. The file isn't looked up and permissions aren't checked
+    again.
+
+    The signed checksum is passed on to servers whose `serve` accepts it
+    (DefaultServer and its subclasses), servers of django-private-media only
+    get the path.
+    """
+    try:
+        checksum = verify(file_id, name, request.GET, request.user)
+    except BadSignature:
+        raise PermissionDenied
+    server = get_media_server()
+    if func_supports_parameter(server.serve, 'checksum'):
+        return server.serve(request, name, checksum=checksum)
+    return server.serve(request, name)
+
+
+async def serve_private_file_async(request, path):
+    """
+    Serve a private media file under ASGI with AsyncDefaultServer. Checks
+    PRIVATE_MEDIA_PERMISSIONS like the view of django-private-media, in a
+    thread since it queries the database. Needs Django 4.2 or later.
+    """
+    permissions = import_string(getattr(
+        settings, 'PRIVATE_MEDIA_PERMISSIONS',
+        'private_media.permissions.DefaultPrivateMediaPermissions'))(
+        **getattr(settings, 'PRIVATE_MEDIA_PERMISSIONS_OPTIONS', {}))
+    if not await sync_to_async(permissions.has_read_permission)(request, path):
+        raise PermissionDenied
+    return await AsyncDefaultServer().serve(request, path)
+
+
 class DeleteFile(SuccessMessageMixin,DeleteView):
 
     model = File
@@ -233,5 +589,106 @@ class DeleteFile(SuccessMessageMixin,DeleteView):
     # ensure only files of own space can get deleted
     def get_queryset(self):
         qs = super(DeleteFile, self).get_queryset()
-        qs = qs.filter(parent__file_manager__space=self.request.SPACE)
+        qs = qs.filter(parent__file_manager=get_files_plugin(self.request))
         return qs
+
+
+### CHUNKED UPLOADS
+# Large files can be uploaded in chunks: POST the file's name, size and
+# parent folder to `upload_start`, PUT the chunks to `upload_chunk` with their
+# byte offset in the `offset` query parameter, then POST to `upload_finalize`.
+# GET on the session tells which chunks have arrived, so interrupted uploads
+# can be resumed.
+
+def get_upload_session(request, session_id):
+    return get_object_or_404(
+        UploadSession,
+        pk=session_id,
+        created_by=request.user,
+        parent__file_manager=get_files_plugin(request)
+    )
+
+
+def upload_session_data(session):
+    return {
+        'id': str(session.pk),
+        'url': session.get_absolute_url(),
+        'size': session.size,
+        'max_chunk_size': uploads.UPLOAD_MAX_CHUNK_SIZE,
+        'chunks': uploads.received_chunks(session),
+    }
+
+
+@require_POST
+@permission_required_or_403('access_space')
+def upload_start(request):
+    form = UploadSessionForm(request.POST, files_plugin=get_files_plugin(request))
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    session = form.save(commit=False)
+    session.created_by = request.user
+    session.save()
+    return JsonResponse(upload_session_data(session), status=201)
+
+
+@require_http_methods(['GET', 'DELETE'])
+@permission_required_or_403('access_space')
+def upload_session(request, session_id=None):
+    session = get_upload_session(request, session_id)
+    if request.method == 'DELETE':
+        session.delete()
+        return JsonResponse({})
+    return JsonResponse(upload_session_data(session))
+
+
+@instrument('upload_chunk')
+@require_http_methods(['PUT'])
+@permission_required_or_403('access_space')
+def upload_chunk(request, session_id=None, index=None):
+    session = get_upload_session(request, session_id)
+    try:
+        offset = int(request.GET['offset'])
+        length = int(request.META['CONTENT_LENGTH'])
+    except (KeyError, ValueError):
+        return JsonResponse(
+            {'error': _("Offset and Content-Length are required.")}, status=400)
+    try:
+        uploads.write_chunk(session, int(index), offset, request, length)
+    except uploads.UploadError as e:
+        return JsonResponse({'error': force_str(e)}, status=400)
+    return JsonResponse({'index': int(index), 'offset': offset, 'size': length})
+
+
+@instrument('upload_finalize')
+@require_POST
+@permission_required_or_403('access_space')
+def upload_finalize(request, session_id=None):
+    """
+    Assemble the chunks and save the file the same way `add_file` does.
+    """
+    session = get_upload_session(request, session_id)
+    try:
+        content = uploads.assemble(session)
+    except uploads.UploadError as e:
+        return JsonResponse(
+            {'error': force_str(e), 'chunks': uploads.received_chunks(session)},
+            status=400
+        )
+    try:
+        form = FileForm(
+            {
+                'name': session.name,
+                'description': session.description,
+                'parent': session.parent_id
+            },
+            {'file': content},
+            files_plugin=get_files_plugin(request)
+        )
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        announce_upload(form.instance, request)
+        file = save_files_form(request, form)
+    finally:
+        content.close()
+    session.delete()
+    return JsonResponse({'id': file.pk, 'url': file.get_absolute_url()}, status=201)